@@ -0,0 +1,225 @@
+"""
+End-to-end build benchmark on the local SQLite backend.
+
+Seeds a throwaway local backend with a synthetic recipe and source table,
+runs a whole build (aggregation, suppression, moe, delivery and the Census
+Reporter metadata) and prints the per-stage timings from the run report.
+No database servers are needed.
+
+    python benchmarks/e2e.py
+    python benchmarks/e2e.py --source points --geoids 5000 --variables 60
+    python benchmarks/e2e.py --json e2e.json --keep
+
+--source geoid uses a source already keyed by geoid (the "geoid"
+aggregation backend); --source points scatters point features over a grid
+of blocks and aggregates them with the "strtree" backend.
+"""
+import argparse
+import json
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from synthetic import SHAPES, make_table, make_variables
+
+from lib.build import BuildJob, build_table
+from lib.d3models import D3EditionMetadata, D3TableMetadata, D3VariableMetadata
+from lib.instrumentation import RunReport
+from lib.local import LocalBackend
+from lib.recipes import load_recipe
+
+
+TABLE_NAME = "b99999"
+SOURCE_DB = "synthetic"
+SOURCE_SCHEMA = "raw"
+
+# Blocks per tract in the points source, every block belongs to both
+BLOCKS_PER_TRACT = 10
+
+
+def leaf_descendants(variables) -> dict[str, list[int]]:
+    """
+    The leaf positions under each variable (a leaf is its own only leaf).
+    """
+    children = {variable.variable_name: [] for variable in variables}
+    for variable in variables:
+        if variable.parent_column is not None:
+            children[variable.parent_column].append(variable.variable_name)
+
+    positions = {variable.variable_name: position for position, variable in enumerate(variables)}
+
+    def leaves(name):
+        if not children[name]:
+            return [positions[name]]
+        return [leaf for child in children[name] for leaf in leaves(child)]
+
+    return {name: leaves(name) for name in children}
+
+
+def seed_geoid_source(directory: Path, variables, namespace) -> list[str]:
+    table = make_table(variables, namespace.geoids, namespace.small_fraction, namespace.threshold)
+
+    with sqlite3.connect(directory / f"{SOURCE_SCHEMA}.sqlite") as connection:
+        table.to_sql(TABLE_NAME, connection, index=False)
+
+    return [f"sum(aa.{variable.variable_name})" for variable in variables]
+
+
+def seed_points_source(directory: Path, variables, namespace) -> list[str]:
+    rng = np.random.default_rng(0)
+    width = int(np.ceil(np.sqrt(namespace.geoids)))
+
+    blocks = pd.DataFrame(
+        {
+            "geoids": [
+                json.dumps([f"10000US{block:09d}", f"14000US{block // BLOCKS_PER_TRACT:09d}"])
+                for block in range(namespace.geoids)
+            ],
+            "geom": shapely.to_wkb(
+                [shapely.box(block % width, block // width, block % width + 1, block // width + 1)
+                 for block in range(namespace.geoids)]
+            ),
+        }
+    )
+    with sqlite3.connect(directory / "shp.sqlite") as connection:
+        blocks.to_sql("blockgeom2geoids20", connection, index=False)
+
+    leaves = leaf_descendants(variables)
+    leaf_positions = sorted({leaf for positions in leaves.values() for leaf in positions})
+
+    count = namespace.geoids * namespace.points_per_geoid
+    block = rng.integers(0, namespace.geoids, count)
+    points = pd.DataFrame(
+        {
+            "category": rng.choice(leaf_positions, count),
+            "geom": shapely.to_wkb(
+                shapely.points(block % width + rng.random(count), block // width + rng.random(count))
+            ),
+        }
+    )
+    with sqlite3.connect(directory / f"{SOURCE_SCHEMA}.sqlite") as connection:
+        points.to_sql(TABLE_NAME, connection, index=False)
+
+    return [
+        f"count(*) FILTER (WHERE aa.category IN ({', '.join(map(str, leaves[variable.variable_name]))}))"
+        for variable in variables
+    ]
+
+
+def seed(backend: LocalBackend, namespace):
+    variables = make_variables(namespace.variables, namespace.shape, TABLE_NAME)
+
+    source = backend.directory / "source" / SOURCE_DB
+    source.mkdir(parents=True, exist_ok=True)
+    if namespace.source == "geoid":
+        phrases = seed_geoid_source(source, variables, namespace)
+    else:
+        phrases = seed_points_source(source, variables, namespace)
+
+    WorkspaceSession = backend.workspace_session()
+    with WorkspaceSession() as db:
+        db.add(
+            D3TableMetadata(
+                table_name=TABLE_NAME,
+                description="Synthetic benchmark table",
+                description_simple="Synthetic",
+                subject_area="Benchmarks",
+                universe="Synthetic geographies",
+                suppression_threshold=namespace.threshold,
+            )
+        )
+        db.add(
+            D3EditionMetadata(
+                table_name=TABLE_NAME,
+                edition="2024",
+                raw_table_db=SOURCE_DB,
+                raw_table_schema=SOURCE_SCHEMA,
+                raw_table_name=TABLE_NAME,
+                time_frame="PRESENT",
+            )
+        )
+        db.add_all(
+            D3VariableMetadata(
+                variable_name=variable.variable_name,
+                table_name=TABLE_NAME,
+                indentation=variable.indentation,
+                description=variable.variable_name,
+                parent_column=variable.parent_column,
+                sql_aggregation_phrase=phrase,
+            )
+            for variable, phrase in zip(variables, phrases)
+        )
+        db.commit()
+
+
+def print_stages(stages, depth=0):
+    for record in stages:
+        rate = f"{record.rows_per_second:12,.0f} rows/s" if record.rows_per_second else ""
+        print(f"{'  ' * depth + record.name:<32} {record.seconds * 1000:10.1f} ms {record.rows:10,} rows {rate}")
+        print_stages(record.stages, depth + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--source", choices=("geoid", "points"), default="geoid")
+    parser.add_argument("--geoids", type=int, default=2000)
+    parser.add_argument("--variables", type=int, default=30)
+    parser.add_argument("--shape", choices=SHAPES, default="balanced")
+    parser.add_argument("--small_fraction", type=float, default=0.2)
+    parser.add_argument("--points_per_geoid", type=int, default=20)
+    parser.add_argument("--threshold", type=int, default=6)
+    parser.add_argument("--compile_phrases", action="store_true", help="Aggregate with lib.compiler's query.")
+    parser.add_argument("--validation", choices=("equal", "not_exceed", "off"), default="off")
+    parser.add_argument("--blobs", action="store_true", help="Also render the per-geoid JSON documents.")
+    parser.add_argument("--trace_memory", action="store_true")
+    parser.add_argument("--json", metavar="PATH", help="Also write the run report here.")
+    parser.add_argument("--keep", action="store_true", help="Keep the local backend's files.")
+    namespace = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp(prefix="pipeline-e2e-"))
+    config = {
+        "backend": {"kind": "local", "directory": str(directory)},
+        "aggregation": {
+            "backend": "geoid" if namespace.source == "geoid" else "strtree",
+            "compile_phrases": namespace.compile_phrases,
+            "verify_compiled": namespace.compile_phrases,
+        },
+        "validation": {"mode": namespace.validation, "strict": True},
+        "blobs": {"enabled": namespace.blobs},
+    }
+
+    try:
+        with LocalBackend.from_config(config) as backend:
+            seed(backend, namespace)
+
+            WorkspaceSession = backend.workspace_session()
+            with WorkspaceSession() as db:
+                recipe = load_recipe(db, TABLE_NAME)
+
+            report = RunReport(trace_memory=namespace.trace_memory)
+            with report.build(TABLE_NAME, "d3_present") as record:
+                build_table(BuildJob(TABLE_NAME), recipe, backend)
+
+        print(
+            f"\n{namespace.source} source, {namespace.geoids:,} geoids, "
+            f"{namespace.variables} variables ({namespace.shape})\n"
+        )
+        print_stages(record.stages)
+        print(f"{'total':<32} {record.seconds * 1000:10.1f} ms")
+
+        if namespace.json:
+            report.write_json(namespace.json)
+    finally:
+        if namespace.keep:
+            print(f"\nLocal backend kept in {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Import-time budget for the pipeline command line.
+
+Runs `python -X importtime pipeline.py <args>` for the invocations that
+should never need a database (--version, --help and an argument error)
+and fails if any of them imports one of the heavy dependencies, or if
+total import time goes over the budget.
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --budget-ms 200 --repeat 10
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+PIPELINE = Path(__file__).resolve().parent.parent / "pipeline.py"
+
+INVOCATIONS = (
+    ["--version"],
+    ["--help"],
+    ["--no-such-flag"],
+)
+
+FORBIDDEN = (
+    "pandas",
+    "numpy",
+    "pyarrow",
+    "sqlalchemy",
+    "sshtunnel",
+    "paramiko",
+    "psycopg2",
+    "shapely",
+    "scipy",
+)
+
+DEFAULT_BUDGET_MS = 100
+
+
+def measure(args: list[str]) -> tuple[float, set[str]]:
+    """
+    Total import time in milliseconds and the set of top-level packages
+    imported for a single invocation.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", str(PIPELINE), *args],
+        capture_output=True,
+        text=True,
+        cwd=PIPELINE.parent,
+    )
+
+    total_us = 0
+    packages = set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+
+        # Only count the outermost imports, nested ones are in their cumulative time
+        if not name.startswith("  "):
+            total_us += int(cumulative)
+
+    return total_us / 1000, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=5)
+    namespace = parser.parse_args()
+
+    failed = False
+    for args in INVOCATIONS:
+        timings, packages = [], set()
+        for _ in range(namespace.repeat):
+            milliseconds, imported = measure(args)
+            timings.append(milliseconds)
+            packages |= imported
+
+        median = statistics.median(timings)
+        heavy = sorted(packages.intersection(FORBIDDEN))
+        ok = (median <= namespace.budget_ms) and not heavy
+        failed |= not ok
+
+        print(
+            f"{' '.join(args):<16} {median:8.1f} ms (budget {namespace.budget_ms:.0f} ms)"
+            f"{'  imports ' + ', '.join(heavy) if heavy else ''}"
+            f"  {'ok' if ok else 'FAILED'}"
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Micro-benchmarks for suppression and delivery on synthetic tables.
+
+Each case is timed (best of --repeat runs) and then run once more under
+tracemalloc for its peak memory. Results can be saved as a baseline and
+later runs compared against it; comparing fails if a case got slower or
+hungrier than the tolerance allows. Baseline timings are first scaled by a
+fixed calibration workload, which takes out most of the difference
+between a busy and an idle machine.
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --sizes small --save benchmarks/baseline.json
+    python benchmarks/micro.py --compare benchmarks/baseline.json
+
+Timings only compare meaningfully on the machine the baseline was saved on.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+from synthetic import SHAPES, make_table, make_variables
+
+from lib.d3models import read_table_variables_to_dataframe
+from lib.delivery import add_moe_columns
+from lib.empty import build_empty_table
+from lib.suppression import apply_suppression, find_pivot_column, suppression_sweep
+
+
+SIZES = {
+    # geoids, variables
+    "small": (200, 15),
+    "medium": (1000, 40),
+    "large": (4000, 100),
+}
+
+THRESHOLD = 6
+SWEEP_THRESHOLDS = [6, 11, 20]
+
+DEFAULT_TOLERANCE = 0.5
+
+# Differences smaller than these are noise, whatever the ratio
+TIME_SLACK_SECONDS = 0.005
+MEMORY_SLACK_BYTES = 256 * 1024
+
+
+@dataclass
+class Result:
+    case: str
+    seconds: float
+    peak_bytes: int
+
+
+def cases(size: str, shape: str, small_fraction: float) -> dict[str, Callable[[], object]]:
+    geoid_count, variable_count = SIZES[size]
+    variables = make_variables(variable_count, shape)
+    table = make_table(variables, geoid_count, small_fraction, THRESHOLD)
+    column_metadata = read_table_variables_to_dataframe(variables)
+    rows = [row for _, row in table.iterrows()]
+
+    suffix = f"{size}/{shape}"
+    return {
+        f"apply_suppression/{suffix}": lambda: apply_suppression(
+            table, column_metadata, threshold=THRESHOLD
+        ),
+        f"suppression_sweep/{suffix}": lambda: suppression_sweep(
+            table, column_metadata, SWEEP_THRESHOLDS
+        ),
+        f"find_pivot_column/{suffix}": lambda: [
+            find_pivot_column(row, threshold=THRESHOLD) for row in rows
+        ],
+        f"add_moe_columns/{suffix}": lambda: add_moe_columns(table),
+        f"build_empty_table/{suffix}": lambda: build_empty_table(variables),
+    }
+
+
+def calibrate(repeat: int = 10) -> float:
+    """
+    Seconds for a fixed mix of interpreter and pandas work, roughly what
+    the benchmarked functions spend their time on.
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame({"a": range(20000), "b": range(20000)})
+
+    timings = []
+    # One extra, untimed round to warm up pandas' caches
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        for _, row in frame.head(500).iterrows():
+            row[row < 100].sum()
+        frame.sort_values("b", ascending=False).sum()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings[1:])
+
+
+def measure(case: str, function: Callable[[], object], repeat: int) -> Result:
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return Result(case, min(timings), peak)
+
+
+def compare(results: list[Result], baseline: dict, tolerance: float, calibration: float) -> bool:
+    """
+    Print each case against the baseline and return whether any regressed.
+    Cases missing from the baseline are reported but never fail.
+    """
+    scale = calibration / baseline["calibration_seconds"]
+    print(f"Machine is running {scale:.2f}x the baseline's calibration time.")
+
+    regressed = False
+    for result in results:
+        before = baseline["results"].get(result.case)
+        if before is None:
+            print(f"{result.case:<40} not in baseline")
+            continue
+
+        before = {**before, "seconds": before["seconds"] * scale}
+
+        slower = result.seconds > before["seconds"] * (1 + tolerance) + TIME_SLACK_SECONDS
+        hungrier = result.peak_bytes > before["peak_bytes"] * (1 + tolerance) + MEMORY_SLACK_BYTES
+        regressed |= slower or hungrier
+
+        print(
+            f"{result.case:<40} "
+            f"{result.seconds / before['seconds']:6.2f}x time  "
+            f"{result.peak_bytes / max(before['peak_bytes'], 1):6.2f}x memory"
+            f"{'  REGRESSED' if slower or hungrier else ''}"
+        )
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["small", "medium"])
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--small_fraction", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="PATH", help="Write the results as a baseline.")
+    parser.add_argument("--compare", metavar="PATH", help="Fail on regressions against a baseline.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    namespace = parser.parse_args()
+
+    calibration = calibrate()
+
+    results = []
+    for size in namespace.sizes:
+        for shape in namespace.shapes:
+            for case, function in cases(size, shape, namespace.small_fraction).items():
+                result = measure(case, function, namespace.repeat)
+                results.append(result)
+
+                if not namespace.compare:
+                    print(
+                        f"{result.case:<40} {result.seconds * 1000:10.1f} ms"
+                        f" {result.peak_bytes / 2**20:8.1f} MiB"
+                    )
+
+    if namespace.save:
+        with open(namespace.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "small_fraction": namespace.small_fraction,
+                    "calibration_seconds": calibration,
+                    "results": {result.case: asdict(result) for result in results},
+                },
+                f,
+                indent=2,
+            )
+        print(f"Baseline written to {namespace.save}")
+
+    if namespace.compare:
+        with open(namespace.compare) as f:
+            baseline = json.load(f)
+
+        sys.exit(1 if compare(results, baseline, namespace.tolerance, calibration) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Synthetic census-style tables for the benchmarks.
+
+A table is a set of variables arranged in an indentation tree (a total at
+indentation 0, its breakdowns under it, and so on) plus one row of counts
+per geoid. Leaf counts are drawn at random, with `small_fraction` of them
+below the suppression threshold, and every parent is the sum of its
+children, as it would be in a real table.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lib.recipes import VariableRecipe  # noqa: E402
+
+
+SHAPES = ("flat", "balanced", "deep")
+
+
+def _parents(variable_count: int, shape: str) -> list[int]:
+    """
+    Position of each variable's parent, -1 for the total.
+
+    flat:      a total and every other variable directly under it
+    balanced:  every variable has up to four children
+    deep:      a total and a chain of breakdowns, each with one sibling
+    """
+    if shape == "flat":
+        return [-1] + [0] * (variable_count - 1)
+
+    if shape == "balanced":
+        return [-1] + [(position - 1) // 4 for position in range(1, variable_count)]
+
+    if shape == "deep":
+        return [-1] + [max(position - 2 + position % 2, 0) for position in range(1, variable_count)]
+
+    raise ValueError(f"Unknown tree shape '{shape}', expected one of {', '.join(SHAPES)}.")
+
+
+def make_variables(
+    variable_count: int, shape: str = "balanced", table_name: str = "b99999"
+) -> list[VariableRecipe]:
+    parents = _parents(variable_count, shape)
+    names = [f"{table_name}{position + 1:03d}" for position in range(variable_count)]
+
+    indentation = []
+    for parent in parents:
+        indentation.append(0 if parent == -1 else indentation[parent] + 1)
+
+    return [
+        VariableRecipe(
+            id=position,
+            variable_name=names[position],
+            table_name=table_name,
+            indentation=indentation[position],
+            parent_column=None if parent == -1 else names[parent],
+            sql_aggregation_phrase="count(*)",
+        )
+        for position, parent in enumerate(parents)
+    ]
+
+
+def make_table(
+    variables: list[VariableRecipe],
+    geoid_count: int,
+    small_fraction: float = 0.2,
+    threshold: int = 6,
+    seed: int = 0,
+) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    names = [variable.variable_name for variable in variables]
+    positions = {name: position for position, name in enumerate(names)}
+
+    values = np.zeros((geoid_count, len(variables)), dtype="int64")
+    has_children = {variable.parent_column for variable in variables}
+
+    leaves = [position for position, name in enumerate(names) if name not in has_children]
+    small = rng.random((geoid_count, len(leaves))) < small_fraction
+    values[:, leaves] = np.where(
+        small,
+        rng.integers(0, threshold, (geoid_count, len(leaves))),
+        rng.integers(threshold, 2000, (geoid_count, len(leaves))),
+    )
+
+    # Children always come after their parent, so summing in reverse fills
+    # every parent before its own parent reads it
+    for position in reversed(range(len(variables))):
+        parent = variables[position].parent_column
+        if parent is not None:
+            values[:, positions[parent]] += values[:, position]
+
+    table = pd.DataFrame(values, columns=names)
+    table.insert(0, "geoid", [f"14000US26163{geoid:06d}" for geoid in range(geoid_count)])
+
+    return table
@@ -1,24 +1,37 @@
 import secrets
 
-from sqlalchemy import inspect
-from flask import Flask
-from flask_admin import Admin
+from sqlalchemy import inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import scoped_session, selectinload
+from flask import Flask, flash, redirect, request
+from flask_admin import Admin, expose
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.model.template import EndpointLinkRowAction
 import tomli
 
-from lib.d3models import D3EditionMetadata, D3TableMetadata, D3VariableMetadata, D3VariableGroup
-from lib.connection import build_connections
+from lib.d3models import (
+    D3EditionMetadata,
+    D3TableMetadata,
+    D3VariableMetadata,
+    D3VariableGroup,
+    InvalidEditionError,
+    InvalidTableError,
+    ensure_search_indexes,
+)
+from lib.connection import build_connections, get_connection_manager
+from lib.preview import DEFAULT_PREVIEW_DIRECTORY, PreviewCache, run_preview, sample_geoids
+from lib.recipes import load_recipe
 
 
 with open("pipeline_config.toml", "rb") as f:
     config = tomli.load(f)
 
 
-_, workspace_session_maker, _ = build_connections(config)
+_, WorkspaceSession, _ = build_connections(config)
 
-WorkspaceSession = workspace_session_maker()
-
-db = WorkspaceSession()
+# One session per request (thread), handed back to the pool on teardown so
+# concurrent editors don't share an identity map or a transaction.
+db = scoped_session(WorkspaceSession)
 
 app = Flask(__name__)
 
@@ -31,27 +44,152 @@ secret_key = secrets.token_hex(16)
 app.config['SECRET_KEY'] = secret_key
 
 
-def make_view(table_metadata_class):
+@app.teardown_appcontext
+def remove_session(exception=None):
+    db.remove()
+
+
+preview_config = config.get("preview", {})
+preview_cache = PreviewCache(preview_config.get("directory", DEFAULT_PREVIEW_DIRECTORY))
+_sample_geoids = {}
+
+
+def preview_geoids(raw_table_db: str) -> list[str]:
+    """
+    The configured sample geoids, or a stable sample drawn once per source
+    database.
+    """
+    if preview_config.get("sample_geoids"):
+        return preview_config["sample_geoids"]
+
+    if raw_table_db not in _sample_geoids:
+        _sample_geoids[raw_table_db] = sample_geoids(
+            get_connection_manager(config).source_engine(raw_table_db),
+            preview_config.get("sample_size", 25),
+        )
+
+    return _sample_geoids[raw_table_db]
+
+
+PAGE_SIZE = 50
+
+# Relationship fields are filled by searching instead of rendering every
+# row of the related table into a <select>.
+TABLE_REF = {"fields": ["table_name", "description"], "page_size": 10}
+VARIABLE_REF = {"fields": ["variable_name", "description"], "page_size": 10}
+
+
+def make_view(table_metadata_class, searchable=(), ajax_refs=None):
     class VerboseView(ModelView):
         column_hide_backrefs = False
         column_list = [c_attr.key for c_attr in inspect(table_metadata_class).mapper.column_attrs]
+        column_searchable_list = list(searchable)
+        column_filters = ["table_name"]
+        form_ajax_refs = ajax_refs or {}
+        page_size = PAGE_SIZE
+        can_set_page_size = True
 
     return VerboseView
 
 
 class TableView(ModelView):
-    inline_models = (D3VariableMetadata, D3EditionMetadata, D3VariableGroup)
+    inline_models = (
+        (D3VariableMetadata, {"form_excluded_columns": ["child_variable_groups"]}),
+        D3EditionMetadata,
+        (
+            D3VariableGroup,
+            {"form_ajax_refs": {"parent_variable": VARIABLE_REF, "variables": VARIABLE_REF}},
+        ),
+    )
     column_hide_backrefs = False
     column_list = [c_attr.key for c_attr in inspect(D3TableMetadata).mapper.column_attrs]
+    column_searchable_list = ["table_name", "description"]
+    column_filters = ["category", "source", "tool"]
+    column_extra_row_actions = [
+        EndpointLinkRowAction("glyphicon glyphicon-eye-open", ".preview_view", title="Preview"),
+    ]
+    page_size = PAGE_SIZE
+    can_set_page_size = True
+
+    @expose("/preview/")
+    def preview_view(self):
+        """
+        Run the saved recipe on the sample geographies and show the result
+        with suppression applied.
+        """
+        try:
+            table = self.get_one(request.args.get("id", ""))
+        except ValueError:
+            table = None
+        if table is None:
+            flash("Unable to preview, that table no longer exists.", "error")
+            return redirect(self.get_url(".index_view"))
+
+        try:
+            recipe = load_recipe(self.session, table.table_name)
+            if request.args.get("edition"):
+                edition = recipe.edition(request.args["edition"])
+            else:
+                edition = recipe.latest_edition()
+
+            preview = run_preview(
+                recipe,
+                edition,
+                get_connection_manager(config).source_engine(edition.raw_table_db),
+                preview_geoids(edition.raw_table_db),
+                cache=preview_cache,
+                statement_timeout_seconds=preview_config.get("statement_timeout_seconds", 30),
+            )
+        except (InvalidEditionError, InvalidTableError, SQLAlchemyError) as e:
+            flash(f"Unable to preview {table.table_name}--{e}", "error")
+            return redirect(self.get_url(".index_view"))
+
+        return self.render("preview.html", recipe=recipe, edition=edition, preview=preview)
+
+    def get_one(self, id):
+        """
+        Load the table with everything the inline forms render in one
+        query per relationship, rather than one per variable or group.
+        """
+        stmt = (
+            select(D3TableMetadata)
+            .where(D3TableMetadata.id == int(id))
+            .options(
+                selectinload(D3TableMetadata.variables),
+                selectinload(D3TableMetadata.all_editions),
+                selectinload(D3TableMetadata.variable_groups).options(
+                    selectinload(D3VariableGroup.parent_variable),
+                    selectinload(D3VariableGroup.variables),
+                ),
+            )
+        )
+
+        return self.session.scalar(stmt)
 
 
 # TableView = make_view(D3TableMetadata)
-VariableView = make_view(D3VariableMetadata)
-EditionView = make_view(D3EditionMetadata)
+VariableView = make_view(
+    D3VariableMetadata,
+    searchable=["variable_name", "description"],
+    ajax_refs={"table": TABLE_REF},
+)
+EditionView = make_view(
+    D3EditionMetadata,
+    searchable=["table_name", "edition"],
+    ajax_refs={"table": TABLE_REF},
+)
 
 admin = Admin(app, name='D3 Data Pipeline', template_mode='bootstrap3')
 admin.add_view(TableView(D3TableMetadata, db))
 admin.add_view(VariableView(D3VariableMetadata, db))
 admin.add_view(EditionView(D3EditionMetadata, db))
 
-app.run()
+
+if __name__ == "__main__":
+    try:
+        with WorkspaceSession() as session:
+            ensure_search_indexes(session)
+    except SQLAlchemyError as e:
+        print(f"WARNING: Unable to create search indexes--{e}")
+
+    app.run()
@@ -1,8 +1,15 @@
 from textwrap import indent
-from sqlalchemy import text, Engine
+from typing import Optional
+from sqlalchemy import ARRAY, Text, bindparam, text, Engine
 import pandas as pd
 
 from .d3models import D3VariableMetadata
+from .instrumentation import observe, stage
+
+
+BACKENDS = ("sql", "strtree", "geoid")
+
+SPATIAL_BLOCK_JOIN = "shp.blockgeom2geoids20 bb on st_intersects(aa.geom, bb.geom)"
 
 
 def build_outer_select(variables: list[D3VariableMetadata]) -> str:
@@ -38,7 +45,37 @@ def build_inner_select(
     ), "\t")
 
 
-def build_query(outer_select, inner_select, source_table_name) -> text:
+def build_geoid_select(variables: list[D3VariableMetadata]) -> str:
+    """
+    The select for build_geoid_query, each phrase COALESCEd to 0 like the
+    outer select of build_query.
+    """
+    return indent(",\n".join(
+        [
+            f"COALESCE({variable.sql_aggregation_phrase}, 0) AS {variable.variable_name}"
+            for variable in variables
+        ]
+    ), "\t")
+
+
+def build_query(
+    outer_select,
+    inner_select,
+    source_table_name,
+    sample_geoids: Optional[list[str]] = None,
+    lateral: str = "",
+    block_join: str = SPATIAL_BLOCK_JOIN,
+) -> text:
+    """
+    With sample_geoids, only the blocks belonging to those geographies are
+    joined against the source and only those geoids are returned, which is
+    what the admin preview runs. `lateral` is joined to the source rows
+    before the blocks (see lib.compiler). `block_join` is how the source
+    (aa) meets the blocks (bb), e.g. through a lib.blockcache assignment.
+    """
+    block_filter = "WHERE bb.geoids::text[] && :sample_geoids" if sample_geoids else ""
+    geoid_filter = "WHERE all_geoms.geoid = ANY(:sample_geoids)" if sample_geoids else ""
+
     result = text(f"""
     SELECT 
         {outer_select}
@@ -47,33 +84,175 @@ def build_query(outer_select, inner_select, source_table_name) -> text:
             SELECT unnest(geoids) geoid,
                 {inner_select}
             FROM
-                {source_table_name} aa
+                {source_table_name} aa {lateral}
                     INNER JOIN
-                shp.blockgeom2geoids20 bb on st_intersects(aa.geom, bb.geom)
+                {block_join}
+            {block_filter}
             GROUP BY geoid
         ) match_geoms
             RIGHT JOIN (
                 SELECT unnest(geoids) geoid FROM shp.blockgeom2geoids20 
                 GROUP BY geoid
             ) all_geoms on all_geoms.geoid = match_geoms.geoid
+    {geoid_filter}
     """)
 
+    if sample_geoids:
+        result = result.bindparams(
+            bindparam("sample_geoids", value=list(sample_geoids), type_=ARRAY(Text()))
+        )
+
     return result
 
 
+def build_geoid_query(geoid_select, source_table_name, lateral: str = "") -> text:
+    """
+    For sources that are already keyed by geoid (one or more rows per
+    geography), so no spatial join is needed. Plain SQL, so it runs on any
+    backend.
+
+    There's no list of every geoid to zero-fill from, so geoids missing
+    from the source are missing from the result too. The variables are
+    COALESCEd to 0 (see build_geoid_select) like build_query's.
+    """
+    return text(f"""
+    SELECT
+        aa.geoid,
+        {geoid_select}
+    FROM
+        {source_table_name} aa {lateral}
+    GROUP BY aa.geoid
+    ORDER BY aa.geoid
+    """)
+
+
+class AggregationMismatchError(Exception):
+    pass
+
+
+def _build_data_query(
+    variables, source_table_name, backend, compiled=None, block_join: str = SPATIAL_BLOCK_JOIN
+) -> text:
+    if compiled is None:
+        outer_select = build_outer_select(variables)
+        inner_select = build_inner_select(variables)
+
+        if backend == "geoid":
+            return build_geoid_query(build_geoid_select(variables), source_table_name)
+        return build_query(outer_select, inner_select, source_table_name, block_join=block_join)
+
+    if backend == "geoid":
+        return build_geoid_query(compiled.geoid_select(), source_table_name, lateral=compiled.lateral)
+    return build_query(
+        compiled.outer_select(),
+        compiled.inner_select(),
+        source_table_name,
+        lateral=compiled.lateral,
+        block_join=block_join,
+    )
+
+
+def mismatched_variables(verbatim: pd.DataFrame, compiled: pd.DataFrame) -> list[str]:
+    """
+    The variables whose values differ between the verbatim and the compiled
+    query, counting NULL and 0 as the same (see lib.compiler).
+    """
+    import numpy as np
+
+    verbatim = verbatim.sort_values("geoid", ignore_index=True)
+    compiled = compiled.sort_values("geoid", ignore_index=True)
+
+    if list(verbatim["geoid"]) != list(compiled["geoid"]):
+        return [column for column in verbatim.columns if column != "geoid"]
+
+    return [
+        column
+        for column in verbatim.columns
+        if column != "geoid"
+        and not np.allclose(
+            verbatim[column].astype("float64").fillna(0).to_numpy(),
+            compiled[column].astype("float64").fillna(0).to_numpy(),
+            rtol=1e-9,
+            atol=0,
+        )
+    ]
+
+
 def run_aggregation(
-    source_table_name, variables: list[D3VariableMetadata], engine: Engine
+    source_table_name,
+    variables: list[D3VariableMetadata],
+    engine: Optional[Engine],
+    backend: str = "sql",
+    blocks=None,
+    compile: bool = False,
+    verify: bool = False,
+    block_assignment: Optional[dict] = None,
+    block_subdivision: Optional[dict] = None,
 ) -> pd.DataFrame:
+    """
+    The "sql" backend runs the whole aggregation on the source database.
+    "strtree" does the spatial join and the aggregation in this process
+    (see lib.spatial), which also works for file exports of the source;
+    `blocks` is the BlockIndex to use, loaded from `engine` if not given.
+    "geoid" is for sources that are pre-aggregated by geoid.
+
+    With `compile`, the database backends run the query from
+    lib.compiler instead of the verbatim phrases; `verify` runs both and
+    raises AggregationMismatchError if they disagree.
+
+    `block_assignment` is the [block_assignment] config. With it, the "sql"
+    backend joins the source to the blocks through the source's cached
+    block assignment (see lib.blockcache) instead of st_intersects.
+    Otherwise, with `block_subdivision` (the [block_subdivision] config),
+    it's matched against the subdivided blocks while they're fresh.
+    """
+    if backend == "strtree":
+        from .spatial import load_blocks, run_spatial_aggregation
+
+        return run_spatial_aggregation(
+            source_table_name, variables, blocks or load_blocks(engine), engine
+        )
+    elif backend not in BACKENDS:
+        raise ValueError(f"Unknown aggregation backend '{backend}', expected one of {', '.join(BACKENDS)}.")
+
+    compiled = None
+    if compile:
+        from .compiler import compile_aggregation
+
+        compiled = compile_aggregation(variables, lateral=engine.dialect.name == "postgresql")
 
-    outer_select = build_outer_select(variables)
-    inner_select = build_inner_select(variables)    
+    block_join = None
+    if backend == "sql" and engine.dialect.name == "postgresql":
+        from .blockcache import assigned_block_join, subdivision_block_join
 
-    data_query = build_query(outer_select, inner_select, source_table_name) 
+        if block_assignment is not None:
+            block_join = assigned_block_join(engine, source_table_name, block_assignment)
+        if block_join is None and block_subdivision is not None:
+            block_join = subdivision_block_join(engine, block_subdivision)
+    block_join = block_join or SPATIAL_BLOCK_JOIN
 
-    with engine.connect() as connection:
+    data_query = _build_data_query(variables, source_table_name, backend, compiled, block_join)
+
+    with stage("query"), engine.connect() as connection:
         aggregated = pd.read_sql(
             data_query, 
-            connection
+            connection,
+            dtype_backend="pyarrow",
         )
+        observe(aggregated)
+
+    if compiled is not None and verify:
+        with stage("verify_query"), engine.connect() as connection:
+            verbatim = pd.read_sql(
+                _build_data_query(variables, source_table_name, backend, block_join=block_join),
+                connection,
+                dtype_backend="pyarrow",
+            )
+            observe(verbatim)
+
+        if mismatched := mismatched_variables(verbatim, aggregated):
+            raise AggregationMismatchError(
+                f"The compiled query disagrees with the recipe's phrases for {', '.join(mismatched)}."
+            )
 
     return aggregated
@@ -0,0 +1,343 @@
+"""
+Build many tables in one process.
+
+A backfill builds every edition of some tables in one run, into
+d3_<edition>, then refreshes d3_present and d3_past from the editions
+marked PRESENT and PAST.
+
+Jobs come from a manifest or from every PRESENT edition in
+d3_edition_metadata. Jobs reading the same raw table are grouped and run
+back to back on one worker, so the source database can answer the later
+ones from its cache, while different raw tables are spread across the
+worker pool. Every job runs in isolation: a failure is recorded and the
+batch carries on.
+"""
+import re
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import tomli
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .build import BuildError, BuildJob, build_hollow, build_table, resolve_edition
+from .checkpoint import Checkpoint, NoCheckpoint
+from .instrumentation import RunReport
+from .connection import Backend
+from .d3models import D3EditionMetadata
+from .metadata import sync_metadata
+from .recipes import EditionRecipe, TableRecipe
+from .sources import raw_table_key
+
+
+@dataclass
+class BuildResult:
+    job: BuildJob
+    ok: bool
+    seconds: float
+    error: Optional[str] = None
+    run_id: Optional[str] = None
+
+
+def read_manifest(path: str) -> list[BuildJob]:
+    """
+    A manifest is a toml file with either a plain list of tables
+
+        tables = ["b01982", "b01983"]
+
+    or one [[build]] entry per table with the same options as the command line
+
+        [[build]]
+        table_name = "b01982"
+        edition = "2020"
+        destination_schema = "d3_2020"
+    """
+    with open(path, "rb") as f:
+        manifest = tomli.load(f)
+
+    jobs = [BuildJob(table_name=table_name) for table_name in manifest.get("tables", [])]
+    jobs += [BuildJob(**build) for build in manifest.get("build", [])]
+
+    return jobs
+
+
+def present_jobs(db: Session) -> list[BuildJob]:
+    """
+    One job for every edition marked PRESENT in d3_edition_metadata.
+    """
+    stmt = (
+        select(D3EditionMetadata.table_name, D3EditionMetadata.edition)
+        .where(D3EditionMetadata.time_frame == "PRESENT")
+        .order_by(D3EditionMetadata.table_name)
+    )
+
+    return [
+        BuildJob(table_name=table_name, edition=edition, destination_schema="d3_present")
+        for table_name, edition in db.execute(stmt)
+    ]
+
+
+TIME_FRAME_SCHEMAS = {"PRESENT": "d3_present", "PAST": "d3_past"}
+
+
+def edition_schema(edition: str) -> str:
+    return f"d3_{edition}"
+
+
+def _edition_year(edition: EditionRecipe) -> Optional[int]:
+    match = re.match(r"\d{4}", edition.edition or "")
+    return int(match.group()) if match else None
+
+
+def backfill_jobs(
+    recipes: Iterable[TableRecipe], years: Optional[tuple[int, int]] = None
+) -> list[BuildJob]:
+    """
+    One job per edition of each recipe, delivered to d3_<edition>. With
+    `years` (inclusive) only editions starting with a year in the range.
+    """
+    jobs = []
+    for recipe in recipes:
+        for edition in sorted(recipe.editions, key=lambda edition: edition.edition):
+            year = _edition_year(edition)
+            if years is not None and (year is None or not years[0] <= year <= years[1]):
+                continue
+
+            jobs.append(
+                BuildJob(
+                    table_name=recipe.table_name,
+                    edition=edition.edition,
+                    destination_schema=edition_schema(edition.edition),
+                )
+            )
+
+    return jobs
+
+
+def promote_time_frames(
+    results: list[BuildResult],
+    recipes: dict[str, TableRecipe],
+    connections: Backend,
+) -> list[BuildResult]:
+    """
+    Copy each table's latest PRESENT and latest PAST edition from its
+    d3_<edition> schema into d3_present or d3_past, then sync the metadata
+    there. d3_past holds a single edition per table, so older PAST editions
+    are left in their own schemas. Returns a result per copy.
+    """
+    from .delivery import copy_tables
+
+    built = {(result.job.table_name, result.job.edition) for result in results if result.ok}
+
+    promoted = []
+    for recipe in recipes.values():
+        # The latest edition per time frame wins, by year and then by name
+        latest = {}
+        for edition in sorted(recipe.editions, key=lambda edition: (_edition_year(edition) or 0, edition.edition)):
+            if (schema := TIME_FRAME_SCHEMAS.get(edition.time_frame)) is not None:
+                latest[schema] = edition
+
+        for schema, edition in latest.items():
+            if (recipe.table_name, edition.edition) not in built:
+                print(
+                    f"Not copying {recipe.table_name} into {schema}, "
+                    f"its latest {edition.time_frame} edition {edition.edition} wasn't built."
+                )
+                continue
+
+            job = BuildJob(recipe.table_name, edition.edition, schema)
+            start = time.perf_counter()
+            print(f"Copying {recipe.table_name} for {edition.edition} into {schema}.")
+            try:
+                copy_tables(
+                    connections.destination_engine(edition_schema(edition.edition)),
+                    connections.destination_engine(schema),
+                    edition_schema(edition.edition),
+                    schema,
+                    [recipe.table_name, recipe.table_name + "_moe"],
+                )
+                promoted.append(BuildResult(job, True, time.perf_counter() - start))
+            except Exception:
+                promoted.append(
+                    BuildResult(job, False, time.perf_counter() - start, traceback.format_exc(limit=3))
+                )
+
+    _sync_batch_metadata(promoted, recipes, connections)
+
+    return promoted
+
+
+def schedule(
+    jobs: list[BuildJob], recipes: dict[str, TableRecipe]
+) -> list[list[BuildJob]]:
+    """
+    Group the jobs by the raw table they read from, biggest groups first.
+    Jobs that don't touch the source (or whose recipe can't be resolved
+    yet) get a group of their own.
+    """
+    groups = defaultdict(list)
+    for i, job in enumerate(jobs):
+        try:
+            edition = resolve_edition(recipes[job.table_name], job)
+        except (KeyError, BuildError):
+            edition = None
+
+        if (edition is None) or job.hollow or job.no_update:
+            groups[("job", i)].append(job)
+        else:
+            groups[raw_table_key(edition)].append(job)
+
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def run_job(
+    job,
+    recipes,
+    connections,
+    source_slot=None,
+    destination_slot=None,
+    checkpoints=None,
+    report=None,
+    update_cr_metadata=False,
+) -> BuildResult:
+    """
+    Build one job, turning any failure into an unsuccessful BuildResult.
+    """
+    start = time.perf_counter()
+    checkpoint = NoCheckpoint()
+    try:
+        if job.table_name not in recipes:
+            raise BuildError(f"'{job.table_name}' is not in d3_table_metadata.")
+
+        if checkpoints:
+            checkpoint = Checkpoint.create(checkpoints, job)
+
+        recording = (
+            report.build(job.table_name, job.destination_schema)
+            if report
+            else nullcontext()
+        )
+        with recording:
+            build_table(
+                job,
+                recipes[job.table_name],
+                connections,
+                source_slot=source_slot,
+                destination_slot=destination_slot,
+                update_cr_metadata=update_cr_metadata,
+                checkpoint=checkpoint,
+            )
+        return BuildResult(job, True, time.perf_counter() - start)
+
+    except Exception as e:
+        # Nothing to resume from if it failed before the first stage was saved
+        if not checkpoint.started:
+            checkpoint.cleanup()
+        return BuildResult(
+            job,
+            False,
+            time.perf_counter() - start,
+            str(e) if isinstance(e, BuildError) else traceback.format_exc(limit=3),
+            checkpoint.run_id if checkpoint.started else None,
+        )
+
+
+def _sync_batch_metadata(results, recipes, connections):
+    """
+    Census Reporter metadata lives alongside the tables, so sync it once
+    per destination schema for everything that built.
+    """
+    by_schema = defaultdict(dict)
+    for result in results:
+        if result.ok:
+            by_schema[result.job.destination_schema][result.job.table_name] = recipes[
+                result.job.table_name
+            ]
+
+    for schema, schema_recipes in by_schema.items():
+        print(f"Updating metadata for {len(schema_recipes)} tables in {schema}.")
+        DestinationSession = connections.destination_session(schema)
+        try:
+            with DestinationSession() as db:
+                sync_metadata(db, schema_recipes.values())
+        except Exception as e:
+            print(f"ERROR: Unable to update metadata for {schema}--{e}")
+
+
+def run_batch(
+    jobs: list[BuildJob],
+    recipes: dict[str, TableRecipe],
+    connections: Backend,
+    workers: int = 4,
+    source_concurrency: int = 2,
+    destination_concurrency: int = 2,
+    checkpoints: Optional[str] = None,
+    report: Optional[RunReport] = None,
+) -> list[BuildResult]:
+    source_slot = threading.BoundedSemaphore(source_concurrency)
+    destination_slot = threading.BoundedSemaphore(destination_concurrency)
+
+    results = []
+
+    # Hollow tables are only DDL, so they're created together per schema
+    hollow = [job for job in jobs if job.hollow and job.table_name in recipes]
+    if hollow:
+        start = time.perf_counter()
+        try:
+            with destination_slot:
+                build_hollow(hollow, recipes, connections)
+            results.extend(
+                BuildResult(job, True, time.perf_counter() - start) for job in hollow
+            )
+        except Exception:
+            error = traceback.format_exc(limit=3)
+            results.extend(
+                BuildResult(job, False, time.perf_counter() - start, error)
+                for job in hollow
+            )
+        jobs = [job for job in jobs if job not in hollow]
+
+    def run_group(group):
+        return [
+            run_job(
+                job,
+                recipes,
+                connections,
+                source_slot,
+                destination_slot,
+                checkpoints,
+                report,
+            )
+            for job in group
+        ]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for group_results in pool.map(run_group, schedule(jobs, recipes)):
+            results.extend(group_results)
+
+    _sync_batch_metadata(results, recipes, connections)
+
+    return results
+
+
+def print_summary(results: list[BuildResult]):
+    failed = [result for result in results if not result.ok]
+
+    print(f"\nBuilt {len(results) - len(failed)} of {len(results)} tables.")
+    for result in sorted(results, key=lambda result: result.job.table_name):
+        status = "ok" if result.ok else "FAILED"
+        print(
+            f"  {result.job.table_name:<10} {result.job.destination_schema:<12} "
+            f"{status:<7} {result.seconds:8.1f}s"
+        )
+
+    for result in failed:
+        print(f"\n{result.job.table_name} failed:\n{result.error}")
+        if result.run_id:
+            print(f"Restart it with --resume {result.run_id}")
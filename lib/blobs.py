@@ -0,0 +1,237 @@
+"""
+Pre-rendered Census Reporter style JSON per geography and table, so the
+API can answer with a single primary key lookup instead of assembling it
+from the wide tables on every request.
+
+Each document holds a table's suppressed estimates, its (_moe) errors
+and the column titles from census_column_metadata:
+
+    {"table_id": "B01001", "title": "Sex by Age", "universe": "...",
+     "columns": {"B01001001": {"name": "Total", "indent": 0}, ...},
+     "estimate": {"B01001001": 1234, ...},
+     "error": {"B01001001": null, ...}}
+
+The documents are rendered column-wise with pyarrow, then bulk loaded
+into <schema>.geography_blobs keyed by (geoid, table_id). Each row stores
+a hash of its document, and only the rows whose hash changed are
+rewritten. A refresh for a subset of geoids leaves the other rows alone.
+"""
+import hashlib
+import io
+import json
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from sqlalchemy import Column, Engine, MetaData, Table, Text, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.sqlite import insert as sqlite_upsert
+
+from .instrumentation import observe
+from .metadata import create_table_metadata_insert, create_variable_metadata_insert
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+
+BLOB_TABLE = "geography_blobs"
+COPY_CHUNK_SIZE = 50_000
+# Rows per statement, under SQLite's limit on bound parameters
+SQLITE_CHUNK_SIZE = 5_000
+
+
+def blob_table(metadata: MetaData) -> Table:
+    return Table(
+        BLOB_TABLE,
+        metadata,
+        Column("geoid", Text(), primary_key=True),
+        Column("table_id", Text(), primary_key=True),
+        Column("hash", Text(), nullable=False),
+        # Already rendered, so SQLite keeps the JSON text as it is
+        Column("document", JSONB().with_variant(Text(), "sqlite"), nullable=False),
+    )
+
+
+def _header(recipe) -> str:
+    """
+    The part of every document that's the same for each geoid, without
+    its closing brace.
+    """
+    table = create_table_metadata_insert(recipe)
+    columns = create_variable_metadata_insert(list(recipe.variables))
+
+    header = json.dumps(
+        {
+            "table_id": table.table_id,
+            "title": table.table_title,
+            "universe": table.universe,
+            "columns": {
+                column.column_id: {"name": column.column_title, "indent": column.indent}
+                for column in columns
+            },
+        },
+        separators=(",", ":"),
+    )
+    return header[:-1]
+
+
+def _json_values(column: "pd.Series") -> "pa.Array":
+    """
+    A column's values as JSON literals, null for missing (or non-finite)
+    values.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    from .columnar import to_arrow
+
+    values = to_arrow(column).combine_chunks()
+    if pa.types.is_floating(values.type):
+        values = pc.if_else(pc.is_finite(values), values, pa.scalar(None, values.type))
+
+    return pc.fill_null(pc.cast(values, pa.string()), "null")
+
+
+def _json_object(frame: "pd.DataFrame", keys: dict[str, str]) -> "pa.Array":
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if not keys:
+        return pa.array([""] * len(frame), pa.string())
+
+    members = [
+        pc.binary_join_element_wise(json.dumps(key) + ":", _json_values(frame[column]), "")
+        for column, key in keys.items()
+    ]
+    return pc.binary_join_element_wise(*members, ",")
+
+
+def render_documents(
+    table: "pd.DataFrame", recipe, geoids: Optional[Iterable[str]] = None
+) -> "pa.Table":
+    """
+    One (geoid, table_id, hash, document) row per geoid of `table`, the
+    delivered _moe layout (geoid, then every value and _moe column). With
+    `geoids`, only those rows are rendered.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if geoids is not None:
+        table = table[table["geoid"].isin(set(geoids))]
+
+    variable_names = [variable.variable_name for variable in recipe.variables]
+    estimates = {name: name.upper() for name in variable_names if name in table.columns}
+    errors = {name + "_moe": name.upper() for name in variable_names if name + "_moe" in table.columns}
+
+    documents = pc.binary_join_element_wise(
+        _header(recipe) + ',"estimate":{',
+        _json_object(table, estimates),
+        '},"error":{',
+        _json_object(table, errors),
+        "}}",
+        "",
+    )
+
+    hashes = [hashlib.md5(document.encode()).hexdigest() for document in documents.to_pylist()]
+    rendered = pa.table(
+        {
+            "geoid": pa.array(table["geoid"].astype(str).to_numpy(), pa.string()),
+            "table_id": pa.array([recipe.table_name.upper()] * len(table), pa.string()),
+            "hash": pa.array(hashes, pa.string()),
+            "document": documents,
+        }
+    )
+    observe(rows=rendered.num_rows, columns=rendered.num_columns, bytes=rendered.nbytes)
+
+    return rendered
+
+
+def push_blobs(
+    documents: "pa.Table", table_id: str, engine: Engine, schema: str, full: bool = True
+) -> tuple[int, int]:
+    """
+    Load rendered documents into <schema>.geography_blobs, rewriting only
+    rows whose hash changed. With `full`, rows of this table for geoids
+    that aren't in `documents` are deleted. Returns (written, deleted).
+    """
+    table = blob_table(MetaData(schema=schema))
+    table.metadata.create_all(engine, checkfirst=True)
+
+    if engine.dialect.name != "postgresql":
+        return _push_blobs_sqlite(documents, table_id, engine, table, full)
+
+    import pyarrow.csv as csv
+
+    target = f'"{schema}"."{BLOB_TABLE}"'
+    with engine.begin() as connection:
+        connection.execute(text("""
+            CREATE TEMPORARY TABLE incoming_blobs (geoid text, table_id text, hash text, document jsonb)
+            ON COMMIT DROP
+        """))
+
+        # Streamed to the server in CSV chunks with COPY
+        cursor = connection.connection.driver_connection.cursor()
+        for batch in documents.to_batches(max_chunksize=COPY_CHUNK_SIZE):
+            buffer = io.BytesIO()
+            csv.write_csv(batch, buffer, csv.WriteOptions(include_header=False))
+            buffer.seek(0)
+            cursor.copy_expert("COPY incoming_blobs FROM STDIN WITH (FORMAT csv)", buffer)
+
+        written = connection.execute(text(f"""
+            INSERT INTO {target} AS blobs (geoid, table_id, hash, document)
+            SELECT geoid, table_id, hash, document FROM incoming_blobs
+            ON CONFLICT (geoid, table_id) DO UPDATE
+                SET hash = EXCLUDED.hash, document = EXCLUDED.document
+                WHERE blobs.hash IS DISTINCT FROM EXCLUDED.hash
+        """)).rowcount
+
+        deleted = 0
+        if full:
+            deleted = connection.execute(
+                text(f"""
+                    DELETE FROM {target} AS blobs
+                    WHERE blobs.table_id = :table_id
+                      AND NOT EXISTS (
+                          SELECT 1 FROM incoming_blobs
+                          WHERE incoming_blobs.geoid = blobs.geoid AND incoming_blobs.table_id = blobs.table_id
+                      )
+                """),
+                {"table_id": table_id},
+            ).rowcount
+
+    return written, deleted
+
+
+def _push_blobs_sqlite(documents, table_id, engine, table, full) -> tuple[int, int]:
+    rows = documents.to_pylist()
+
+    with engine.begin() as connection:
+        existing = dict(
+            connection.execute(
+                table.select().with_only_columns(table.c.geoid, table.c.hash).where(table.c.table_id == table_id)
+            ).all()
+        )
+        changed = [row for row in rows if existing.get(row["geoid"]) != row["hash"]]
+
+        for start in range(0, len(changed), SQLITE_CHUNK_SIZE):
+            stmt = sqlite_upsert(table).values(changed[start : start + SQLITE_CHUNK_SIZE])
+            connection.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["geoid", "table_id"],
+                    set_={"hash": stmt.excluded.hash, "document": stmt.excluded.document},
+                )
+            )
+
+        deleted = 0
+        if full:
+            stale = list(set(existing) - {row["geoid"] for row in rows})
+            for start in range(0, len(stale), SQLITE_CHUNK_SIZE):
+                connection.execute(
+                    table.delete().where(
+                        table.c.table_id == table_id,
+                        table.c.geoid.in_(stale[start : start + SQLITE_CHUNK_SIZE]),
+                    )
+                )
+            deleted = len(stale)
+
+    return len(changed), deleted
@@ -0,0 +1,553 @@
+"""
+Side tables on the source database that spare the aggregation query its
+st_intersects against every block in shp.blockgeom2geoids20.
+
+A block assignment stores, for each row of a (point) source table, the
+block(s) it falls in:
+
+    block_cache."<schema>__<table>" (source_id, block_id, geom_hash)
+
+source_id is the source's key column, block_id the block table's key
+column, and geom_hash an md5 of the row's geometry. Rows that fall in no
+block are kept with a NULL block_id so they aren't looked up again. Once
+the assignment is in place, build_query joins the source to the blocks
+through it by key, a plain hash join.
+
+block_cache.assignment_state records a RelationMarker of the source and
+block tables at the last refresh: the relation's oid and relfilenode
+next to its change counter (lib.sources). The counter alone misses a
+table reloaded with DROP/CREATE or TRUNCATE at the same row count, which
+the oid or relfilenode catch. While none of them have moved the
+assignment is fresh, and anything unknown counts as stale. When only the
+source's rows moved, the refresh is incremental: rows that are gone or
+whose geometry changed are dropped, and rows without an assignment are
+assigned. When the blocks moved, the source was recreated, or the key
+columns changed, the assignment is rebuilt.
+
+For polygon and line sources there's a subdivided copy of the blocks,
+
+    block_cache.blockgeom2geoids20_subdivided (block_id, geom)
+
+cut with ST_Subdivide into pieces of at most max_vertices vertices, with
+its own GIST index. Small pieces have tight bounding boxes and cheap
+st_intersects. build_query matches each source feature against the
+pieces, keeps each block once however many of its pieces it hits, and
+joins the blocks back by key. block_cache.subdivision_state records the
+block table's RelationMarker and the vertex limit it was cut with, and
+the copy is only used while both still match. `pipeline.py
+--refresh_block_cache` rebuilds it.
+"""
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+from sqlalchemy import Engine, text
+
+from .instrumentation import stage
+
+
+CACHE_SCHEMA = "block_cache"
+BLOCK_SCHEMA, BLOCK_NAME = "shp", "blockgeom2geoids20"
+
+SUBDIVIDED_NAME = BLOCK_NAME + "_subdivided"
+
+DEFAULT_SOURCE_KEY = "id"
+DEFAULT_BLOCK_KEY = "geoid20"
+DEFAULT_MAX_VERTICES = 256
+
+
+def _quote(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _source_table(source_table_name: str) -> tuple[str, str]:
+    schema, _, name = source_table_name.rpartition(".")
+    return schema or "public", name
+
+
+class RelationMarker(NamedTuple):
+    """
+    oid changes when the table is dropped and recreated, relfilenode when
+    it's rewritten (TRUNCATE, VACUUM FULL, ...) and changes, the
+    statistics collector's n_tup_ins + n_tup_upd + n_tup_del, when rows
+    are written.
+    """
+    oid: int
+    relfilenode: int
+    changes: Optional[int]
+
+    @property
+    def known(self) -> bool:
+        return self.changes is not None
+
+
+def relation_markers(
+    engine: Engine, tables: list[tuple[str, str]]
+) -> dict[tuple[str, str], Optional[RelationMarker]]:
+    """
+    A RelationMarker per (schema, table), None for tables that don't
+    exist.
+    """
+    stmt = text("""
+        SELECT
+            n.nspname, c.relname, c.oid::bigint AS oid, c.relfilenode::bigint AS relfilenode,
+            s.n_tup_ins + s.n_tup_upd + s.n_tup_del AS changes
+        FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        WHERE n.nspname || '.' || c.relname = ANY(:names)
+    """)
+
+    with engine.connect() as connection:
+        found = {
+            (row.nspname, row.relname): RelationMarker(row.oid, row.relfilenode, row.changes)
+            for row in connection.execute(stmt, {"names": [f"{schema}.{name}" for schema, name in tables]})
+        }
+
+    return {table: found.get(table) for table in tables}
+
+
+def _stored_marker(state, prefix: str) -> Optional[RelationMarker]:
+    oid, relfilenode, changes = (
+        getattr(state, f"{prefix}_{column}", None) for column in ("oid", "relfilenode", "marker")
+    )
+    if oid is None or relfilenode is None:
+        return None
+    return RelationMarker(oid, relfilenode, changes)
+
+
+def _unchanged(stored: Optional[RelationMarker], current: Optional[RelationMarker]) -> bool:
+    return stored is not None and current is not None and current.known and stored == current
+
+
+def _marker_parameters(prefix: str, marker: Optional[RelationMarker]) -> dict:
+    return {
+        f"{prefix}_oid": marker.oid if marker else None,
+        f"{prefix}_relfilenode": marker.relfilenode if marker else None,
+        f"{prefix}_marker": marker.changes if marker else None,
+    }
+
+
+@dataclass(frozen=True)
+class BlockAssignment:
+    """
+    The assignment for one source table. source_key has to be unique in
+    the source, block_key in the block table.
+    """
+    source_table_name: str
+    source_key: str = DEFAULT_SOURCE_KEY
+    block_key: str = DEFAULT_BLOCK_KEY
+
+    @property
+    def name(self) -> str:
+        return "__".join(_source_table(self.source_table_name))
+
+    @property
+    def table(self) -> str:
+        return f"{CACHE_SCHEMA}.{_quote(self.name)}"
+
+    def block_join(self) -> str:
+        """
+        Stands in for the spatial join in build_query (the source is aa and
+        the blocks bb).
+        """
+        return (
+            f"{self.table} ab ON ab.source_id = aa.{_quote(self.source_key)}\n"
+            f"                    INNER JOIN\n"
+            f"                {BLOCK_SCHEMA}.{BLOCK_NAME} bb ON bb.{_quote(self.block_key)} = ab.block_id"
+        )
+
+
+def _create_state(connection):
+    connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {CACHE_SCHEMA}"))
+    connection.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {CACHE_SCHEMA}.assignment_state (
+            source_table text PRIMARY KEY,
+            source_key text NOT NULL,
+            block_key text NOT NULL,
+            source_marker bigint,
+            blocks_marker bigint,
+            refreshed_at timestamptz NOT NULL DEFAULT now()
+        )
+    """))
+    # State tables from before the oid and relfilenode were recorded
+    connection.execute(text(f"""
+        ALTER TABLE {CACHE_SCHEMA}.assignment_state
+            ADD COLUMN IF NOT EXISTS source_oid bigint,
+            ADD COLUMN IF NOT EXISTS source_relfilenode bigint,
+            ADD COLUMN IF NOT EXISTS blocks_oid bigint,
+            ADD COLUMN IF NOT EXISTS blocks_relfilenode bigint
+    """))
+
+
+def _create_assignment(connection, assignment: BlockAssignment):
+    source_key, block_key = _quote(assignment.source_key), _quote(assignment.block_key)
+
+    # The key columns take their types from the source and the blocks
+    connection.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {assignment.table} AS
+        SELECT aa.{source_key} AS source_id, bb.{block_key} AS block_id, ''::text AS geom_hash
+        FROM {assignment.source_table_name} aa, {BLOCK_SCHEMA}.{BLOCK_NAME} bb
+        WITH NO DATA
+    """))
+
+    for column in ("source_id", "block_id"):
+        index = _quote(f"{assignment.name}_{column}")
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {assignment.table} ({column})"))
+
+
+def _assign(connection, assignment: BlockAssignment, missing_only: bool) -> int:
+    source_key, block_key = _quote(assignment.source_key), _quote(assignment.block_key)
+    missing = (
+        f"WHERE NOT EXISTS (SELECT 1 FROM {assignment.table} ab WHERE ab.source_id = aa.{source_key})"
+        if missing_only
+        else ""
+    )
+
+    return connection.execute(text(f"""
+        INSERT INTO {assignment.table} (source_id, block_id, geom_hash)
+        SELECT aa.{source_key}, bb.{block_key}, md5(ST_AsEWKB(aa.geom))
+        FROM
+            {assignment.source_table_name} aa
+                LEFT JOIN
+            {BLOCK_SCHEMA}.{BLOCK_NAME} bb on st_intersects(aa.geom, bb.geom)
+        {missing}
+    """)).rowcount
+
+
+def _drop_changed(connection, assignment: BlockAssignment) -> int:
+    source_key = _quote(assignment.source_key)
+
+    return connection.execute(text(f"""
+        DELETE FROM {assignment.table} ab
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {assignment.source_table_name} aa
+            WHERE aa.{source_key} = ab.source_id
+              AND md5(ST_AsEWKB(aa.geom)) IS NOT DISTINCT FROM ab.geom_hash
+        )
+    """)).rowcount
+
+
+def refresh_assignment(engine: Engine, assignment: BlockAssignment, force: bool = False) -> Optional[str]:
+    """
+    Bring the assignment up to date. Returns how it was refreshed,
+    "rebuilt" or "incremental", or None if it was already fresh.
+
+    Builds refreshing the same source wait on each other.
+    """
+    source = _source_table(assignment.source_table_name)
+    blocks = (BLOCK_SCHEMA, BLOCK_NAME)
+
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": assignment.table}
+        )
+        _create_state(connection)
+
+        # Read before refreshing, so changes made meanwhile show up next time
+        markers = relation_markers(engine, [source, blocks])
+        state = connection.execute(
+            text(f"SELECT * FROM {CACHE_SCHEMA}.assignment_state WHERE source_table = :source_table"),
+            {"source_table": assignment.source_table_name},
+        ).one_or_none()
+        stored_source = _stored_marker(state, "source")
+
+        recreated = (
+            stored_source is None
+            or markers[source] is None
+            or stored_source.oid != markers[source].oid
+        )
+        if state is not None and (
+            recreated or (state.source_key, state.block_key) != (assignment.source_key, assignment.block_key)
+        ):
+            # The key columns may have other types
+            connection.execute(text(f"DROP TABLE IF EXISTS {assignment.table}"))
+            state = None
+        _create_assignment(connection, assignment)
+
+        rebuild = force or state is None or not _unchanged(_stored_marker(state, "blocks"), markers[blocks])
+
+        if rebuild:
+            with stage("assign_blocks"):
+                connection.execute(text(f"TRUNCATE {assignment.table}"))
+                _assign(connection, assignment, missing_only=False)
+            refreshed = "rebuilt"
+        elif not _unchanged(stored_source, markers[source]):
+            with stage("assign_blocks"):
+                _drop_changed(connection, assignment)
+                _assign(connection, assignment, missing_only=True)
+            refreshed = "incremental"
+        else:
+            return None
+
+        connection.execute(
+            text(f"""
+                INSERT INTO {CACHE_SCHEMA}.assignment_state
+                    (source_table, source_key, block_key,
+                     source_oid, source_relfilenode, source_marker,
+                     blocks_oid, blocks_relfilenode, blocks_marker, refreshed_at)
+                VALUES (:source_table, :source_key, :block_key,
+                        :source_oid, :source_relfilenode, :source_marker,
+                        :blocks_oid, :blocks_relfilenode, :blocks_marker, now())
+                ON CONFLICT (source_table) DO UPDATE SET
+                    source_key = EXCLUDED.source_key,
+                    block_key = EXCLUDED.block_key,
+                    source_oid = EXCLUDED.source_oid,
+                    source_relfilenode = EXCLUDED.source_relfilenode,
+                    source_marker = EXCLUDED.source_marker,
+                    blocks_oid = EXCLUDED.blocks_oid,
+                    blocks_relfilenode = EXCLUDED.blocks_relfilenode,
+                    blocks_marker = EXCLUDED.blocks_marker,
+                    refreshed_at = EXCLUDED.refreshed_at
+            """),
+            {
+                "source_table": assignment.source_table_name,
+                "source_key": assignment.source_key,
+                "block_key": assignment.block_key,
+                **_marker_parameters("source", markers[source]),
+                **_marker_parameters("blocks", markers[blocks]),
+            },
+        )
+
+    with engine.begin() as connection:
+        connection.execute(text(f"ANALYZE {assignment.table}"))
+
+    return refreshed
+
+
+def is_fresh(engine: Engine, assignment: BlockAssignment) -> bool:
+    """
+    Whether the assignment exists and neither the source nor the blocks
+    have changed since it was refreshed.
+    """
+    source = _source_table(assignment.source_table_name)
+    blocks = (BLOCK_SCHEMA, BLOCK_NAME)
+
+    with engine.connect() as connection:
+        exists = connection.execute(
+            text("SELECT to_regclass(:name) IS NOT NULL"), {"name": f"{CACHE_SCHEMA}.assignment_state"}
+        ).scalar()
+        if not exists:
+            return False
+
+        state = connection.execute(
+            text(f"SELECT * FROM {CACHE_SCHEMA}.assignment_state WHERE source_table = :source_table"),
+            {"source_table": assignment.source_table_name},
+        ).one_or_none()
+
+    if state is None or (state.source_key, state.block_key) != (assignment.source_key, assignment.block_key):
+        return False
+
+    markers = relation_markers(engine, [source, blocks])
+    return _unchanged(_stored_marker(state, "source"), markers[source]) and _unchanged(
+        _stored_marker(state, "blocks"), markers[blocks]
+    )
+
+
+def assigned_block_join(engine: Engine, source_table_name: str, settings: dict) -> Optional[str]:
+    """
+    The block join for build_query from the [block_assignment] config, or
+    None to use the spatial join (sources not in `tables`, if that's set).
+    With refresh (the default), a stale assignment is refreshed first,
+    otherwise it's only used while fresh.
+    """
+    tables = settings.get("tables", [])
+    if tables and source_table_name not in tables:
+        return None
+
+    assignment = BlockAssignment(
+        source_table_name,
+        source_key=settings.get("source_key", DEFAULT_SOURCE_KEY),
+        block_key=settings.get("block_key", DEFAULT_BLOCK_KEY),
+    )
+
+    if settings.get("refresh", True):
+        if refreshed := refresh_assignment(engine, assignment):
+            print(f"Block assignment for {source_table_name} {refreshed}.")
+    elif not is_fresh(engine, assignment):
+        print(f"Block assignment for {source_table_name} is stale, using the spatial join.")
+        return None
+
+    return assignment.block_join()
+
+
+## Subdivided blocks
+
+def subdivided_block_join(block_key: str = DEFAULT_BLOCK_KEY) -> str:
+    """
+    Stands in for the spatial join in build_query. The DISTINCT keeps a
+    source feature from counting twice when it crosses several pieces of
+    the same block.
+    """
+    return (
+        f"LATERAL (\n"
+        f"                    SELECT DISTINCT ss.block_id FROM {CACHE_SCHEMA}.{SUBDIVIDED_NAME} ss\n"
+        f"                    WHERE st_intersects(aa.geom, ss.geom)\n"
+        f"                ) sb ON TRUE\n"
+        f"                    INNER JOIN\n"
+        f"                {BLOCK_SCHEMA}.{BLOCK_NAME} bb ON bb.{_quote(block_key)} = sb.block_id"
+    )
+
+
+def _create_subdivision_state(connection):
+    connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {CACHE_SCHEMA}"))
+    connection.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {CACHE_SCHEMA}.subdivision_state (
+            block_table text PRIMARY KEY,
+            block_key text NOT NULL,
+            max_vertices integer NOT NULL,
+            blocks_marker bigint,
+            refreshed_at timestamptz NOT NULL DEFAULT now()
+        )
+    """))
+    connection.execute(text(f"""
+        ALTER TABLE {CACHE_SCHEMA}.subdivision_state
+            ADD COLUMN IF NOT EXISTS blocks_oid bigint,
+            ADD COLUMN IF NOT EXISTS blocks_relfilenode bigint
+    """))
+
+
+def _subdivision_state(connection):
+    exists = connection.execute(
+        text("SELECT to_regclass(:name) IS NOT NULL"), {"name": f"{CACHE_SCHEMA}.subdivision_state"}
+    ).scalar()
+    if not exists:
+        return None
+
+    return connection.execute(
+        text(f"SELECT * FROM {CACHE_SCHEMA}.subdivision_state WHERE block_table = :block_table"),
+        {"block_table": f"{BLOCK_SCHEMA}.{BLOCK_NAME}"},
+    ).one_or_none()
+
+
+def _subdivision_matches(
+    state, marker: Optional[RelationMarker], block_key: str, max_vertices: int
+) -> bool:
+    return (
+        state is not None
+        and (state.block_key, state.max_vertices) == (block_key, max_vertices)
+        and _unchanged(_stored_marker(state, "blocks"), marker)
+    )
+
+
+def refresh_subdivision(
+    engine: Engine,
+    block_key: str = DEFAULT_BLOCK_KEY,
+    max_vertices: int = DEFAULT_MAX_VERTICES,
+    force: bool = False,
+) -> bool:
+    """
+    (Re)build the subdivided blocks if the block table or the settings
+    changed since they were cut. Returns whether they were rebuilt.
+
+    The new copy is built next to the old one and swapped in, so builds
+    running meanwhile keep reading the old one.
+    """
+    blocks = (BLOCK_SCHEMA, BLOCK_NAME)
+    table = f"{CACHE_SCHEMA}.{SUBDIVIDED_NAME}"
+    staging = _quote(SUBDIVIDED_NAME + "_new")
+
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": table})
+        _create_subdivision_state(connection)
+
+        marker = relation_markers(engine, [blocks])[blocks]
+        if not force and _subdivision_matches(_subdivision_state(connection), marker, block_key, max_vertices):
+            return False
+
+        with stage("subdivide_blocks"):
+            connection.execute(text(f"DROP TABLE IF EXISTS {CACHE_SCHEMA}.{staging}"))
+            connection.execute(
+                text(f"""
+                    CREATE TABLE {CACHE_SCHEMA}.{staging} AS
+                    SELECT bb.{_quote(block_key)} AS block_id, ST_Subdivide(bb.geom, :max_vertices) AS geom
+                    FROM {BLOCK_SCHEMA}.{BLOCK_NAME} bb
+                    WHERE bb.geom IS NOT NULL
+                """),
+                {"max_vertices": max_vertices},
+            )
+            connection.execute(text(f"DROP INDEX IF EXISTS {CACHE_SCHEMA}.{_quote(SUBDIVIDED_NAME + '_geom')}"))
+            connection.execute(text(
+                f"CREATE INDEX {_quote(SUBDIVIDED_NAME + '_geom')} ON {CACHE_SCHEMA}.{staging} USING GIST (geom)"
+            ))
+            connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            connection.execute(text(f"ALTER TABLE {CACHE_SCHEMA}.{staging} RENAME TO {SUBDIVIDED_NAME}"))
+
+        connection.execute(
+            text(f"""
+                INSERT INTO {CACHE_SCHEMA}.subdivision_state
+                    (block_table, block_key, max_vertices,
+                     blocks_oid, blocks_relfilenode, blocks_marker, refreshed_at)
+                VALUES (:block_table, :block_key, :max_vertices,
+                        :blocks_oid, :blocks_relfilenode, :blocks_marker, now())
+                ON CONFLICT (block_table) DO UPDATE SET
+                    block_key = EXCLUDED.block_key,
+                    max_vertices = EXCLUDED.max_vertices,
+                    blocks_oid = EXCLUDED.blocks_oid,
+                    blocks_relfilenode = EXCLUDED.blocks_relfilenode,
+                    blocks_marker = EXCLUDED.blocks_marker,
+                    refreshed_at = EXCLUDED.refreshed_at
+            """),
+            {
+                "block_table": f"{BLOCK_SCHEMA}.{BLOCK_NAME}",
+                "block_key": block_key,
+                "max_vertices": max_vertices,
+                **_marker_parameters("blocks", marker),
+            },
+        )
+
+    with engine.begin() as connection:
+        connection.execute(text(f"ANALYZE {table}"))
+
+    return True
+
+
+def subdivision_block_join(engine: Engine, settings: dict) -> Optional[str]:
+    """
+    The block join for build_query from the [block_subdivision] config, or
+    None to use the spatial join when the subdivided blocks are missing or
+    stale.
+    """
+    block_key = settings.get("block_key", DEFAULT_BLOCK_KEY)
+    max_vertices = settings.get("max_vertices", DEFAULT_MAX_VERTICES)
+    blocks = (BLOCK_SCHEMA, BLOCK_NAME)
+
+    with engine.connect() as connection:
+        state = _subdivision_state(connection)
+
+    if not _subdivision_matches(state, relation_markers(engine, [blocks])[blocks], block_key, max_vertices):
+        print("Subdivided blocks are missing or stale, using the spatial join. Run --refresh_block_cache.")
+        return None
+
+    return subdivided_block_join(block_key)
+
+
+def refresh_block_cache(engine: Engine, config: dict, force: bool = False):
+    """
+    Refresh the subdivided blocks, and the assignments of the sources
+    listed in [block_assignment] that are on this source database, for
+    pipeline.py --refresh_block_cache.
+    """
+    subdivision = config.get("block_subdivision", {})
+    rebuilt = refresh_subdivision(
+        engine,
+        block_key=subdivision.get("block_key", DEFAULT_BLOCK_KEY),
+        max_vertices=subdivision.get("max_vertices", DEFAULT_MAX_VERTICES),
+        force=force,
+    )
+    print(f"Subdivided blocks {'rebuilt' if rebuilt else 'already fresh'}.")
+
+    settings = config.get("block_assignment", {})
+    for source_table_name in settings.get("tables", []):
+        with engine.connect() as connection:
+            if not connection.execute(
+                text("SELECT to_regclass(:name) IS NOT NULL"), {"name": source_table_name}
+            ).scalar():
+                continue
+
+        assignment = BlockAssignment(
+            source_table_name,
+            source_key=settings.get("source_key", DEFAULT_SOURCE_KEY),
+            block_key=settings.get("block_key", DEFAULT_BLOCK_KEY),
+        )
+        refreshed = refresh_assignment(engine, assignment, force=force)
+        print(f"Block assignment for {source_table_name} {refreshed or 'already fresh'}.")
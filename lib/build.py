@@ -0,0 +1,410 @@
+"""
+The stages of a single table build: aggregate, suppress and deliver.
+
+The modules behind each stage are imported when the stage runs, so a
+hollow or metadata-only build never loads the aggregation code, etc.
+
+pipeline.py runs one of these per invocation, lib.batch runs many of them
+side by side. Problems with a recipe are raised as BuildError so a batch
+can record them and move on to the next table.
+"""
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import ContextManager, Optional
+
+from .connection import Backend
+from .d3models import InvalidEditionError, InvalidTableError, read_table_variables_to_dataframe
+from .recipes import EditionRecipe, TableRecipe, placeholder_edition
+from .checkpoint import Checkpoint, NoCheckpoint
+from .instrumentation import observe, stage
+from .phrases import DivisionByZeroError, UnsupportedPhraseError
+from .sources import FILE_SOURCE
+
+
+class BuildError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class BuildJob:
+    table_name: str
+    edition: Optional[str] = None
+    destination_schema: str = "d3_present"
+    hollow: bool = False
+    no_update: bool = False
+
+
+def resolve_edition(recipe: TableRecipe, job: BuildJob) -> EditionRecipe:
+    """
+    Pick the edition to build from the recipe: a placeholder for hollow
+    tables, the requested edition, or else the latest one.
+    """
+    if job.hollow:
+        return placeholder_edition(job.table_name)
+
+    try:
+        if not job.edition:
+            edition = recipe.latest_edition()
+        else:
+            edition = recipe.edition(job.edition)
+    except (InvalidEditionError, InvalidTableError) as e:
+        raise BuildError(str(e)) from e
+
+    if (edition.raw_table_db is None) | (edition.raw_table_schema is None):
+        raise BuildError(
+            "No database or schema provided in the editions metadata table. Add this argument before attempting again."
+        )
+
+    return edition
+
+
+def _aggregation_arguments(edition: EditionRecipe, connections: Backend) -> dict:
+    """
+    Where run_aggregation reads from and which backend it uses, from the
+    edition and the optional [aggregation] config section. Editions whose
+    raw_table_db is "file" point at a GeoParquet or GeoPackage export in
+    raw_table_name, which only the strtree backend can read.
+    """
+    settings = connections.config.get("aggregation", {})
+    backend = settings.get("backend", "sql")
+
+    if edition.raw_table_db == FILE_SOURCE:
+        if not settings.get("blocks_path"):
+            raise BuildError(
+                f"{edition} is read from a file, set blocks_path in [aggregation] to aggregate it."
+            )
+        arguments = {"source_table_name": edition.raw_table_name, "engine": None, "backend": "strtree"}
+    else:
+        arguments = {
+            # Have to do it this way because the postgis stuff isn't available in the lower namespaces.
+            # Maybe there is a way to handle this by adding to the schema instead of replacing the schema name.
+            "source_table_name": f"{edition.raw_table_schema}.{edition.raw_table_name}",
+            "engine": connections.source_engine(edition.raw_table_db),
+            "backend": backend,
+        }
+
+    if arguments["backend"] != "strtree":
+        arguments["compile"] = settings.get("compile_phrases", False)
+        arguments["verify"] = settings.get("verify_compiled", False)
+
+    block_assignment = connections.config.get("block_assignment", {})
+    if arguments["backend"] == "sql" and block_assignment.get("enabled"):
+        arguments["block_assignment"] = block_assignment
+
+    block_subdivision = connections.config.get("block_subdivision", {})
+    if arguments["backend"] == "sql" and block_subdivision.get("enabled"):
+        arguments["block_subdivision"] = block_subdivision
+
+    if arguments["backend"] == "strtree" and settings.get("blocks_path"):
+        from .spatial import load_blocks
+
+        arguments["blocks"] = load_blocks(settings["blocks_path"])
+
+    return arguments
+
+
+def _update_cr_metadata(job: BuildJob, recipe: TableRecipe, connections: Backend):
+    # Update the metadata tables if necessary
+    from .metadata import update_metadata
+
+    print("Updating metadata on destination database.")
+    DestinationSession = connections.destination_session(job.destination_schema)
+    try:
+        with DestinationSession() as db, stage("metadata"):
+            update_metadata(
+                db,
+                recipe,
+                list(recipe.variables),
+            )
+    except (TypeError, AttributeError) as e:
+        print(f"ERROR: Unable to update metadata--{e}")
+
+
+def _partitioned_delivery(connections: Backend, engine) -> Optional[dict]:
+    """
+    The [delivery] settings when tables should be delivered partitioned by
+    summary level, None for the usual flat tables.
+    """
+    settings = connections.config.get("delivery", {})
+    if not settings.get("partition_by_summary_level"):
+        return None
+
+    if engine.dialect.name != "postgresql":
+        print("Partitioned delivery needs Postgres, delivering flat tables instead.")
+        return None
+
+    return settings
+
+
+def _check_pruning(frame, table_name: str, engine, schema: str):
+    from .delivery import check_partition_pruning
+    from .geography import summary_levels
+
+    # One lookup per summary level is enough to cover every partition
+    geoids = frame["geoid"].groupby(summary_levels(frame["geoid"]).to_numpy()).first()
+    for geoid, partitions in check_partition_pruning(engine, schema, table_name, list(geoids)).items():
+        print(f"WARNING: looking up {geoid} in {schema}.{table_name} reads {', '.join(partitions)}.")
+
+
+def build_hollow(
+    jobs: list[BuildJob],
+    recipes: dict[str, TableRecipe],
+    connections: Backend,
+):
+    """
+    Create the empty base and _moe tables for many hollow jobs straight
+    from their recipes, one transaction per destination schema.
+    """
+    from .ddl import create_hollow_tables
+
+    by_schema = {}
+    for job in jobs:
+        by_schema.setdefault(job.destination_schema, []).append(recipes[job.table_name])
+
+    for schema, schema_recipes in by_schema.items():
+        print(f"Creating {len(schema_recipes)} hollow tables in {schema}.")
+        with stage("deliver_hollow"):
+            created = create_hollow_tables(
+                connections.destination_engine(schema), schema, schema_recipes
+            )
+            observe(rows=0, columns=len(created))
+
+
+def sweep_table(
+    job: BuildJob,
+    recipe: TableRecipe,
+    connections: Backend,
+    thresholds: list[int],
+    keep_masks: bool = False,
+):
+    """
+    Aggregate a table and report what suppression would remove at each
+    threshold, without delivering anything.
+    """
+    from .aggregation import AggregationMismatchError, run_aggregation
+    from .suppression import suppression_sweep
+
+    edition_metadata = resolve_edition(recipe, job)
+    variable_metadata = list(recipe.variables)
+
+    with stage("aggregate"):
+        try:
+            unsuppressed = run_aggregation(
+                variables=variable_metadata,
+                **_aggregation_arguments(edition_metadata, connections),
+            )
+        except UnsupportedPhraseError as e:
+            raise BuildError(f"{recipe.table_name} can't be aggregated outside the database--{e}")
+        except (AggregationMismatchError, DivisionByZeroError) as e:
+            raise BuildError(f"{recipe.table_name}: {e}")
+        observe(unsuppressed)
+
+    with stage("sweep"):
+        return suppression_sweep(
+            unsuppressed,
+            read_table_variables_to_dataframe(variable_metadata),
+            thresholds,
+            keep_masks=keep_masks,
+        )
+
+
+def build_table(
+    job: BuildJob,
+    recipe: TableRecipe,
+    connections: Backend,
+    source_slot: Optional[ContextManager] = None,
+    destination_slot: Optional[ContextManager] = None,
+    update_cr_metadata: bool = True,
+    checkpoint: Optional[Checkpoint | NoCheckpoint] = None,
+):
+    """
+    Run every stage of the build for one table. The slots are held while
+    talking to the source and destination databases, which lets a batch
+    cap how many builds hit each server at once.
+
+    Stages already recorded in the checkpoint are skipped, so a resumed
+    build picks up where the failed one stopped.
+    """
+    source_slot = source_slot or nullcontext()
+    destination_slot = destination_slot or nullcontext()
+    checkpoint = checkpoint or NoCheckpoint()
+
+    edition_metadata = resolve_edition(recipe, job)
+    variable_metadata = list(recipe.variables)
+    variable_metadata_df = read_table_variables_to_dataframe(variable_metadata)
+
+    if job.hollow:
+        # Hollow tables are created from the recipe with DDL, no data involved
+        with destination_slot:
+            build_hollow([job], {job.table_name: recipe}, connections)
+            print("Hollow table ready.")
+
+            if update_cr_metadata:
+                _update_cr_metadata(job, recipe, connections)
+
+        checkpoint.cleanup()
+        return
+
+    print(f"Metadata loaded for {recipe.table_name}: {recipe.description}, beginning aggregation.")
+
+    def suppress(unsuppressed):
+        from .suppression import apply_suppression
+
+        if not recipe.suppression_threshold:
+            print("Aggregation complete.")
+            return unsuppressed
+        elif job.no_update:
+            return unsuppressed
+
+        print("Aggregation complete, beginning suppression.")
+        return apply_suppression(
+            unsuppressed,
+            variable_metadata_df,
+            threshold=recipe.suppression_threshold,
+        )
+
+    def validate(unsuppressed):
+        from .validation import report_violations, table_mode, validate_hierarchy
+
+        settings = connections.config.get("validation", {})
+        mode = table_mode(settings, recipe.table_name)
+        if mode == "off":
+            return
+
+        violations = validate_hierarchy(unsuppressed, variable_metadata, mode)
+        if violations.empty:
+            return
+
+        report = report_violations(recipe.table_name, mode, violations)
+        if settings.get("strict", False):
+            raise BuildError(report)
+        print(f"WARNING: {report}")
+
+    unsuppressed = final = final_moe = None
+
+    # 2. Run aggregation
+    if checkpoint.done("aggregate"):
+        print("Aggregation already checkpointed, skipping.")
+
+    elif job.no_update:
+        # Nothing is delivered, an empty dataframe with the correct shape will do.
+        from .empty import build_empty_table
+
+        unsuppressed = build_empty_table(variable_metadata)
+        checkpoint.save("aggregate", unsuppressed)
+
+    else:
+        # otherwise run the aggregation to obtain the dataframe
+        from .aggregation import AggregationMismatchError, run_aggregation
+
+        with source_slot, stage("aggregate"):
+            try:
+                unsuppressed = run_aggregation(
+                    variables=variable_metadata,
+                    **_aggregation_arguments(edition_metadata, connections),
+                )
+            except UnsupportedPhraseError as e:
+                raise BuildError(f"{recipe.table_name} can't be aggregated outside the database--{e}")
+            except (AggregationMismatchError, DivisionByZeroError) as e:
+                raise BuildError(f"{recipe.table_name}: {e}")
+            observe(unsuppressed)
+        checkpoint.save("aggregate", unsuppressed)
+
+    # 3. Check the aggregates against the variable hierarchy
+    if not (job.no_update or checkpoint.done("validate")):
+        unsuppressed = checkpoint.frame("aggregate", unsuppressed)
+        with stage("validate"):
+            validate(unsuppressed)
+        checkpoint.save("validate")
+
+    # 4. Apply suppression if necessary
+    if checkpoint.done("suppress"):
+        print("Suppression already checkpointed, skipping.")
+    else:
+        unsuppressed = checkpoint.frame("aggregate", unsuppressed)
+
+        with stage("suppress"):
+            final = suppress(unsuppressed)
+        checkpoint.save("suppress", final)
+
+    from .delivery import push_base_table, add_moe_columns, push_moe_table, push_partitioned_table
+
+    if not checkpoint.done("moe"):
+        with stage("moe"):
+            final_moe = add_moe_columns(checkpoint.frame("suppress", final))
+            observe(final_moe)
+        checkpoint.save("moe", final_moe)
+
+    # 5. Deliver tables
+    with destination_slot:
+        destination_engine = connections.destination_engine(job.destination_schema)
+        partitioned = _partitioned_delivery(connections, destination_engine)
+
+        if job.no_update:
+            print("No-update flag was selected so no data is moving.")
+
+        if not (job.no_update or checkpoint.done("deliver_base")):
+            print(f"Pushing {job.table_name} to schema {job.destination_schema} on destination database.")
+
+            with stage("deliver_base"):
+                if partitioned is None:
+                    push_base_table(
+                        checkpoint.frame("suppress", final),
+                        job.table_name,
+                        destination_engine,
+                        schema=job.destination_schema,
+                    )
+                else:
+                    final = checkpoint.frame("suppress", final)
+                    push_partitioned_table(
+                        final,
+                        job.table_name,
+                        destination_engine,
+                        schema=job.destination_schema,
+                        workers=partitioned.get("partition_workers", 4),
+                    )
+                    if partitioned.get("check_pruning", True):
+                        _check_pruning(final, job.table_name, destination_engine, job.destination_schema)
+            checkpoint.save("deliver_base")
+
+        if not (job.no_update or checkpoint.done("deliver_moe")):
+            with stage("deliver_moe"):
+                if partitioned is None:
+                    push_moe_table(
+                        checkpoint.frame("moe", final_moe),
+                        job.table_name,
+                        destination_engine,
+                        schema=job.destination_schema,
+                    )
+                else:
+                    push_partitioned_table(
+                        checkpoint.frame("moe", final_moe),
+                        job.table_name + "_moe",
+                        destination_engine,
+                        schema=job.destination_schema,
+                        workers=partitioned.get("partition_workers", 4),
+                    )
+            checkpoint.save("deliver_moe")
+
+        if (
+            connections.config.get("blobs", {}).get("enabled")
+            and not (job.no_update or checkpoint.done("deliver_blobs"))
+        ):
+            from .blobs import push_blobs, render_documents
+
+            with stage("deliver_blobs"):
+                documents = render_documents(checkpoint.frame("moe", final_moe), recipe)
+                written, deleted = push_blobs(
+                    documents,
+                    recipe.table_name.upper(),
+                    destination_engine,
+                    schema=job.destination_schema,
+                )
+            print(f"Rendered {documents.num_rows} JSON documents, {written} new or changed, {deleted} removed.")
+            checkpoint.save("deliver_blobs")
+
+        if update_cr_metadata and not checkpoint.done("metadata"):
+            _update_cr_metadata(job, recipe, connections)
+            checkpoint.save("metadata")
+
+    checkpoint.cleanup()
@@ -0,0 +1,158 @@
+"""
+Stage checkpoints for table builds.
+
+Each stage of a build records itself in a small manifest, and the stages
+that produce a table also write it out as parquet. If a build dies part
+way through (a dropped tunnel during delivery, say), it can be restarted
+with --resume <run id> from the first stage that didn't finish. The
+checkpoint is removed once the whole build succeeds.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+DEFAULT_CHECKPOINT_DIRECTORY = ".pipeline_cache/checkpoints"
+
+STAGES = (
+    "aggregate",
+    "validate",
+    "suppress",
+    "moe",
+    "deliver_base",
+    "deliver_moe",
+    "deliver_blobs",
+    "metadata",
+)
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class Checkpoint:
+    def __init__(self, path: Path, manifest: dict):
+        self.path = path
+        self.manifest = manifest
+
+    @property
+    def run_id(self) -> str:
+        return self.manifest["run_id"]
+
+    @classmethod
+    def create(cls, directory: str | Path, job) -> "Checkpoint":
+        run_id = f"{job.table_name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        path = Path(directory) / run_id
+        path.mkdir(parents=True)
+
+        checkpoint = cls(path, {"run_id": run_id, "job": asdict(job), "completed": []})
+        checkpoint._write_manifest()
+
+        return checkpoint
+
+    @classmethod
+    def resume(cls, directory: str | Path, run_id: str) -> "Checkpoint":
+        path = Path(directory) / run_id
+
+        try:
+            with open(path / "manifest.json") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            raise CheckpointError(
+                f"No checkpoint found for run '{run_id}' in {directory}."
+            )
+
+        return cls(path, manifest)
+
+    @property
+    def job_options(self) -> dict:
+        return self.manifest["job"]
+
+    def _write_manifest(self):
+        # Write then rename so a crash never leaves a half written manifest
+        temporary = self.path / "manifest.json.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(temporary, self.path / "manifest.json")
+
+    def done(self, stage: str) -> bool:
+        return stage in self.manifest["completed"]
+
+    @property
+    def started(self) -> bool:
+        """
+        Whether any stage has been saved, i.e. whether resuming saves work.
+        """
+        return bool(self.manifest["completed"])
+
+    def save(self, stage: str, frame: Optional["pd.DataFrame"] = None):
+        if frame is not None:
+            frame.to_parquet(self.path / f"{stage}.parquet", index=False)
+
+        self.manifest["completed"].append(stage)
+        self._write_manifest()
+
+    def load(self, stage: str) -> "pd.DataFrame":
+        import pandas as pd
+
+        return pd.read_parquet(self.path / f"{stage}.parquet")
+
+    def frame(self, stage: str, frame: Optional["pd.DataFrame"]) -> "pd.DataFrame":
+        """
+        The frame produced by a stage: the one in hand if the stage just
+        ran, otherwise the one saved by an earlier run.
+        """
+        return frame if frame is not None else self.load(stage)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class NoCheckpoint:
+    """
+    Stand-in used when checkpoints are turned off, every stage runs.
+    """
+
+    run_id = None
+    started = False
+
+    def done(self, stage: str) -> bool:
+        return False
+
+    def save(self, stage: str, frame: Optional["pd.DataFrame"] = None):
+        pass
+
+    def frame(self, stage: str, frame: Optional["pd.DataFrame"]) -> "pd.DataFrame":
+        return frame
+
+    def cleanup(self):
+        pass
+
+
+def checkpoint_directory(config: dict) -> Optional[str]:
+    """
+    Where checkpoints go, or None if they're turned off in the config.
+    """
+    settings = config.get("checkpoints", {})
+
+    if not settings.get("enabled", True):
+        return None
+
+    return settings.get("directory", DEFAULT_CHECKPOINT_DIRECTORY)
+
+
+def start_checkpoint(config: dict, job) -> Checkpoint | NoCheckpoint:
+    directory = checkpoint_directory(config)
+
+    if directory is None:
+        return NoCheckpoint()
+
+    return Checkpoint.create(directory, job)
@@ -0,0 +1,80 @@
+"""
+Helpers for passing tables between the build stages as Arrow-backed
+DataFrames without copying their values.
+
+Aggregation reads straight into Arrow columns, suppression only swaps in a
+new validity bitmap over each column's existing data buffer, and the _moe
+layout reuses the value columns plus one shared all-null column.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def to_arrow(column: pd.Series) -> pa.ChunkedArray:
+    """
+    The Arrow data behind a column, zero-copy for Arrow-backed columns and
+    for numeric numpy columns without missing values.
+    """
+    if isinstance(column.dtype, pd.ArrowDtype):
+        return column.array._pa_array
+
+    return pa.chunked_array([pa.array(column.to_numpy(), from_pandas=True)])
+
+
+def _bitmap(valid: np.ndarray, offset: int) -> pa.Buffer:
+    if offset:
+        valid = np.concatenate([np.ones(offset, dtype=bool), valid])
+    return pa.py_buffer(np.packbits(valid, bitorder="little"))
+
+
+def _with_validity(array: pa.Array, keep: np.ndarray) -> pa.Array:
+    """
+    The same values as `array` with the positions where `keep` is False
+    set to null. Fixed width types only get a new validity bitmap; the
+    data buffer is shared.
+    """
+    buffers = array.buffers()
+
+    if not pa.types.is_primitive(array.type) and not pa.types.is_decimal(array.type):
+        return pc.if_else(pa.array(keep), array, pa.nulls(len(array), array.type))
+
+    if buffers[0] is not None:
+        existing = np.unpackbits(
+            np.frombuffer(buffers[0], dtype=np.uint8), bitorder="little"
+        )[array.offset : array.offset + len(array)].astype(bool)
+        keep = keep & existing
+
+    return pa.Array.from_buffers(
+        array.type,
+        len(array),
+        [_bitmap(keep, array.offset), *buffers[1:]],
+        null_count=int(len(keep) - keep.sum()),
+        offset=array.offset,
+    )
+
+
+def mask_column(column: pd.Series, mute: np.ndarray) -> pd.Series:
+    """
+    `column` with the rows where `mute` is True set to null, as an Arrow
+    backed Series over the same value buffers.
+    """
+    if not mute.any():
+        chunked = to_arrow(column)
+    else:
+        keep = ~mute
+        chunks, start = [], 0
+        for chunk in to_arrow(column).chunks:
+            chunks.append(_with_validity(chunk, keep[start : start + len(chunk)]))
+            start += len(chunk)
+        chunked = pa.chunked_array(chunks, type=to_arrow(column).type)
+
+    return pd.Series(pd.arrays.ArrowExtensionArray(chunked), index=column.index, name=column.name, copy=False)
+
+
+def shared_nulls(length: int, type: pa.DataType = pa.float64()) -> pd.arrays.ArrowExtensionArray:
+    """
+    One all-null column that any number of DataFrame columns can point at.
+    """
+    return pd.arrays.ArrowExtensionArray(pa.chunked_array([pa.nulls(length, type)]))
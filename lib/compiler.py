@@ -0,0 +1,331 @@
+"""
+Compiles a recipe's sql_aggregation_phrases into a leaner aggregation
+query than pasting them in verbatim.
+
+Phrases that lib.phrases can parse are rendered back to SQL with three
+rewrites:
+
+    sum(CASE WHEN c THEN x ELSE 0 END)   ->  COALESCE(sum(x) FILTER (WHERE c), 0)
+    sum(CASE WHEN c THEN x END)          ->  sum(x) FILTER (WHERE c)
+    count(CASE WHEN c THEN 1 END)        ->  count(*) FILTER (WHERE c)
+
+- Phrases that come out the same are computed once.
+- Conditions (or AND-ed parts of them) and value expressions shared by
+  more than one phrase are computed once per source row. This happens in
+  a LATERAL subquery next to the source table, and the aggregates refer to
+  the results by name. OFFSET 0 keeps Postgres from inlining the subquery
+  back into every aggregate.
+
+Only expressions over the source table (aa.*) that can't raise an error
+are shared this way. The lateral runs for every source row, outside the
+CASE or FILTER that guarded the expression in the phrase, so arithmetic
+on columns or a ::cast stays where it was (sum(CASE WHEN aa.units > 0 THEN
+aa.value / aa.units ELSE 0 END) would otherwise divide by zero, and a
+multiplication could overflow). Phrases that can't
+be parsed go into the query as they are.
+
+The one difference in results is the ELSE 0 rewrite. Where a geoid's rows
+all match and every value is NULL, sum(CASE ...) is NULL and the rewrite
+gives 0. build_query COALESCEs every variable to 0 anyway.
+"""
+import re
+from collections import Counter
+from dataclasses import dataclass, replace
+from textwrap import indent
+from typing import Optional
+
+from .phrases import (
+    Aggregate,
+    Arithmetic,
+    BoolOp,
+    Case,
+    Cast,
+    ColumnRef,
+    Comparison,
+    InList,
+    IsNull,
+    Like,
+    Literal,
+    Not,
+    UnsupportedPhraseError,
+    parse_phrase,
+)
+
+
+SOURCE_ALIAS = "aa"
+LATERAL_ALIAS = "pp"
+
+_IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+## Rendering the expression tree back to SQL
+
+def _identifier(name: str) -> str:
+    return name if _IDENTIFIER.match(name) else '"{}"'.format(name.replace('"', '""'))
+
+
+def _literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return repr(value)
+
+
+def render(node) -> str:
+    """
+    SQL for an expression, fully parenthesised so it reads the same
+    wherever it's pasted.
+    """
+    match node:
+        case Literal(value):
+            return _literal(value)
+
+        case ColumnRef(name, table):
+            return f"{table}.{_identifier(name)}" if table else _identifier(name)
+
+        case Cast(operand, type_name):
+            return f"({render(operand)})::{type_name}"
+
+        case Arithmetic(operator, left, right):
+            return f"({render(left)} {operator} {render(right)})"
+
+        case Case(branches, otherwise):
+            whens = " ".join(f"WHEN {render(condition)} THEN {render(value)}" for condition, value in branches)
+            otherwise = f" ELSE {render(otherwise)}" if otherwise is not None else ""
+            return f"CASE {whens}{otherwise} END"
+
+        case Comparison(operator, left, right):
+            return f"({render(left)} {operator} {render(right)})"
+
+        case InList(operand, options, negated):
+            options = ", ".join(_literal(option) for option in options)
+            return f"({render(operand)} {'NOT ' if negated else ''}IN ({options}))"
+
+        case IsNull(operand, negated):
+            return f"({render(operand)} IS {'NOT ' if negated else ''}NULL)"
+
+        case Like(operand, pattern, case_sensitive, negated):
+            keyword = "LIKE" if case_sensitive else "ILIKE"
+            return f"({render(operand)} {'NOT ' if negated else ''}{keyword} {_literal(pattern)})"
+
+        case BoolOp(operator, operands):
+            return "(" + f" {operator.upper()} ".join(render(operand) for operand in operands) + ")"
+
+        case Not(operand):
+            return f"(NOT {render(operand)})"
+
+        case Aggregate(function, argument, where):
+            rendered = f"{function}({render(argument) if argument is not None else '*'})"
+            return rendered + (f" FILTER (WHERE {render(where)})" if where is not None else "")
+
+    raise UnsupportedPhraseError(f"Can't render {node!r}.")
+
+
+## Rewrites
+
+def _and(*conditions):
+    operands = []
+    for condition in conditions:
+        if isinstance(condition, BoolOp) and condition.operator == "and":
+            operands.extend(condition.operands)
+        elif condition is not None:
+            operands.append(condition)
+
+    if not operands:
+        return None
+    return operands[0] if len(operands) == 1 else BoolOp("and", tuple(operands))
+
+
+def _conjuncts(condition) -> tuple:
+    if condition is None:
+        return ()
+    if isinstance(condition, BoolOp) and condition.operator == "and":
+        return condition.operands
+    return (condition,)
+
+
+def to_filter(aggregate: Aggregate) -> tuple[Aggregate, bool]:
+    """
+    Rewrite a single-branch CASE aggregate as a FILTERed one. Also returns
+    whether the result has to be COALESCEd to 0 to match (the ELSE 0 form).
+    """
+    case = aggregate.argument
+    if not (isinstance(case, Case) and len(case.branches) == 1):
+        return aggregate, False
+
+    (condition, value), otherwise = case.branches[0], case.otherwise
+    no_else = otherwise is None or otherwise == Literal(None)
+
+    if aggregate.function == "sum" and (no_else or otherwise in (Literal(0), Literal(0.0))):
+        return replace(aggregate, argument=value, where=_and(aggregate.where, condition)), not no_else
+
+    if aggregate.function == "count" and no_else:
+        # count(CASE WHEN c THEN 1 END) counts the rows where c holds
+        argument = None if isinstance(value, Literal) and value.value is not None else value
+        return replace(aggregate, argument=argument, where=_and(aggregate.where, condition)), False
+
+    return aggregate, False
+
+
+def _source_only(node) -> bool:
+    """
+    Whether every column in an expression is on the source table, so it can
+    be computed next to it.
+    """
+    match node:
+        case ColumnRef(_, table):
+            return table == SOURCE_ALIAS
+        case Literal():
+            return True
+        case Cast(operand):
+            return _source_only(operand)
+        case Arithmetic(_, left, right) | Comparison(_, left, right):
+            return _source_only(left) and _source_only(right)
+        case Case(branches, otherwise):
+            return all(_source_only(c) and _source_only(v) for c, v in branches) and (
+                otherwise is None or _source_only(otherwise)
+            )
+        case InList(operand) | IsNull(operand) | Like(operand) | Not(operand):
+            return _source_only(operand)
+        case BoolOp(_, operands):
+            return all(_source_only(operand) for operand in operands)
+
+    return False
+
+
+def _literal_only(node) -> bool:
+    match node:
+        case Literal():
+            return True
+        case Arithmetic(_, left, right):
+            return _literal_only(left) and _literal_only(right)
+
+    return False
+
+
+def _can_raise(node) -> bool:
+    """
+    Whether evaluating an expression can fail on some rows: divisions
+    (by zero), arithmetic on columns (overflow) and casts (of values that
+    don't convert).
+    """
+    match node:
+        case Cast():
+            return True
+        case Arithmetic(operator, left, right):
+            return operator == "/" or not (_literal_only(left) and _literal_only(right))
+        case Comparison(_, left, right):
+            return _can_raise(left) or _can_raise(right)
+        case Case(branches, otherwise):
+            return any(_can_raise(c) or _can_raise(v) for c, v in branches) or (
+                otherwise is not None and _can_raise(otherwise)
+            )
+        case InList(operand) | IsNull(operand) | Like(operand) | Not(operand):
+            return _can_raise(operand)
+        case BoolOp(_, operands):
+            return any(_can_raise(operand) for operand in operands)
+
+    return False
+
+
+def _worth_sharing(node) -> bool:
+    return not isinstance(node, (ColumnRef, Literal)) and _source_only(node) and not _can_raise(node)
+
+
+@dataclass
+class CompiledAggregation:
+    """
+    `aggregates` holds the SQL for each distinct aggregate, keyed by the
+    first variable that uses it. `sources` maps every variable to that key.
+    `lateral` is the subquery of shared expressions, empty if none.
+    """
+    variable_names: list[str]
+    aggregates: dict[str, str]
+    sources: dict[str, str]
+    lateral: str = ""
+
+    def inner_select(self) -> str:
+        return indent(",\n".join(f"{sql} AS {name}" for name, sql in self.aggregates.items()), "\t")
+
+    def outer_select(self) -> str:
+        return indent(",\n".join(
+            ["all_geoms.geoid"]
+            + [
+                f"COALESCE(match_geoms.{self.sources[name]}, 0) {name}"
+                for name in self.variable_names
+            ]
+        ), "\t")
+
+    def geoid_select(self) -> str:
+        """
+        The inner select with every variable, for queries that have no outer
+        select to fan the distinct aggregates out, COALESCEd to 0 like
+        that outer select would. Postgres computes identical aggregates in
+        one query level only once.
+        """
+        return indent(",\n".join(
+            f"COALESCE({self.aggregates[self.sources[name]]}, 0) AS {name}" for name in self.variable_names
+        ), "\t")
+
+
+def compile_aggregation(variables, lateral: bool = True) -> CompiledAggregation:
+    """
+    Compile the variables' phrases. Without `lateral` (for databases that
+    don't have it) nothing is shared, the phrases are only rewritten and
+    deduplicated.
+    """
+    parsed: dict[str, Optional[tuple[Aggregate, bool]]] = {}
+    for variable in variables:
+        try:
+            parsed[variable.variable_name] = to_filter(parse_phrase(variable.sql_aggregation_phrase))
+        except UnsupportedPhraseError:
+            parsed[variable.variable_name] = None
+
+    # Count each shareable piece once per distinct aggregate that uses it
+    distinct = {result for result in parsed.values() if result is not None}
+    uses = Counter()
+    for aggregate, _ in distinct:
+        uses.update(set(filter(_worth_sharing, _conjuncts(aggregate.where))))
+        if aggregate.argument is not None and _worth_sharing(aggregate.argument):
+            uses[aggregate.argument] += 1
+
+    shared = {}
+    if lateral:
+        for expression, count in uses.items():
+            if count > 1:
+                prefix = "_e" if expression in [a.argument for a, _ in distinct] else "_p"
+                shared[expression] = ColumnRef(f"{prefix}{len(shared) + 1}", LATERAL_ALIAS)
+
+    def sql(name) -> str:
+        if parsed[name] is None:
+            return next(v.sql_aggregation_phrase for v in variables if v.variable_name == name)
+
+        aggregate, coalesce = parsed[name]
+        aggregate = replace(
+            aggregate,
+            argument=shared.get(aggregate.argument, aggregate.argument),
+            where=_and(*[shared.get(part, part) for part in _conjuncts(aggregate.where)]),
+        )
+        return f"COALESCE({render(aggregate)}, 0)" if coalesce else render(aggregate)
+
+    aggregates, sources = {}, {}
+    by_sql = {}
+    for variable in variables:
+        rendered = sql(variable.variable_name)
+        sources[variable.variable_name] = by_sql.setdefault(rendered, variable.variable_name)
+        aggregates.setdefault(sources[variable.variable_name], rendered)
+
+    lateral_sql = ""
+    if shared:
+        columns = ", ".join(f"{render(expression)} AS {ref.name}" for expression, ref in shared.items())
+        lateral_sql = f"CROSS JOIN LATERAL (SELECT {columns} OFFSET 0) {LATERAL_ALIAS}"
+
+    return CompiledAggregation(
+        variable_names=[variable.variable_name for variable in variables],
+        aggregates=aggregates,
+        sources=sources,
+        lateral=lateral_sql,
+    )
@@ -1,8 +1,11 @@
-from typing import Optional, Callable
+import atexit
+import socket
+import threading
+from typing import Optional, Callable, Protocol
 from urllib.parse import quote
 
-from sshtunnel import open_tunnel
 from sqlalchemy import create_engine, Engine
+from sqlalchemy.orm import sessionmaker
 
 
 def _build_engine(
@@ -13,19 +16,32 @@ def _build_engine(
     password: str,
     schema: Optional[str] = None,
     schema_translate_map: Optional[dict[str | None, str]] = None,
+    connect_args: Optional[dict] = None,
+    **engine_options,
 ) -> Engine:
     """
     This is the generic engine builder. This file will also provide the
     specific engine builders which will be called into the main pipeline file.
+
+    Any extra keyword arguments (pool_size, pool_pre_ping, ...) are passed
+    straight through to create_engine.
     """
+    connect_args = dict(connect_args or {})
+
     if (not schema) & (not schema_translate_map):
         return create_engine(
-            f"postgresql+psycopg2://{user}:{quote(password)}@{host}:{port}/{dbname}"
+            f"postgresql+psycopg2://{user}:{quote(password)}@{host}:{port}/{dbname}",
+            connect_args=connect_args,
+            **engine_options,
         )
 
+    if schema:
+        connect_args["options"] = f"-csearch_path={schema},public"
+
     engine = create_engine(
         f"postgresql+psycopg2://{user}:{quote(password)}@{host}:{port}/{dbname}",
-        connect_args={"options": f"-csearch_path={schema},public"},
+        connect_args=connect_args,
+        **engine_options,
     )
 
     if schema_translate_map:
@@ -72,6 +88,16 @@ def build_destination_engine(config, port, schema):
     )
 
 
+def open_tunnel(*args, **kwargs):
+    """
+    sshtunnel (and paramiko underneath it) is slow to import and often not
+    needed at all, so it's only loaded when a tunnel is opened.
+    """
+    from sshtunnel import open_tunnel as _open_tunnel
+
+    return _open_tunnel(*args, **kwargs)
+
+
 def open_workspace_tunnel(config):
     return open_tunnel(
         (config["workspace_db"]["host"], 22),
@@ -90,6 +116,251 @@ def open_destination_tunnel(config):
     )
 
 
+class Backend(Protocol):
+    """
+    Where the pipeline reads recipes and source data from and delivers
+    tables to. ConnectionManager is the Postgres implementation and
+    lib.local.LocalBackend keeps everything in SQLite files.
+    """
+
+    config: dict
+
+    def workspace_engine(self) -> Engine: ...
+
+    def source_engine(self, db_name: str) -> Engine: ...
+
+    def destination_engine(self, schema: str) -> Engine: ...
+
+    def workspace_session(self) -> sessionmaker: ...
+
+    def destination_session(self, schema: str) -> sessionmaker: ...
+
+    def close(self): ...
+
+
+class ConnectionManager:
+    """
+    Owns every tunnel and engine the pipeline opens in this process.
+
+    There is at most one ssh tunnel per host (the workspace and destination
+    databases currently live on the same box, so they share one) and one
+    pooled engine per (host, db, schema). Tunnels are only opened when the
+    database port isn't directly reachable from here.
+
+    Pool and keepalive settings are read from the optional [connection]
+    section of the config, see config_template.toml.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.settings = config.get("connection", {})
+        self._tunnels = {}
+        self._reachable = {}
+        self._engines = {}
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _engine_options(self) -> dict:
+        return {
+            "pool_size": self.settings.get("pool_size", 5),
+            "max_overflow": self.settings.get("max_overflow", 5),
+            "pool_pre_ping": self.settings.get("pool_pre_ping", True),
+            "pool_recycle": self.settings.get("pool_recycle", 1800),
+            "connect_args": {
+                "keepalives": 1,
+                "keepalives_idle": self.settings.get("keepalives_idle", 30),
+                "keepalives_interval": self.settings.get("keepalives_interval", 10),
+                "keepalives_count": self.settings.get("keepalives_count", 5),
+            },
+        }
+
+    def _is_reachable(self, host: str, port: int) -> bool:
+        """
+        Check (once per host) whether the database port answers directly,
+        in which case no tunnel is needed.
+        """
+        if not self.settings.get("probe_direct", True):
+            return False
+
+        if (host, port) not in self._reachable:
+            try:
+                with socket.create_connection(
+                    (host, port), timeout=self.settings.get("probe_timeout", 1.0)
+                ):
+                    self._reachable[(host, port)] = True
+            except OSError:
+                self._reachable[(host, port)] = False
+
+        return self._reachable[(host, port)]
+
+    def _tunnel_port(self, host: str, machine: dict) -> int:
+        tunnel = self._tunnels.get(host)
+
+        if tunnel is None:
+            tunnel = open_tunnel(
+                (host, 22),
+                ssh_username=machine["user"],
+                ssh_password=machine["password"],
+                remote_bind_address=('127.0.0.1', 5432),
+                set_keepalive=self.settings.get("ssh_keepalive", 30.0),
+            )
+            tunnel.start()
+            self._tunnels[host] = tunnel
+
+        elif not tunnel.is_active:
+            # The box dropped us; bring the tunnel back and forget any engine
+            # that was pointed at the old local port.
+            tunnel.restart()
+            self._dispose_host(host)
+
+        return tunnel.local_bind_port
+
+    def _address(self, db_config: dict, machine_key: Optional[str]) -> tuple[str, int]:
+        host = db_config["host"]
+        port = db_config.get("port", 5432)
+
+        if (machine_key is None) or self._is_reachable(host, port):
+            return host, port
+
+        return "127.0.0.1", self._tunnel_port(host, self.config[machine_key])
+
+    def _engine(
+        self,
+        db_key: str,
+        machine_key: Optional[str],
+        dbname: str,
+        schema: Optional[str] = None,
+    ) -> Engine:
+        db_config = self.config[db_key]
+        # The same database can be reached as different roles (workspace
+        # and destination credentials), each needs its own engine
+        key = (db_config["host"], dbname, db_config["user"], schema)
+
+        with self._lock:
+            # Always resolve the address so a dead tunnel gets restarted
+            address, port = self._address(db_config, machine_key)
+
+            if key not in self._engines:
+                self._engines[key] = _build_engine(
+                    address,
+                    port,
+                    dbname,
+                    db_config["user"],
+                    db_config["password"],
+                    schema=schema,
+                    **self._engine_options(),
+                )
+
+            return self._engines[key]
+
+    def _dispose_host(self, host: str):
+        for key in [key for key in self._engines if key[0] == host]:
+            self._engines.pop(key).dispose()
+
+    def workspace_engine(self) -> Engine:
+        return self._engine(
+            "workspace_db",
+            "workspace_machine",
+            self.config["workspace_db"]["dbname"],
+            self.config["workspace_db"].get("schema"),
+        )
+
+    def source_engine(self, db_name: str) -> Engine:
+        return self._engine("source_db", None, db_name)
+
+    def destination_engine(self, schema: str) -> Engine:
+        """
+        The destination engine shares one pool across schemas, the schema is
+        only applied through a schema_translate_map.
+        """
+        engine = self._engine(
+            "destination_db",
+            "destination_machine",
+            self.config["destination_db"]["dbname"],
+        )
+
+        return engine.execution_options(
+            schema_translate_map={None: "public", "census": schema}
+        )
+
+    def workspace_session(self) -> sessionmaker:
+        return sessionmaker(self.workspace_engine())
+
+    def destination_session(self, schema: str) -> sessionmaker:
+        return sessionmaker(self.destination_engine(schema))
+
+    def close(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+            for tunnel in self._tunnels.values():
+                tunnel.stop()
+            self._tunnels.clear()
+
+
+_manager: Optional[ConnectionManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_connection_manager(config: dict) -> ConnectionManager:
+    """
+    Return the process-wide connection manager, creating it on first use.
+    Its engines and tunnels are built from the first config, so asking for
+    it with a different one is an error rather than a silent mix-up.
+    """
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = ConnectionManager(config)
+            atexit.register(_manager.close)
+        elif config is not _manager.config and config != _manager.config:
+            raise ValueError(
+                "The connection manager was already created from a different config, "
+                "there's one per process."
+            )
+
+    return _manager
+
+
+def get_backend(config: dict) -> Backend:
+    """
+    The backend chosen by the optional [backend] config section, Postgres
+    through the connection manager unless kind = "local".
+    """
+    settings = config.get("backend", {})
+
+    if settings.get("kind", "postgres") == "local":
+        from .local import get_local_backend
+
+        return get_local_backend(config)
+
+    return get_connection_manager(config)
+
+
+def build_connections(
+    config: dict, destination_schema: str = "d3_present"
+) -> tuple[Callable[[str], Engine], sessionmaker, sessionmaker]:
+    """
+    Returns the source engine builder along with workspace and destination
+    sessionmakers, all backed by the process-wide connection manager.
+    """
+    manager = get_connection_manager(config)
+
+    return (
+        manager.source_engine,
+        manager.workspace_session(),
+        manager.destination_session(destination_schema),
+    )
+
+
 def sqlalch_obj_to_dict(alch_obj):
     return {
         key: getattr(alch_obj, key) for key in alch_obj.__table__.columns.keys()
@@ -1,5 +1,11 @@
-from sqlalchemy import ARRAY, TEXT
-from sqlalchemy import Integer, String, Text
+import hashlib
+import os
+import pickle
+import threading
+from pathlib import Path
+
+from sqlalchemy import ARRAY, JSON, TEXT
+from sqlalchemy import Integer, String, Text, MetaData, text
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import (
     Mapped,
@@ -13,6 +19,9 @@ from .dtypes import Indentation, CensusTableName, CensusVariableName
 ## Database table definitions
 Base = automap_base()
 
+# Text arrays on Postgres, JSON arrays on the local SQLite backend
+TextArray = ARRAY(TEXT, dimensions=1).with_variant(JSON(), "sqlite")
+
 
 class CRColumnMetadata(Base):
     __tablename__ = "census_column_metadata"
@@ -41,7 +50,7 @@ class CRTableMetadata(Base):
     subject_area: Mapped[str] = mapped_column(Text(), nullable=True)
     universe: Mapped[str] = mapped_column(Text(), nullable=True)
     denominator_column_id: Mapped[str] = mapped_column(String(16), nullable=True)
-    topics: Mapped[ARRAY[TEXT]] = mapped_column(ARRAY(TEXT, dimensions=1))
+    topics: Mapped[ARRAY[TEXT]] = mapped_column(TextArray)
     # suppression_level: Mapped[int] = mapped_column(Integer(), nullable=True)
 
     def __str__(self):
@@ -58,11 +67,11 @@ class CRTabulationMetadata(Base):
     simple_table_title: Mapped[str] = mapped_column(Text())
     subject_area: Mapped[str] = mapped_column(Text())
     universe: Mapped[str] = mapped_column(Text())
-    topics: Mapped[ARRAY[TEXT]] = mapped_column(ARRAY(TEXT, dimensions=1))
+    topics: Mapped[ARRAY[TEXT]] = mapped_column(TextArray)
     weight: Mapped[int] = mapped_column(Integer())
-    tables_in_one_yr: Mapped[ARRAY[TEXT]] = mapped_column(ARRAY(TEXT, dimensions=1))
-    tables_in_three_yr: Mapped[ARRAY[TEXT]] = mapped_column(ARRAY(TEXT, dimensions=1))
-    tables_in_five_yr: Mapped[ARRAY[TEXT]] = mapped_column(ARRAY(TEXT, dimensions=1))
+    tables_in_one_yr: Mapped[ARRAY[TEXT]] = mapped_column(TextArray)
+    tables_in_three_yr: Mapped[ARRAY[TEXT]] = mapped_column(TextArray)
+    tables_in_five_yr: Mapped[ARRAY[TEXT]] = mapped_column(TextArray)
 
     def __str__(self):
         return f"{self.tabulation_code}: {self.table_title}"
@@ -70,5 +79,112 @@ class CRTabulationMetadata(Base):
     __repr__ = __str__
 
 
-def bind_cr_tables(db: Session):
-    Base.prepare(autoload_with=db.get_bind())
+DEFAULT_REFLECTION_CACHE = ".pipeline_cache/reflection"
+
+# One round trip that changes whenever a table, column, type or constraint
+# in the schema being reflected changes.
+_CATALOG_FINGERPRINT = text("""
+    SELECT
+        current_database() AS dbname,
+        current_schema() AS schema_name,
+        md5(
+            coalesce((
+                SELECT string_agg(
+                    c.relname || '.' || a.attname || ':'
+                        || format_type(a.atttypid, a.atttypmod) || ':' || a.attnotnull::text,
+                    ',' ORDER BY c.relname, a.attnum
+                )
+                FROM pg_catalog.pg_attribute a
+                    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+                    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = current_schema()
+                    AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+                    AND a.attnum > 0
+                    AND NOT a.attisdropped
+            ), '')
+            || coalesce((
+                SELECT string_agg(
+                    c.relname || '.' || con.conname || ':' || pg_get_constraintdef(con.oid),
+                    ',' ORDER BY c.relname, con.conname
+                )
+                FROM pg_catalog.pg_constraint con
+                    JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+                    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = current_schema()
+            ), '')
+        ) AS fingerprint
+""")
+
+_bound: set[str] = set()
+_bind_lock = threading.Lock()
+
+
+def _merge_reflected(reflected: MetaData):
+    """
+    Copy the cached tables into Base.metadata the way reflection would
+    have: new tables are added and tables that are already declared above
+    only gain the columns they're missing.
+    """
+    for table in reflected.sorted_tables:
+        if table.key not in Base.metadata.tables:
+            table.to_metadata(Base.metadata)
+            continue
+
+        existing = Base.metadata.tables[table.key]
+        for column in table.columns:
+            if column.key not in existing.c:
+                existing.append_column(column._copy())
+
+
+def bind_cr_tables(db: Session, cache_dir: str | Path = DEFAULT_REFLECTION_CACHE):
+    """
+    Reflect the destination schema into the automap Base.
+
+    The reflected MetaData is pickled to cache_dir keyed by the destination
+    database, along with a fingerprint of its catalog. Later runs check the
+    fingerprint (one query) and reuse the pickle unless the schema changed.
+    Within a process each destination is only bound once.
+
+    Destinations other than Postgres (the local backend) are created from
+    the declarations above, so there's nothing to reflect.
+    """
+    with _bind_lock:
+        if db.get_bind().dialect.name != "postgresql":
+            if "declared" not in _bound:
+                Base.prepare()
+                _bound.add("declared")
+            return
+
+        catalog = db.execute(_CATALOG_FINGERPRINT).one()
+        key = hashlib.sha1(
+            f"{catalog.dbname}/{catalog.schema_name}".encode()
+        ).hexdigest()
+
+        if f"{key}:{catalog.fingerprint}" in _bound:
+            return
+
+        path = Path(cache_dir) / f"{key}.pickle"
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+            metadata = cached["metadata"] if cached["fingerprint"] == catalog.fingerprint else None
+        except Exception:
+            # Missing, truncated, or pickled by another version of the code
+            metadata = None
+
+        if metadata is not None:
+            _merge_reflected(metadata)
+            Base.prepare()
+        else:
+            Base.prepare(autoload_with=db.get_bind())
+
+            # Written aside and swapped in, so other processes never read half a file
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(temporary, "wb") as f:
+                pickle.dump(
+                    {"fingerprint": catalog.fingerprint, "metadata": Base.metadata}, f
+                )
+            os.replace(temporary, path)
+
+        _bound.add(f"{key}:{catalog.fingerprint}")
@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
+from dataclasses import asdict, is_dataclass
 from enum import Enum as _Enum, auto
-import pandas as pd
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import (
     Integer,
@@ -10,6 +10,7 @@ from sqlalchemy import (
     Table,
     Column,
     select,
+    text,
 )
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -19,8 +20,12 @@ from sqlalchemy.orm import (
     relationship,
 )
 from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.exc import SQLAlchemyError
 from .connection import sqlalch_obj_to_dict
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 ## Database table definitions
 class Base(DeclarativeBase):
@@ -103,7 +108,7 @@ class D3VariableMetadata(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     variable_name: Mapped[str] = mapped_column(String(12), unique=True)
     table_name: Mapped[str] = mapped_column(
-        ForeignKey("d3_table_metadata.table_name")
+        ForeignKey("d3_table_metadata.table_name"), index=True
     )
     indentation: Mapped[int] = mapped_column(Integer(), nullable=True)
     description: Mapped[str] = mapped_column(String(200), nullable=True)
@@ -128,7 +133,7 @@ class D3EditionMetadata(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     table_name: Mapped[str] = mapped_column(
-        ForeignKey("d3_table_metadata.table_name")
+        ForeignKey("d3_table_metadata.table_name"), index=True
     )
 
     edition: Mapped[str] = mapped_column(
@@ -146,7 +151,7 @@ class D3EditionMetadata(Base):
     table: Mapped[D3TableMetadata] = relationship(back_populates="all_editions")
 
     def __str__(self) -> str:
-        return f"{self.table.table_name} for {self.edition}"
+        return f"{self.table_name} for {self.edition}"
 
     __repr__ = __str__
 
@@ -160,7 +165,7 @@ class D3VariableGroup(Base):
 
     id: Mapped[int] = mapped_column(Integer(), primary_key=True)
     table_name: Mapped[str] = mapped_column(
-        ForeignKey("d3_table_metadata.table_name")
+        ForeignKey("d3_table_metadata.table_name"), index=True
     )
     description: Mapped[str] = mapped_column(String(100), nullable=False)
     documentation: Mapped[str] = mapped_column(Text(), nullable=True)
@@ -200,11 +205,59 @@ def bind_d3_metadata_tables(db: Session):
     Base.metadata.create_all(db.get_bind())
 
 
+# Lookups by table_name on the child tables
+_LOOKUP_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_d3_variable_metadata_table_name ON d3_variable_metadata (table_name)",
+    "CREATE INDEX IF NOT EXISTS ix_d3_edition_metadata_table_name ON d3_edition_metadata (table_name)",
+    "CREATE INDEX IF NOT EXISTS ix_d3_variable_groups_table_name ON d3_variable_groups (table_name)",
+)
+
+# Trigram indexes so the admin's substring searches (ILIKE '%...%') don't
+# scan the whole table. pg_trgm needs a role that can create extensions.
+_TRIGRAM_INDEXES = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS trgm_d3_variable_metadata_variable_name ON d3_variable_metadata USING gin (variable_name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS trgm_d3_variable_metadata_description ON d3_variable_metadata USING gin (description gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS trgm_d3_table_metadata_table_name ON d3_table_metadata USING gin (table_name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS trgm_d3_table_metadata_description ON d3_table_metadata USING gin (description gin_trgm_ops)",
+)
+
+
+def ensure_search_indexes(db: Session):
+    """
+    Create the search indexes on an existing workspace. Safe to run
+    repeatedly; tables created by bind_d3_metadata_tables already have
+    the table_name indexes.
+
+    The trigram indexes go in a transaction of their own, so a role that
+    can't create pg_trgm still gets the table_name indexes.
+    """
+    for statement in _LOOKUP_INDEXES:
+        db.execute(text(statement))
+    db.commit()
+
+    try:
+        for statement in _TRIGRAM_INDEXES:
+            db.execute(text(statement))
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        print(f"WARNING: Unable to create the trigram search indexes--{e}")
+
+
 def read_table_variables_to_dataframe(
     variables: list[D3VariableMetadata],
-) -> pd.DataFrame:
+) -> "pd.DataFrame":
+    """
+    Accepts either the ORM objects or the detached recipes from lib.recipes.
+    """
+    import pandas as pd
+
     return pd.DataFrame.from_records(
-        [sqlalch_obj_to_dict(variable) for variable in variables]
+        [
+            asdict(variable) if is_dataclass(variable) else sqlalch_obj_to_dict(variable)
+            for variable in variables
+        ]
     )
 
 
@@ -295,8 +348,6 @@ if __name__ == "__main__":
     with open(Path.cwd() / "pipeline_config.toml", "rb") as f:
         config = tomli.load(f)
 
-    _, workspace_sessionmaker, _ = build_connections(config)
-
-    WorkspaceSession = workspace_sessionmaker()
+    _, WorkspaceSession, _ = build_connections(config)
 
     Base.metadata.create_all(WorkspaceSession().get_bind())
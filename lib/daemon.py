@@ -0,0 +1,330 @@
+"""
+Long running watch mode: rebuild tables when their recipe or their raw
+source data changes.
+
+Every poll asks the workspace for one checksum per table recipe (table,
+variables and editions together) and each source database for the
+change counters of the raw tables in use. Tables whose checksum or raw
+table moved are queued and built once they've been quiet for the
+debounce period, a few at a time. Connections, tunnels and the reflected
+Census Reporter schema all stay warm between builds.
+
+If [daemon] notify_channel is set, the watcher also LISTENs on that
+channel in the workspace database and polls as soon as a notification
+arrives. See install_notify_triggers for a matching set of triggers.
+
+Progress is written to a JSON status file after every poll.
+"""
+import json
+import os
+import select as _select
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import text
+
+from .batch import BuildResult, present_jobs, run_job
+from .build import BuildError, BuildJob, resolve_edition
+from .connection import Backend
+from .recipes import TableRecipe, load_recipes
+from .sources import change_markers, raw_table_key
+
+
+DEFAULT_STATUS_PATH = ".pipeline_cache/daemon_status.json"
+
+_RECIPE_MARKERS = text("""
+    SELECT
+        t.table_name,
+        md5(
+            t::text
+            || coalesce((
+                SELECT string_agg(v::text, ',' ORDER BY v.id)
+                FROM d3_variable_metadata v
+                WHERE v.table_name = t.table_name
+            ), '')
+            || coalesce((
+                SELECT string_agg(e::text, ',' ORDER BY e.id)
+                FROM d3_edition_metadata e
+                WHERE e.table_name = t.table_name
+            ), '')
+        ) AS marker
+    FROM d3_table_metadata t
+""")
+
+_NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pipeline_notify_recipe_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify(TG_ARGV[0], TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def install_notify_triggers(engine, channel: str):
+    """
+    Have the workspace NOTIFY on `channel` whenever a recipe table changes.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(_NOTIFY_FUNCTION))
+        for table in ("d3_table_metadata", "d3_variable_metadata", "d3_edition_metadata"):
+            connection.execute(text(f"DROP TRIGGER IF EXISTS pipeline_notify ON {table}"))
+            connection.execute(
+                text(
+                    f"CREATE TRIGGER pipeline_notify AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION pipeline_notify_recipe_change('{channel}')"
+                )
+            )
+
+
+class Watcher:
+    def __init__(
+        self,
+        config: dict,
+        connections: Backend,
+        jobs: Optional[list[BuildJob]] = None,
+        checkpoints: Optional[str] = None,
+    ):
+        settings = config.get("daemon", {})
+
+        self.connections = connections
+        self.checkpoints = checkpoints
+        self.poll_seconds = settings.get("poll_seconds", 60)
+        self.debounce_seconds = settings.get("debounce_seconds", 120)
+        self.max_concurrency = settings.get("max_concurrency", 2)
+        self.notify_channel = settings.get("notify_channel") or None
+        self.status_path = Path(settings.get("status_path", DEFAULT_STATUS_PATH))
+
+        # With no explicit jobs, watch every PRESENT edition (re-read each poll)
+        self.fixed_jobs = jobs
+
+        self.jobs: dict[str, BuildJob] = {}
+        self.recipe_markers: dict[str, str] = {}
+        self.source_markers: dict[tuple, Optional[int]] = {}
+        self.recipes: dict[str, TableRecipe] = {}
+
+        # table name -> (first change seen, last change seen)
+        self.pending: dict[str, tuple[float, float]] = {}
+        self.running: dict[str, Future] = {}
+        self.results: dict[str, BuildResult] = {}
+        self.finished_at: dict[str, float] = {}
+
+        self._polled = False
+        self._listener = None
+        self._stopping = False
+
+    def _jobs(self, db) -> list[BuildJob]:
+        if self.fixed_jobs is not None:
+            return self.fixed_jobs
+        return present_jobs(db)
+
+    def _queue(self, table_name: str, now: float):
+        first, _ = self.pending.get(table_name, (now, now))
+        self.pending[table_name] = (first, now)
+
+    def poll(self):
+        """
+        Look for recipe and source changes and queue the affected tables.
+        The first poll only records where things stand.
+        """
+        now = time.time()
+        first_poll = not self._polled
+
+        WorkspaceSession = self.connections.workspace_session()
+        with WorkspaceSession() as db:
+            self.jobs = {job.table_name: job for job in self._jobs(db)}
+            markers = {
+                row.table_name: row.marker
+                for row in db.execute(_RECIPE_MARKERS)
+                if row.table_name in self.jobs
+            }
+
+            changed_recipes = [
+                table_name
+                for table_name, marker in markers.items()
+                if self.recipe_markers.get(table_name) != marker
+            ]
+            if changed_recipes or first_poll:
+                # A new dict, builds already running keep the recipes they started with
+                self.recipes = {
+                    **self.recipes,
+                    **load_recipes(db, changed_recipes if not first_poll else list(markers)),
+                }
+
+        self.recipe_markers = markers
+
+        # Which raw tables feed which watched tables
+        readers = defaultdict(list)
+        for table_name, job in self.jobs.items():
+            if table_name not in self.recipes:
+                continue
+            try:
+                key = raw_table_key(resolve_edition(self.recipes[table_name], job))
+            except BuildError:
+                continue
+            if key is not None:
+                readers[key].append(table_name)
+
+        by_database = defaultdict(list)
+        for database, schema, name in readers:
+            by_database[database].append((schema, name))
+
+        source_markers = {}
+        for database, tables in by_database.items():
+            engine = self.connections.source_engine(database)
+            for (schema, name), marker in change_markers(engine, tables).items():
+                source_markers[(database, schema, name)] = marker
+
+        if not first_poll:
+            for table_name in changed_recipes:
+                self._queue(table_name, now)
+
+            for key, marker in source_markers.items():
+                if self.source_markers.get(key) != marker:
+                    for table_name in readers[key]:
+                        self._queue(table_name, now)
+
+        self.source_markers = source_markers
+        self._polled = True
+
+    def dispatch(self, pool: ThreadPoolExecutor):
+        """
+        Start the queued builds that have been quiet for the debounce
+        period, without running the same table twice at once.
+        """
+        now = time.time()
+
+        for table_name, future in list(self.running.items()):
+            if future.done():
+                self.results[table_name] = future.result()
+                self.finished_at[table_name] = now
+                del self.running[table_name]
+
+        for table_name, (_, last_change) in sorted(self.pending.items()):
+            if len(self.running) >= self.max_concurrency:
+                break
+            if (table_name in self.running) or (now - last_change < self.debounce_seconds):
+                continue
+
+            del self.pending[table_name]
+            if table_name not in self.jobs:
+                print(f"{table_name} is no longer watched, dropping its queued rebuild.")
+                continue
+
+            print(f"Change detected, rebuilding {table_name}.")
+            recipe = self.recipes.get(table_name)
+            self.running[table_name] = pool.submit(
+                run_job,
+                self.jobs[table_name],
+                # run_job reports a missing recipe as a failed build
+                {table_name: recipe} if recipe is not None else {},
+                self.connections,
+                checkpoints=self.checkpoints,
+                update_cr_metadata=True,
+            )
+
+    def write_status(self):
+        status = {
+            "updated_at": time.time(),
+            "watching": len(self.recipe_markers),
+            "pending": {
+                table_name: {"first_change": first, "last_change": last}
+                for table_name, (first, last) in self.pending.items()
+            },
+            "running": sorted(self.running),
+            "last_builds": {
+                table_name: {
+                    "ok": result.ok,
+                    "seconds": result.seconds,
+                    "finished_at": self.finished_at[table_name],
+                    "error": result.error,
+                    "run_id": result.run_id,
+                }
+                for table_name, result in self.results.items()
+            },
+        }
+
+        self.status_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.status_path.with_name(self.status_path.name + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump(status, f, indent=2)
+        os.replace(temporary, self.status_path)
+
+    def _listen(self):
+        """
+        LISTEN on the notify channel. A failure (the workspace being
+        unreachable, say) leaves the daemon polling on its timer, and the
+        next wait tries again.
+        """
+        try:
+            listener = self.connections.workspace_engine().raw_connection()
+            listener.driver_connection.set_isolation_level(0)  # autocommit
+            with listener.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.notify_channel}")
+        except Exception as e:
+            print(f"ERROR: Unable to LISTEN on {self.notify_channel}, polling on the timer--{e}")
+            return
+        self._listener = listener
+
+    def _close_listener(self):
+        try:
+            self._listener.close()
+        except Exception:
+            pass
+        self._listener = None
+
+    def wait(self, seconds: float):
+        """
+        Sleep until the next poll, waking early on a NOTIFY if listening.
+        """
+        if self.notify_channel and self._listener is None:
+            self._listen()
+
+        if self._listener is None:
+            time.sleep(seconds)
+            return
+
+        try:
+            connection = self._listener.driver_connection
+            if _select.select([connection], [], [], seconds)[0]:
+                connection.poll()
+                connection.notifies.clear()
+        except Exception as e:
+            # A dropped connection (tunnel or server restart), listen again next time round
+            print(f"ERROR: Lost the LISTEN connection--{e}")
+            self._close_listener()
+            time.sleep(seconds)
+
+    def stop(self):
+        self._stopping = True
+
+    def run(self):
+        if self.notify_channel:
+            self._listen()
+
+        print(f"Watching for recipe and source changes every {self.poll_seconds}s.")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            while not self._stopping:
+                try:
+                    self.poll()
+                except Exception as e:
+                    # A failed poll (dropped tunnel, say) is retried next time round
+                    print(f"ERROR: Unable to poll for changes--{e}")
+
+                try:
+                    self.dispatch(pool)
+                    self.write_status()
+                except Exception as e:
+                    print(f"ERROR: Unable to dispatch builds--{e}")
+
+                # Come back sooner if something is waiting out its debounce
+                wake = self.poll_seconds
+                if self.pending:
+                    wake = min(wake, max(1, self.debounce_seconds / 4))
+                self.wait(wake)
+
+        if self._listener is not None:
+            self._close_listener()
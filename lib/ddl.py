@@ -0,0 +1,141 @@
+"""
+CREATE TABLE statements for the delivered tables, built straight from the
+recipe rather than by pushing an empty DataFrame through pandas (which
+types every column as text).
+"""
+from typing import Iterable, Optional
+
+from sqlalchemy import Column, Engine, MetaData, Numeric, Table, Text, text
+
+from .dtypes import CensusTableName, CensusVariableName
+
+
+def base_table(
+    table_name: CensusTableName,
+    variable_names: list[CensusVariableName],
+    metadata: MetaData,
+) -> Table:
+    return Table(
+        table_name,
+        metadata,
+        Column("geoid", Text(), primary_key=True),
+        *[Column(variable_name, Numeric()) for variable_name in variable_names],
+    )
+
+
+def moe_table(
+    table_name: CensusTableName,
+    variable_names: list[CensusVariableName],
+    metadata: MetaData,
+) -> Table:
+    """
+    Same column layout as lib.delivery.add_moe_columns: geoid, then every
+    value and _moe column in sorted order.
+    """
+    columns = sorted(
+        variable_names + [variable_name + "_moe" for variable_name in variable_names]
+    )
+
+    return Table(
+        table_name + "_moe",
+        metadata,
+        Column("geoid", Text(), primary_key=True),
+        *[Column(column, Numeric()) for column in columns],
+    )
+
+
+def create_hollow_tables(engine: Engine, schema: str, recipes: Iterable) -> list[str]:
+    """
+    (Re)create empty base and _moe tables for every recipe in `schema`, all
+    in one transaction, creating the schema itself if needed. Returns the
+    names of the tables created.
+    """
+    metadata = MetaData(schema=schema)
+    tables = []
+    for recipe in recipes:
+        variable_names = [variable.variable_name for variable in recipe.variables]
+        tables.append(base_table(recipe.table_name, variable_names, metadata))
+        tables.append(moe_table(recipe.table_name, variable_names, metadata))
+
+    with engine.begin() as connection:
+        # The local backend's schemas are attached database files instead
+        if engine.dialect.name == "postgresql":
+            connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+
+        for table in tables:
+            table.drop(connection, checkfirst=True)
+            table.create(connection)
+
+    return [table.name for table in tables]
+
+
+def partitioned_table(
+    table_name: str,
+    columns: list[str],
+    metadata: MetaData,
+) -> Table:
+    """
+    A table partitioned by ranges of geoid. geoid uses the "C" collation so
+    the ranges are plain byte order and every geoid of a summary level sorts
+    between the level and the next one up.
+    """
+    return Table(
+        table_name,
+        metadata,
+        Column("geoid", Text(collation="C"), primary_key=True),
+        *[Column(column, Numeric()) for column in columns if column != "geoid"],
+        postgresql_partition_by="RANGE (geoid)",
+    )
+
+
+def partition_name(table_name: str, summary_level: Optional[str]) -> str:
+    return f"{table_name}_sl{summary_level}" if summary_level is not None else f"{table_name}_default"
+
+
+def create_partitioned_table(
+    engine: Engine, schema: str, table: Table, summary_levels: Iterable[str]
+) -> dict[Optional[str], str]:
+    """
+    (Re)create `table` with a partition for each summary level, e.g.
+    b01001_sl140 for geoids from '140' up to '141', and a DEFAULT partition
+    for anything else. Returns the partition name for each level, with the
+    DEFAULT partition under None.
+    """
+    with engine.begin() as connection:
+        return create_partitions(connection, schema, table, summary_levels)
+
+
+def partition_bounds(summary_level: Optional[str]) -> str:
+    """
+    The FOR VALUES clause of a summary level's partition, DEFAULT for None.
+    """
+    if summary_level is None:
+        return "DEFAULT"
+
+    upper = summary_level[:-1] + chr(ord(summary_level[-1]) + 1)
+    return "FOR VALUES FROM ('{}') TO ('{}')".format(
+        summary_level.replace("'", "''"), upper.replace("'", "''")
+    )
+
+
+def create_partitions(
+    connection, schema: str, table: Table, summary_levels: Iterable[str]
+) -> dict[Optional[str], str]:
+    """
+    create_partitioned_table inside an open transaction.
+    """
+    partitions = {level: partition_name(table.name, level) for level in sorted(summary_levels)}
+    partitions[None] = partition_name(table.name, None)
+
+    parent = f'"{schema}"."{table.name}"'
+
+    connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+    table.drop(connection, checkfirst=True)
+    table.create(connection)
+
+    for level, name in partitions.items():
+        connection.execute(
+            text(f'CREATE TABLE "{schema}"."{name}" PARTITION OF {parent} {partition_bounds(level)}')
+        )
+
+    return partitions
@@ -1,6 +1,11 @@
-from sqlalchemy import Engine
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from sqlalchemy import Engine, MetaData, text
 import pandas as pd
 
+from .instrumentation import observe
+
 """
 This is missing (as is the pipeline generally) logic to handle if you 
 actually have a table with meaningful '_moe' columns.
@@ -8,12 +13,19 @@ actually have a table with meaningful '_moe' columns.
 
 
 def add_moe_columns(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    value_columns = [col for col in df.columns if col != "geoid"]
-    for col in value_columns:
-        df[col + "_moe"] = None
+    from .columnar import shared_nulls
 
-    return df[["geoid"] + [col for col in sorted(df.columns) if col != "geoid"]]
+    # The value columns are referenced, not copied, and every _moe column
+    # points at the same all-null array
+    nulls = shared_nulls(len(df))
+    columns = {col: df[col] for col in df.columns}
+    for col in [col for col in df.columns if col != "geoid"]:
+        columns[col + "_moe"] = pd.Series(nulls, index=df.index, copy=False)
+
+    return pd.DataFrame(
+        {col: columns[col] for col in ["geoid"] + [col for col in sorted(columns) if col != "geoid"]},
+        copy=False,
+    )
 
 
 def push_moe_table(
@@ -25,6 +37,7 @@ def push_moe_table(
     table.to_sql(
         table_name + "_moe", engine, schema=schema, if_exists="replace", index=False
     )
+    observe(table)
 
 
 # This one needs to change to create a view
@@ -32,6 +45,147 @@ def push_base_table(
     table: pd.DataFrame, table_name: str, engine: Engine, schema: str = "d3_present"
 ) -> None:
     table.to_sql(table_name, engine, schema=schema, if_exists="replace", index=False)
+    observe(table)
+
+
+def push_partitioned_table(
+    table: pd.DataFrame,
+    table_name: str,
+    engine: Engine,
+    schema: str = "d3_present",
+    workers: int = 4,
+) -> dict[str, int]:
+    """
+    Deliver `table` as a Postgres table partitioned by summary level (the
+    geoid prefix), loading each level straight into its partition from
+    `workers` threads. Returns the rows loaded per partition.
+    """
+    from .ddl import create_partitioned_table, partitioned_table
+    from .geography import summary_levels
+
+    levels = summary_levels(table["geoid"])
+    partitions = create_partitioned_table(
+        engine,
+        schema,
+        partitioned_table(table_name, list(table.columns), MetaData(schema=schema)),
+        levels.unique(),
+    )
+
+    def load(level, rows):
+        rows.to_sql(partitions[level], engine, schema=schema, if_exists="append", index=False)
+        return partitions[level], len(rows)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        loaded = dict(pool.map(lambda group: load(*group), table.groupby(levels.to_numpy(), sort=False)))
+
+    observe(table)
+
+    return loaded
+
+
+def partitions_scanned(engine: Engine, schema: str, table_name: str, geoid: str) -> list[str]:
+    """
+    The partitions Postgres plans to read for a single geoid lookup, from
+    EXPLAIN. With pruning working this is just the geoid's summary level.
+    """
+    with engine.connect() as connection:
+        plan = connection.execute(
+            text(f'EXPLAIN (FORMAT JSON) SELECT * FROM "{schema}"."{table_name}" WHERE geoid = :geoid'),
+            {"geoid": geoid},
+        ).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    def relations(node):
+        if "Relation Name" in node:
+            yield node["Relation Name"]
+        for child in node.get("Plans", ()):
+            yield from relations(child)
+
+    return sorted(set(relations(plan[0]["Plan"])))
+
+
+def check_partition_pruning(
+    engine: Engine, schema: str, table_name: str, geoids: list[str]
+) -> dict[str, list[str]]:
+    """
+    The lookups among `geoids` that would read more than one partition,
+    with the partitions they'd read.
+    """
+    scanned = {geoid: partitions_scanned(engine, schema, table_name, geoid) for geoid in geoids}
+    return {geoid: partitions for geoid, partitions in scanned.items() if len(partitions) > 1}
+
+
+def _recreate_like(connection, from_schema: str, to_schema: str, table_name: str):
+    from .ddl import create_partitions, partitioned_table
+
+    source = f'"{from_schema}"."{table_name}"'
+    target = f'"{to_schema}"."{table_name}"'
+
+    partitions = connection.execute(
+        text("""
+            SELECT child.relname
+            FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = CAST(:source AS regclass)
+        """),
+        {"source": source},
+    ).scalars().all()
+
+    connection.execute(text(f"DROP TABLE IF EXISTS {target}"))
+
+    if not partitions:
+        connection.execute(text(f"CREATE TABLE {target} (LIKE {source} INCLUDING ALL)"))
+        return
+
+    # Partitions are named <table>_sl<summary level> (see lib.ddl.partition_name)
+    prefix = table_name + "_sl"
+    levels = [name[len(prefix):] for name in partitions if name.startswith(prefix)]
+    columns = connection.execute(
+        text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table
+            ORDER BY ordinal_position
+        """),
+        {"schema": from_schema, "table": table_name},
+    ).scalars().all()
+
+    create_partitions(
+        connection, to_schema, partitioned_table(table_name, list(columns), MetaData(schema=to_schema)), levels
+    )
+
+
+def copy_tables(
+    from_engine: Engine,
+    to_engine: Engine,
+    from_schema: str,
+    to_schema: str,
+    table_names: list[str],
+) -> None:
+    """
+    Replace `to_schema`'s copies of the tables with `from_schema`'s. On
+    Postgres every schema is in the one destination database, so each table
+    is recreated like its source and filled with INSERT ... SELECT, all in
+    a single transaction, and no rows leave the server. Tables delivered
+    partitioned by summary level (see push_partitioned_table) keep their
+    partitions, flat tables their primary key.
+    """
+    if to_engine.dialect.name == "postgresql":
+        with to_engine.begin() as connection:
+            connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{to_schema}"'))
+            for table_name in table_names:
+                _recreate_like(connection, from_schema, to_schema, table_name)
+                connection.execute(
+                    text(f'INSERT INTO "{to_schema}"."{table_name}" SELECT * FROM "{from_schema}"."{table_name}"')
+                )
+        return
+
+    # The local backend keeps each schema in its own file
+    for table_name in table_names:
+        table = pd.read_sql(text(f'SELECT * FROM "{from_schema}"."{table_name}"'), from_engine)
+        table.to_sql(table_name, to_engine, schema=to_schema, if_exists="replace", index=False)
+        observe(table)
 
 
 # Options no moe
@@ -0,0 +1,22 @@
+"""
+Helpers for Census Reporter style geoids, e.g. '14000US26163520100' is the
+tract 26163520100 and its summary level is '140'.
+"""
+import pandas as pd
+
+
+SUMMARY_LEVEL_LENGTH = 3
+
+
+def summary_level(geoid: str) -> str:
+    """
+    The summary level a geoid belongs to, e.g. '140' for tracts.
+    """
+    return geoid[:SUMMARY_LEVEL_LENGTH]
+
+
+def summary_levels(geoids: pd.Series) -> pd.Series:
+    """
+    summary_level for a whole column of geoids.
+    """
+    return geoids.astype(str).str[:SUMMARY_LEVEL_LENGTH]
@@ -0,0 +1,297 @@
+"""
+Timing, memory and throughput measurements for table builds.
+
+A RunReport collects one record per table build. Inside a build, code
+marks its stages with `stage(name)` and reports the data it handled with
+`observe(...)`. Both are no-ops when no build is being recorded, so the
+library functions can call them unconditionally.
+
+The report is written as JSON and, optionally, as a Prometheus textfile
+for the node exporter so nightly runs can be compared over time.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+@dataclass
+class StageRecord:
+    """
+    ru_maxrss only ever grows over the life of the process, so it can't
+    give a stage's own peak. `process_peak_rss_bytes` is the process' peak
+    when the stage ended, and `peak_rss_growth_bytes` how much the stage
+    raised it (0 for every stage after the biggest one in a batch).
+    """
+    name: str
+    seconds: float = 0.0
+    process_peak_rss_bytes: Optional[int] = None
+    peak_rss_growth_bytes: Optional[int] = None
+    tracemalloc_peak_bytes: Optional[int] = None
+    rows: int = 0
+    columns: int = 0
+    bytes: int = 0
+    stages: list["StageRecord"] = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        if not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+    def to_dict(self) -> dict:
+        record = asdict(self)
+        record["rows_per_second"] = self.rows_per_second
+        record["stages"] = [stage.to_dict() for stage in self.stages]
+        return record
+
+
+@dataclass
+class BuildRecord:
+    table_name: str
+    destination_schema: str
+    ok: bool = True
+    seconds: float = 0.0
+    stages: list[StageRecord] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "table_name": self.table_name,
+            "destination_schema": self.destination_schema,
+            "ok": self.ok,
+            "seconds": self.seconds,
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+
+
+# The stage currently open in this thread, and the list new stages go into
+_current_stage: ContextVar[Optional[StageRecord]] = ContextVar("current_stage", default=None)
+_current_stages: ContextVar[Optional[list]] = ContextVar("current_stages", default=None)
+
+# Builds being recorded right now, across threads. tracemalloc's peak is
+# process-wide, so per-stage peaks only mean something while there's one.
+_open_builds = 0
+_builds_opened = 0
+_open_builds_lock = threading.Lock()
+
+
+def _alone_since(opened: int) -> bool:
+    """
+    Whether this is the only build being recorded, and no other has started
+    since `opened` builds had been.
+    """
+    return _open_builds == 1 and _builds_opened == opened
+
+
+def _peak_rss() -> Optional[int]:
+    """
+    The process' high-water mark for resident memory, where the platform
+    reports one.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a stage of the current build. Stages opened inside another stage
+    are recorded as its sub-stages.
+    """
+    stages = _current_stages.get()
+
+    if stages is None:
+        yield None
+        return
+
+    record = StageRecord(name)
+    stages.append(record)
+
+    parent = _current_stage.get()
+    # Resetting the peak under other builds' feet would skew theirs, so
+    # concurrent builds (batch workers) leave tracemalloc_peak_bytes empty
+    opened = _builds_opened
+    tracing = tracemalloc.is_tracing() and _alone_since(opened)
+    if tracing:
+        # Fold the parent's peak so far into the parent before resetting
+        if parent is not None:
+            parent.tracemalloc_peak_bytes = max(
+                parent.tracemalloc_peak_bytes or 0, tracemalloc.get_traced_memory()[1]
+            )
+        tracemalloc.reset_peak()
+
+    stage_token = _current_stage.set(record)
+    stages_token = _current_stages.set(record.stages)
+    rss_before = _peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.process_peak_rss_bytes = _peak_rss()
+        if rss_before is not None:
+            record.peak_rss_growth_bytes = record.process_peak_rss_bytes - rss_before
+        if tracing and _alone_since(opened):
+            record.tracemalloc_peak_bytes = max(
+                record.tracemalloc_peak_bytes or 0, tracemalloc.get_traced_memory()[1]
+            )
+            if parent is not None:
+                parent.tracemalloc_peak_bytes = max(
+                    parent.tracemalloc_peak_bytes or 0, record.tracemalloc_peak_bytes
+                )
+
+        _current_stages.reset(stages_token)
+        _current_stage.reset(stage_token)
+
+
+def observe(
+    frame: Optional["pd.DataFrame"] = None,
+    rows: int = 0,
+    columns: int = 0,
+    bytes: int = 0,
+):
+    """
+    Add the size of the data handled to the current stage. With a frame,
+    rows, columns and (in memory) bytes are taken from it.
+    """
+    record = _current_stage.get()
+
+    if record is None:
+        return
+
+    if frame is not None:
+        rows, columns = frame.shape
+        bytes = int(frame.memory_usage(deep=True).sum())
+
+    record.rows += rows
+    record.columns = max(record.columns, columns)
+    record.bytes += bytes
+
+
+class RunReport:
+    def __init__(self, trace_memory: bool = False):
+        self.started_at = time.time()
+        self.builds: list[BuildRecord] = []
+        self._lock = threading.Lock()
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def build(self, table_name: str, destination_schema: str):
+        """
+        Record a table build. Any stage() opened within (in this thread)
+        is attached to it.
+        """
+        global _open_builds, _builds_opened
+
+        record = BuildRecord(table_name, destination_schema)
+        with self._lock:
+            self.builds.append(record)
+        with _open_builds_lock:
+            _open_builds += 1
+            _builds_opened += 1
+
+        token = _current_stages.set(record.stages)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record.ok = False
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            _current_stages.reset(token)
+            with _open_builds_lock:
+                _open_builds -= 1
+
+    def to_dict(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "process_peak_rss_bytes": _peak_rss(),
+            "builds": [build.to_dict() for build in self.builds],
+        }
+
+    def write_json(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, path: str | Path):
+        """
+        Write the report in the Prometheus text format. The file is written
+        next to its target and renamed so the node exporter never reads a
+        partial file.
+        """
+        metrics = {
+            "pipeline_build_seconds": ("Wall time of a table build.", []),
+            "pipeline_build_success": ("1 if the table build succeeded.", []),
+            "pipeline_stage_seconds": ("Wall time of a build stage.", []),
+            "pipeline_stage_rows": ("Rows handled by a build stage.", []),
+            "pipeline_stage_bytes": ("Bytes handled by a build stage.", []),
+            "pipeline_stage_rows_per_second": ("Rows per second through a build stage.", []),
+            "pipeline_stage_process_peak_rss_bytes": (
+                "Peak RSS of the whole process so far, at the end of a build stage.",
+                [],
+            ),
+            "pipeline_stage_peak_rss_growth_bytes": ("How much a build stage raised the process peak RSS.", []),
+        }
+
+        for build in self.builds:
+            labels = f'table="{build.table_name}",schema="{build.destination_schema}"'
+            metrics["pipeline_build_seconds"][1].append(f"{{{labels}}} {build.seconds}")
+            metrics["pipeline_build_success"][1].append(f"{{{labels}}} {int(build.ok)}")
+
+            def add_stages(stages, prefix=""):
+                for record in stages:
+                    name = f"{prefix}{record.name}"
+                    stage_labels = f'{{{labels},stage="{name}"}}'
+                    metrics["pipeline_stage_seconds"][1].append(f"{stage_labels} {record.seconds}")
+                    metrics["pipeline_stage_rows"][1].append(f"{stage_labels} {record.rows}")
+                    metrics["pipeline_stage_bytes"][1].append(f"{stage_labels} {record.bytes}")
+                    if record.rows_per_second is not None:
+                        metrics["pipeline_stage_rows_per_second"][1].append(
+                            f"{stage_labels} {record.rows_per_second}"
+                        )
+                    if record.process_peak_rss_bytes is not None:
+                        metrics["pipeline_stage_process_peak_rss_bytes"][1].append(
+                            f"{stage_labels} {record.process_peak_rss_bytes}"
+                        )
+                    if record.peak_rss_growth_bytes is not None:
+                        metrics["pipeline_stage_peak_rss_growth_bytes"][1].append(
+                            f"{stage_labels} {record.peak_rss_growth_bytes}"
+                        )
+                    add_stages(record.stages, prefix=f"{name}.")
+
+            add_stages(build.stages)
+
+        lines = []
+        for metric, (description, samples) in metrics.items():
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(f"{metric}{sample}" for sample in samples)
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(path.name + ".tmp")
+        with open(temporary, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
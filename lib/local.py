@@ -0,0 +1,155 @@
+"""
+A backend that keeps the workspace, source and destination databases in
+SQLite files, so whole builds can run on a laptop or in CI without any of
+the servers.
+
+Everything lives under one directory:
+
+    workspace.sqlite                 the recipe tables (lib.d3models)
+    source/<db>/<schema>.sqlite      raw tables, attached as <schema>
+    destination/<schema>.sqlite      delivered tables and the Census
+                                     Reporter column/table metadata
+    destination/public.sqlite        Census Reporter tabulation metadata
+
+Attaching each schema's file under the schema's name means the same
+schema-qualified names (shp.blockgeom2geoids20, d3_present.b01001, ...)
+work as they do on Postgres. Source geometries are stored as WKB blobs and
+ST_AsBinary is registered as a no-op, so the strtree aggregation backend
+can read them; sources keyed by geoid use the "geoid" backend.
+"""
+import atexit
+import threading
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from .crmodels import CRColumnMetadata, CRTableMetadata, CRTabulationMetadata
+from .d3models import Base as D3Base
+
+
+DEFAULT_LOCAL_DIRECTORY = ".pipeline_cache/local"
+
+
+def _attach_on_connect(engine: Engine, databases: dict[str, Path]):
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.create_function("ST_AsBinary", 1, lambda geometry: geometry, deterministic=True)
+        for schema, path in databases.items():
+            dbapi_connection.execute(f"ATTACH DATABASE '{path}' AS \"{schema}\"")
+
+
+class LocalBackend:
+    def __init__(self, config: dict, directory: str | Path = DEFAULT_LOCAL_DIRECTORY):
+        self.config = config
+        self.directory = Path(directory)
+        self._engines = {}
+        self._lock = threading.RLock()
+
+        for subdirectory in ("source", "destination"):
+            (self.directory / subdirectory).mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "LocalBackend":
+        return cls(config, config.get("backend", {}).get("directory", DEFAULT_LOCAL_DIRECTORY))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _engine(self, key: tuple, main: Optional[Path], attached: dict[str, Path]) -> Engine:
+        with self._lock:
+            if key not in self._engines:
+                engine = create_engine(
+                    f"sqlite:///{main}" if main else "sqlite://",
+                    # Batch builds use the engines from worker threads
+                    connect_args={"check_same_thread": False},
+                )
+                _attach_on_connect(engine, attached)
+                self._engines[key] = engine
+
+            return self._engines[key]
+
+    def workspace_engine(self) -> Engine:
+        with self._lock:
+            created = ("workspace",) in self._engines
+            engine = self._engine(("workspace",), self.directory / "workspace.sqlite", {})
+            if not created:
+                D3Base.metadata.create_all(engine)
+
+            return engine
+
+    def source_engine(self, db_name: str) -> Engine:
+        """
+        Every <schema>.sqlite in source/<db_name> is attached, as it is when
+        the engine is created.
+        """
+        source = self.directory / "source" / db_name
+        source.mkdir(parents=True, exist_ok=True)
+
+        return self._engine(
+            ("source", db_name),
+            None,
+            {path.stem: path for path in sorted(source.glob("*.sqlite"))},
+        )
+
+    def destination_engine(self, schema: str) -> Engine:
+        """
+        Same schema_translate_map as the Postgres destination, with the
+        schema and public attached as files. The Census Reporter metadata
+        tables are created on first use.
+        """
+        destination = self.directory / "destination"
+
+        with self._lock:
+            created = ("destination", schema) in self._engines
+            engine = self._engine(
+                ("destination", schema),
+                None,
+                {schema: destination / f"{schema}.sqlite", "public": destination / "public.sqlite"},
+            ).execution_options(schema_translate_map={None: "public", "census": schema})
+
+            if not created:
+                CRColumnMetadata.metadata.create_all(
+                    engine,
+                    tables=[
+                        CRColumnMetadata.__table__,
+                        CRTableMetadata.__table__,
+                        CRTabulationMetadata.__table__,
+                    ],
+                )
+
+            return engine
+
+    def workspace_session(self) -> sessionmaker:
+        return sessionmaker(self.workspace_engine())
+
+    def destination_session(self, schema: str) -> sessionmaker:
+        return sessionmaker(self.destination_engine(schema))
+
+    def close(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+_backend: Optional[LocalBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_local_backend(config: dict) -> LocalBackend:
+    """
+    Return the process-wide local backend, creating it on first use.
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            _backend = LocalBackend.from_config(config)
+            atexit.register(_backend.close)
+
+    return _backend
@@ -2,10 +2,14 @@
 Translation functions between the D3 metadata schema and the Census 
 Reporter metadata schema.
 """
+from typing import Iterable
+
+from sqlalchemy import literal_column, or_, select
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert as posgres_upsert
+from sqlalchemy.dialects.sqlite import insert as sqlite_upsert
 
-from .connection import sqlalch_obj_to_dict
+from .instrumentation import observe, stage
 from .d3models import D3TableMetadata, D3VariableMetadata
 from .crmodels import (
     CRColumnMetadata,
@@ -73,44 +77,168 @@ def create_tabulation_metadata_insert(
     )
 
 
-def update_metadata(
-    db: Session,
-    table_metadata: D3TableMetadata,
-    variable_metadata: list[D3VariableMetadata],
-):
-    bind_cr_tables(db)
+# Only these columns are written, so anything else on the Census Reporter
+# tables (picked up by reflection) is left alone by the updates below.
+TABLE_COLUMNS = (
+    "table_id",
+    "table_title",
+    "simple_table_title",
+    "subject_area",
+    "universe",
+    "denominator_column_id",
+    "topics",
+)
+COLUMN_COLUMNS = (
+    "column_id",
+    "line_number",
+    "indent",
+    "table_id",
+    "column_title",
+    "parent_column_id",
+)
+TABULATION_COLUMNS = (
+    "tabulation_code",
+    "table_title",
+    "simple_table_title",
+    "subject_area",
+    "universe",
+    "topics",
+    "weight",
+    "tables_in_one_yr",
+    "tables_in_three_yr",
+    "tables_in_five_yr",
+)
 
-    destination_table_metadata = create_table_metadata_insert(table_metadata)
-    destination_variable_metadata = create_variable_metadata_insert(variable_metadata)
-    destination_tabulation_metadata = create_tabulation_metadata_insert(table_metadata)
+UPSERT_CHUNK_SIZE = 1000
 
-    table_stmt = (
-        posgres_upsert(CRTableMetadata)
-            .values([sqlalch_obj_to_dict(destination_table_metadata)])
-            .on_conflict_do_nothing(
-                index_elements=["table_id"]
-            )
-    )
 
-    variable_stmt = (
-        posgres_upsert(CRColumnMetadata)
-            .values([sqlalch_obj_to_dict(variable) for variable in destination_variable_metadata])
-            .on_conflict_do_nothing(
-                index_elements=["column_id"]
-            )
-    )
+def _as_row(cr_obj, columns: tuple[str, ...]) -> dict:
+    return {column: getattr(cr_obj, column) for column in columns}
 
-    tabulation_stmt = (
-        posgres_upsert(CRTabulationMetadata)
-            .values([sqlalch_obj_to_dict(destination_tabulation_metadata)])
-            .on_conflict_do_nothing(
-                index_elements=["tabulation_code"]
-            )
+
+def _changed_rows(
+    db: Session, model, columns: tuple[str, ...], rows: list[dict]
+) -> tuple[list[dict], set]:
+    """
+    Compare the wanted rows against what's already on the destination (one
+    query for all of them) and keep only the new or different ones. Also
+    returns the keys that already exist.
+    """
+    key = columns[0]
+    wanted = {row[key]: row for row in rows}  # Last one wins on duplicate keys
+
+    if not wanted:
+        return [], set()
+
+    table = model.__table__
+    stmt = select(*[table.c[column] for column in columns]).where(
+        table.c[key].in_(list(wanted))
     )
+    existing = {row[key]: dict(row) for row in db.execute(stmt).mappings()}
+
+    return [row for k, row in wanted.items() if existing.get(k) != row], set(existing)
+
+
+def _upsert_changed(
+    db: Session, model, columns: tuple[str, ...], rows: list[dict], existing: set = frozenset()
+) -> tuple[int, int]:
+    """
+    Multi-row upsert that only touches rows whose values actually differ.
+    Returns the number of (inserted, updated) rows.
+
+    SQLite (the local backend) has no xmax to tell inserts from updates,
+    so there the counts come from the keys that already existed.
+    """
+    key = columns[0]
+    table = model.__table__
+    inserted = updated = 0
+
+    if db.get_bind().dialect.name == "sqlite":
+        for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            stmt = sqlite_upsert(table).values(rows[start : start + UPSERT_CHUNK_SIZE])
+            db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[key],
+                    set_={column: stmt.excluded[column] for column in columns[1:]},
+                )
+            )
+
+        inserted = sum(1 for row in rows if row[key] not in existing)
+        return inserted, len(rows) - inserted
+
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        stmt = posgres_upsert(table).values(rows[start : start + UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[key],
+            set_={column: stmt.excluded[column] for column in columns[1:]},
+            where=or_(
+                *[
+                    table.c[column].is_distinct_from(stmt.excluded[column])
+                    for column in columns[1:]
+                ]
+            ),
+        ).returning(literal_column("(xmax = 0)").label("inserted"))
 
-    db.execute(table_stmt)
-    db.execute(variable_stmt)
+        for (was_inserted,) in db.execute(stmt):
+            if was_inserted:
+                inserted += 1
+            else:
+                updated += 1
 
-    db.execute(tabulation_stmt)
+    return inserted, updated
+
+
+def _sync_metadata(
+    db: Session,
+    tables: Iterable[tuple[D3TableMetadata, list[D3VariableMetadata]]],
+) -> dict[str, tuple[int, int]]:
+    bind_cr_tables(db)
+
+    table_rows, column_rows, tabulation_rows = [], [], []
+    for table_metadata, variable_metadata in tables:
+        table_rows.append(
+            _as_row(create_table_metadata_insert(table_metadata), TABLE_COLUMNS)
+        )
+        column_rows.extend(
+            _as_row(column, COLUMN_COLUMNS)
+            for column in create_variable_metadata_insert(variable_metadata)
+        )
+        tabulation_rows.append(
+            _as_row(create_tabulation_metadata_insert(table_metadata), TABULATION_COLUMNS)
+        )
+
+    summary = {}
+    for model, columns, rows in (
+        (CRTableMetadata, TABLE_COLUMNS, table_rows),
+        (CRColumnMetadata, COLUMN_COLUMNS, column_rows),
+        (CRTabulationMetadata, TABULATION_COLUMNS, tabulation_rows),
+    ):
+        with stage(model.__tablename__):
+            changed, existing = _changed_rows(db, model, columns, rows)
+            summary[model.__tablename__] = _upsert_changed(db, model, columns, changed, existing)
+            observe(rows=len(changed), columns=len(columns))
 
     db.commit()
+
+    return summary
+
+
+def sync_metadata(db: Session, recipes: Iterable) -> dict[str, tuple[int, int]]:
+    """
+    Bring the Census Reporter metadata for many tables in line with their
+    D3 recipes (lib.recipes.TableRecipe) in a single transaction. Edited
+    titles, indentations etc. are updated, unchanged rows aren't touched.
+
+    Returns (inserted, updated) counts for each Census Reporter table.
+    """
+    return _sync_metadata(
+        db, [(recipe, list(recipe.variables)) for recipe in recipes]
+    )
+
+
+def update_metadata(
+    db: Session,
+    table_metadata: D3TableMetadata,
+    variable_metadata: list[D3VariableMetadata],
+) -> dict[str, tuple[int, int]]:
+    return _sync_metadata(db, [(table_metadata, variable_metadata)])
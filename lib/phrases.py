@@ -0,0 +1,621 @@
+"""
+A parser for the common shapes of sql_aggregation_phrase, so they can be
+evaluated outside the database.
+
+Supported phrases are count or sum aggregates, optionally filtered, over
+columns of the source table:
+
+    count(*)
+    count(aa.parcel_id)
+    sum(aa.units)
+    sum(aa.units) FILTER (WHERE aa.land_use = 'residential')
+    count(*) FILTER (WHERE aa.year_built < 1940 AND aa.vacant)
+    sum(CASE WHEN aa.owner_occupied THEN aa.units ELSE 0 END)
+    count(CASE WHEN aa.sale_price > 100000 THEN 1 END)
+
+Conditions can use comparisons, IN, BETWEEN, LIKE/ILIKE, IS [NOT] NULL,
+AND/OR/NOT and parentheses, with SQL's three-valued logic for NULLs. Values
+can be columns, literals, simple arithmetic and ::casts. Anything else
+(other functions, DISTINCT, subqueries) raises UnsupportedPhraseError, and
+the phrase has to run on the database.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+
+class UnsupportedPhraseError(Exception):
+    pass
+
+
+class DivisionByZeroError(Exception):
+    pass
+
+
+_TOKEN = re.compile(
+    r"""
+    \s*(?:
+        (?P<number>\d+\.\d*|\.\d+|\d+)
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*|"[^"]+")
+      | (?P<symbol><=|>=|<>|!=|::|[=<>(),*+\-/])
+    )
+    """,
+    re.VERBOSE,
+)
+
+KEYWORDS = {
+    "and", "or", "not", "in", "is", "null", "between", "like", "ilike",
+    "case", "when", "then", "else", "end", "filter", "where", "distinct",
+    "true", "false",
+}
+
+NUMERIC_CASTS = {"int", "integer", "bigint", "smallint", "numeric", "float", "real", "decimal"}
+TEXT_CASTS = {"text", "varchar"}
+
+
+def tokenize(phrase: str) -> list[tuple[str, Any]]:
+    tokens = []
+    position = 0
+    phrase = phrase.strip()
+
+    while position < len(phrase):
+        match = _TOKEN.match(phrase, position)
+        if match is None or match.end() == position:
+            raise UnsupportedPhraseError(f"Can't read '{phrase[position:]}' in '{phrase}'.")
+        position = match.end()
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("literal", float(value) if "." in value else int(value)))
+        elif kind == "string":
+            tokens.append(("literal", value[1:-1].replace("''", "'")))
+        elif kind == "name" and value.startswith('"'):
+            tokens.append(("column", value[1:-1]))
+        elif kind == "name" and value.lower() in KEYWORDS:
+            tokens.append(("keyword", value.lower()))
+        elif kind == "name":
+            tokens.append(("name", value.lower()))
+        else:
+            tokens.append(("symbol", value))
+
+    return tokens
+
+
+## Expression tree
+
+@dataclass(frozen=True)
+class Literal:
+    value: Any
+
+
+@dataclass(frozen=True)
+class ColumnRef:
+    """
+    `table` is the alias the phrase used, if any (aa in aa.units).
+    """
+    name: str
+    table: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class Cast:
+    operand: Any
+    type_name: str
+
+
+@dataclass(frozen=True)
+class Arithmetic:
+    operator: str
+    left: Any
+    right: Any
+
+
+@dataclass(frozen=True)
+class Case:
+    branches: tuple[tuple[Any, Any], ...]
+    otherwise: Any = None
+
+
+@dataclass(frozen=True)
+class Comparison:
+    operator: str
+    left: Any
+    right: Any
+
+
+@dataclass(frozen=True)
+class InList:
+    operand: Any
+    options: tuple
+    negated: bool = False
+
+
+@dataclass(frozen=True)
+class IsNull:
+    operand: Any
+    negated: bool = False
+
+
+@dataclass(frozen=True)
+class Like:
+    operand: Any
+    pattern: str
+    case_sensitive: bool = True
+    negated: bool = False
+
+
+@dataclass(frozen=True)
+class BoolOp:
+    operator: str
+    operands: tuple
+
+
+@dataclass(frozen=True)
+class Not:
+    operand: Any
+
+
+@dataclass(frozen=True)
+class Aggregate:
+    """
+    A parsed phrase. `argument` is None for count(*).
+    """
+    function: str
+    argument: Any = None
+    where: Any = None
+    columns: frozenset = field(default=frozenset(), compare=False)
+
+
+class _Parser:
+    def __init__(self, phrase: str):
+        self.phrase = phrase
+        self.tokens = tokenize(phrase)
+        self.position = 0
+        self.columns = set()
+
+    def peek(self, offset: int = 0) -> tuple[str, Any]:
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return ("end", None)
+
+    def accept(self, kind: str, value: Any = None) -> bool:
+        token_kind, token_value = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, kind: str, value: Any = None) -> Any:
+        token = self.peek()
+        if not self.accept(kind, value):
+            raise UnsupportedPhraseError(
+                f"Expected {value or kind} but found '{token[1]}' in '{self.phrase}'."
+            )
+        return token[1]
+
+    def aggregate(self) -> Aggregate:
+        function = self.expect("name")
+        if function not in ("count", "sum"):
+            raise UnsupportedPhraseError(f"Only count and sum can run outside the database, not '{function}'.")
+
+        self.expect("symbol", "(")
+        if self.accept("keyword", "distinct"):
+            raise UnsupportedPhraseError("DISTINCT aggregates can't run outside the database.")
+
+        if function == "count" and self.accept("symbol", "*"):
+            argument = None
+        else:
+            argument = self.value()
+        self.expect("symbol", ")")
+
+        where = None
+        if self.accept("keyword", "filter"):
+            self.expect("symbol", "(")
+            self.expect("keyword", "where")
+            where = self.condition()
+            self.expect("symbol", ")")
+
+        if self.peek()[0] != "end":
+            raise UnsupportedPhraseError(f"Unexpected '{self.peek()[1]}' in '{self.phrase}'.")
+
+        return Aggregate(function, argument, where, frozenset(self.columns))
+
+    # Conditions, lowest precedence first
+    def condition(self):
+        operands = [self.conjunction()]
+        while self.accept("keyword", "or"):
+            operands.append(self.conjunction())
+        return operands[0] if len(operands) == 1 else BoolOp("or", tuple(operands))
+
+    def conjunction(self):
+        operands = [self.negation()]
+        while self.accept("keyword", "and"):
+            operands.append(self.negation())
+        return operands[0] if len(operands) == 1 else BoolOp("and", tuple(operands))
+
+    def negation(self):
+        if self.accept("keyword", "not"):
+            return Not(self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        if self.peek() == ("symbol", "("):
+            # Either a parenthesised condition or a value, try the condition first
+            start = self.position
+            try:
+                self.position += 1
+                inner = self.condition()
+                self.expect("symbol", ")")
+                if not self._continues_value():
+                    return inner
+            except UnsupportedPhraseError:
+                pass
+            self.position = start
+
+        left = self.value()
+        negated = self.accept("keyword", "not")
+
+        if self.accept("keyword", "in"):
+            self.expect("symbol", "(")
+            options = [self.value()]
+            while self.accept("symbol", ","):
+                options.append(self.value())
+            self.expect("symbol", ")")
+            if not all(isinstance(option, Literal) for option in options):
+                raise UnsupportedPhraseError("IN lists must be literals to run outside the database.")
+            return InList(left, tuple(option.value for option in options), negated)
+
+        if self.accept("keyword", "between"):
+            low = self.value()
+            self.expect("keyword", "and")
+            high = self.value()
+            between = BoolOp("and", (Comparison(">=", left, low), Comparison("<=", left, high)))
+            return Not(between) if negated else between
+
+        for keyword in ("like", "ilike"):
+            if self.accept("keyword", keyword):
+                pattern = self.value()
+                if not isinstance(pattern, Literal):
+                    raise UnsupportedPhraseError("LIKE patterns must be literals to run outside the database.")
+                return Like(left, pattern.value, keyword == "like", negated)
+
+        if negated:
+            raise UnsupportedPhraseError(f"Unexpected NOT in '{self.phrase}'.")
+
+        if self.accept("keyword", "is"):
+            negated = self.accept("keyword", "not")
+            self.expect("keyword", "null")
+            return IsNull(left, negated)
+
+        kind, operator = self.peek()
+        if kind == "symbol" and operator in ("=", "<>", "!=", "<", "<=", ">", ">="):
+            self.position += 1
+            return Comparison("<>" if operator == "!=" else operator, left, self.value())
+
+        # A bare boolean column or literal
+        return left
+
+    def _continues_value(self) -> bool:
+        kind, value = self.peek()
+        return (kind == "symbol" and value in ("=", "<>", "!=", "<", "<=", ">", ">=", "+", "-", "*", "/", "::")) or (
+            kind == "keyword" and value in ("in", "between", "like", "ilike", "is")
+        )
+
+    # Values
+    def value(self):
+        left = self.term()
+        while self.peek()[0] == "symbol" and self.peek()[1] in ("+", "-"):
+            operator = self.expect("symbol")
+            left = Arithmetic(operator, left, self.term())
+        return left
+
+    def term(self):
+        left = self.primary()
+        while self.peek()[0] == "symbol" and self.peek()[1] in ("*", "/"):
+            operator = self.expect("symbol")
+            left = Arithmetic(operator, left, self.primary())
+        return left
+
+    def primary(self):
+        kind, value = self.peek()
+
+        if kind == "literal":
+            self.position += 1
+            result = Literal(value)
+        elif kind == "keyword" and value in ("true", "false", "null"):
+            self.position += 1
+            result = Literal({"true": True, "false": False, "null": None}[value])
+        elif kind == "symbol" and value == "-":
+            self.position += 1
+            result = Arithmetic("-", Literal(0), self.primary())
+        elif kind == "symbol" and value == "(":
+            self.position += 1
+            result = self.value()
+            self.expect("symbol", ")")
+        elif kind == "keyword" and value == "case":
+            self.position += 1
+            result = self.case()
+        elif kind in ("name", "column"):
+            self.position += 1
+            if self.peek() == ("symbol", "("):
+                raise UnsupportedPhraseError(f"The function '{value}' can't run outside the database.")
+            # The source frame's columns have no table alias, aa.units -> units
+            *qualifier, name = value.split(".") if kind == "name" else [value]
+            self.columns.add(name)
+            result = ColumnRef(name, qualifier[-1] if qualifier else None)
+        else:
+            raise UnsupportedPhraseError(f"Unexpected '{value}' in '{self.phrase}'.")
+
+        while self.accept("symbol", "::"):
+            type_name = self.expect("name")
+            if type_name not in NUMERIC_CASTS | TEXT_CASTS | {"boolean", "bool"}:
+                raise UnsupportedPhraseError(f"Can't cast to '{type_name}' outside the database.")
+            result = Cast(result, type_name)
+
+        return result
+
+    def case(self):
+        branches = []
+        while self.accept("keyword", "when"):
+            condition = self.condition()
+            self.expect("keyword", "then")
+            branches.append((condition, self.value()))
+
+        if not branches:
+            raise UnsupportedPhraseError("Only searched CASE (CASE WHEN ...) is supported outside the database.")
+
+        otherwise = self.value() if self.accept("keyword", "else") else None
+        self.expect("keyword", "end")
+
+        return Case(tuple(branches), otherwise)
+
+
+def parse_phrase(phrase: str) -> Aggregate:
+    if not phrase or not phrase.strip():
+        raise UnsupportedPhraseError("The aggregation phrase is empty.")
+
+    return _Parser(phrase).aggregate()
+
+
+## Evaluation against a DataFrame of source rows
+
+def _evaluate(node, frame: "pd.DataFrame"):
+    """
+    Values come back as Series (or scalars for literals), conditions as
+    nullable boolean Series so NULL behaves as it does in SQL.
+    """
+    import numpy as np
+    import pandas as pd
+
+    match node:
+        case Literal(value):
+            return value
+
+        case ColumnRef(name):
+            try:
+                return frame[name]
+            except KeyError:
+                raise UnsupportedPhraseError(f"The source has no column '{name}'.")
+
+        case Cast(operand, type_name):
+            value = _evaluate(operand, frame)
+            if type_name in INTEGER_CASTS:
+                # Postgres rounds half away from zero, 2.5::int is 3
+                if not isinstance(value, pd.Series):
+                    return None if value is None else int(np.sign(float(value)) * np.floor(abs(float(value)) + 0.5))
+                number = pd.to_numeric(value)
+                return (np.sign(number) * np.floor(np.abs(number) + 0.5)).astype("Int64")
+            if type_name in NUMERIC_CASTS:
+                return pd.to_numeric(value) if isinstance(value, pd.Series) else float(value)
+            if type_name in TEXT_CASTS:
+                return value.astype("string") if isinstance(value, pd.Series) else str(value)
+            return _as_condition(value, frame)
+
+        case Arithmetic(operator, left, right):
+            left, right = _evaluate(left, frame), _evaluate(right, frame)
+            if operator == "/":
+                # Integer division truncates in SQL
+                integer = _is_integer(left) and _is_integer(right)
+                left, right = _broadcast(left, frame).astype("Float64"), _broadcast(right, frame).astype("Float64")
+                quotient = np.trunc(left / right) if integer else left / right
+                # SQL raises on a zero divisor, but a CASE may still skip the
+                # row, so it's marked with inf and checked once it's summed
+                return quotient.mask((right == 0).fillna(False), np.inf)
+            return {"+": lambda: left + right, "-": lambda: left - right, "*": lambda: left * right}[operator]()
+
+        case Case(branches, otherwise):
+            result = _broadcast(_evaluate(otherwise, frame) if otherwise is not None else np.nan, frame)
+            for condition, value in reversed(branches):
+                chosen = _as_condition(_evaluate(condition, frame), frame).fillna(False).astype(bool)
+                result = _broadcast(_evaluate(value, frame), frame).where(chosen, result)
+            return result
+
+        case Comparison(operator, left, right):
+            left, right = _coerce(_evaluate(left, frame), _evaluate(right, frame))
+            compared = {
+                "=": lambda: left == right,
+                "<>": lambda: left != right,
+                "<": lambda: left < right,
+                "<=": lambda: left <= right,
+                ">": lambda: left > right,
+                ">=": lambda: left >= right,
+            }[operator]()
+            return _with_nulls(_broadcast(compared, frame), left, right)
+
+        case InList(operand, options, negated):
+            value = _broadcast(_evaluate(operand, frame), frame)
+            contained = _with_nulls(value.isin(options), value)
+            return ~contained if negated else contained
+
+        case IsNull(operand, negated):
+            value = _broadcast(_evaluate(operand, frame), frame)
+            return (value.notna() if negated else value.isna()).astype("boolean")
+
+        case Like(operand, pattern, case_sensitive, negated):
+            value = _broadcast(_evaluate(operand, frame), frame).astype("string")
+            expression = "^" + "".join(
+                ".*" if character == "%" else "." if character == "_" else re.escape(character)
+                for character in pattern
+            ) + "$"
+            matched = value.str.match(expression, case=case_sensitive).astype("boolean")
+            return ~matched if negated else matched
+
+        case BoolOp(operator, operands):
+            conditions = [_as_condition(_evaluate(operand, frame), frame) for operand in operands]
+            result = conditions[0]
+            for condition in conditions[1:]:
+                result = (result & condition) if operator == "and" else (result | condition)
+            return result
+
+        case Not(operand):
+            return ~_as_condition(_evaluate(operand, frame), frame)
+
+    raise UnsupportedPhraseError(f"Can't evaluate {node!r}.")
+
+
+def _broadcast(value, frame: "pd.DataFrame") -> "pd.Series":
+    import pandas as pd
+
+    if isinstance(value, pd.Series):
+        return value
+    return pd.Series([value] * len(frame), index=frame.index, dtype=None if value is not None else object)
+
+
+def _is_integer(value) -> bool:
+    import pandas as pd
+
+    if isinstance(value, pd.Series):
+        return pd.api.types.is_integer_dtype(value)
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+INTEGER_CASTS = {"int", "integer", "bigint", "smallint"}
+
+
+def _integer_expression(node, frame: "pd.DataFrame") -> bool:
+    """
+    Whether Postgres would type an expression as an integer. It's decided
+    from the tree rather than from values, so an expression made only of
+    literals (CASE WHEN c THEN 1 ELSE 0 END) counts as well.
+    """
+    match node:
+        case Literal(value):
+            # A bare NULL takes the type of the other branches
+            return value is None or _is_integer(value)
+        case ColumnRef():
+            return _is_integer(_evaluate(node, frame))
+        case Cast(_, type_name):
+            return type_name in INTEGER_CASTS
+        case Arithmetic(_, left, right):
+            return _integer_expression(left, frame) and _integer_expression(right, frame)
+        case Case(branches, otherwise):
+            return all(_integer_expression(value, frame) for _, value in branches) and (
+                otherwise is None or _integer_expression(otherwise, frame)
+            )
+
+    return _is_integer(_evaluate(node, frame))
+
+
+def _coerce(left, right):
+    """
+    Postgres reads a quoted literal as whatever type it's compared with,
+    so '5' compared with a numeric column is the number 5.
+    """
+    import pandas as pd
+
+    for column, literal, swap in ((left, right, False), (right, left, True)):
+        if isinstance(column, pd.Series) and isinstance(literal, str) and pd.api.types.is_numeric_dtype(column):
+            try:
+                number = float(literal)
+            except ValueError:
+                continue
+            return (number, column) if swap else (column, number)
+
+    return left, right
+
+
+def _with_nulls(result: "pd.Series", *operands) -> "pd.Series":
+    import pandas as pd
+
+    result = result.astype("boolean")
+    for operand in operands:
+        if isinstance(operand, pd.Series):
+            result = result.mask(operand.isna().to_numpy(), pd.NA)
+        elif operand is None:
+            result[:] = pd.NA
+    return result
+
+
+def _as_condition(value, frame: "pd.DataFrame") -> "pd.Series":
+    return _broadcast(value, frame).astype("boolean")
+
+
+@dataclass(frozen=True)
+class CompiledPhrase:
+    """
+    A phrase ready to be accumulated batch by batch, per geoid code.
+    """
+    variable_name: str
+    aggregate: Aggregate
+
+    @property
+    def columns(self) -> frozenset:
+        return self.aggregate.columns
+
+    def accumulate(self, frame: "pd.DataFrame", codes: "np.ndarray", size: int) -> "np.ndarray":
+        """
+        The aggregate over `frame` for each of `size` geoid codes. count and
+        sum both add up across batches, so the caller can sum the results.
+        """
+        import numpy as np
+        import pandas as pd
+
+        mask = np.ones(len(frame), dtype=bool)
+        if self.aggregate.where is not None:
+            where = _as_condition(_evaluate(self.aggregate.where, frame), frame)
+            mask &= where.fillna(False).to_numpy(dtype=bool)
+
+        if self.aggregate.argument is None:
+            return np.bincount(codes[mask], minlength=size)
+
+        values = _broadcast(_evaluate(self.aggregate.argument, frame), frame)
+        mask &= values.notna().to_numpy()
+
+        if self.aggregate.function == "count":
+            return np.bincount(codes[mask], minlength=size)
+
+        values = pd.to_numeric(values[mask]).to_numpy(dtype="float64")
+        if not np.isfinite(values).all():
+            raise DivisionByZeroError(f"{self.variable_name}: division by zero")
+        return np.bincount(codes[mask], weights=values, minlength=size)
+
+    def is_integer(self, frame: "pd.DataFrame") -> bool:
+        if self.aggregate.function == "count":
+            return True
+        try:
+            return _integer_expression(self.aggregate.argument, frame.head(0))
+        except UnsupportedPhraseError:
+            return False
+
+
+def compile_phrases(variables) -> list[CompiledPhrase]:
+    """
+    Parse every variable's phrase, raising UnsupportedPhraseError naming the
+    first variable that has to run on the database.
+    """
+    compiled = []
+    for variable in variables:
+        try:
+            compiled.append(
+                CompiledPhrase(variable.variable_name, parse_phrase(variable.sql_aggregation_phrase))
+            )
+        except UnsupportedPhraseError as e:
+            raise UnsupportedPhraseError(f"{variable.variable_name}: {e}")
+
+    return compiled
@@ -0,0 +1,210 @@
+"""
+Run a recipe's aggregation against a handful of geographies so a change to
+an sql_aggregation_phrase can be checked from the admin without a full
+build. Results are cached by a hash of everything that goes into the
+query, so previewing the same recipe again is instant.
+"""
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from sqlalchemy import Engine, text
+
+from .aggregation import build_inner_select, build_outer_select, build_query
+from .d3models import read_table_variables_to_dataframe
+from .recipes import EditionRecipe, TableRecipe
+from .sources import change_markers
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+DEFAULT_PREVIEW_DIRECTORY = ".pipeline_cache/previews"
+
+
+@dataclass
+class Preview:
+    table_name: str
+    edition: str
+    sample_geoids: list[str]
+    unsuppressed: "pd.DataFrame"
+    suppressed: "pd.DataFrame"
+    seconds: float
+    cached: bool = False
+
+    @property
+    def suppressed_cells(self) -> int:
+        return int(self.suppressed.isna().sum().sum() - self.unsuppressed.isna().sum().sum())
+
+
+def recipe_hash(
+    recipe: TableRecipe,
+    edition: EditionRecipe,
+    sample_geoids: list[str],
+    source_marker: Optional[int] = None,
+) -> str:
+    """
+    Changes whenever the query, the suppression or (if the source's change
+    marker is known) the source data would change the preview.
+    """
+    key = {
+        "table_name": recipe.table_name,
+        "suppression_threshold": recipe.suppression_threshold,
+        "raw_table": [edition.raw_table_db, edition.raw_table_schema, edition.raw_table_name],
+        "variables": [
+            [
+                variable.variable_name,
+                variable.sql_aggregation_phrase,
+                variable.indentation,
+                variable.parent_column,
+            ]
+            for variable in recipe.variables
+        ],
+        "sample_geoids": sorted(sample_geoids),
+        "source_marker": source_marker,
+    }
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def sample_geoids(engine: Engine, size: int = 25) -> list[str]:
+    """
+    A stable spread of geoids across every summary level, ordering by a hash
+    of the geoid so the sample (and the cache key) doesn't move between runs.
+    """
+    stmt = text("""
+        SELECT geoid
+        FROM (SELECT DISTINCT unnest(geoids) geoid FROM shp.blockgeom2geoids20) geoms
+        ORDER BY md5(geoid)
+        LIMIT :size
+    """)
+
+    with engine.connect() as connection:
+        return list(connection.scalars(stmt, {"size": size}))
+
+
+class PreviewCache:
+    """
+    Previews kept in memory for this process and as parquet on disk, so
+    they survive an admin restart.
+    """
+
+    def __init__(self, directory: str | Path = DEFAULT_PREVIEW_DIRECTORY):
+        self.directory = Path(directory)
+        self._previews: dict[str, Preview] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Preview]:
+        with self._lock:
+            if key in self._previews:
+                return self._previews[key]
+
+        path = self.directory / key
+        if not (path / "preview.json").exists():
+            return None
+
+        import pandas as pd
+
+        with open(path / "preview.json") as f:
+            details = json.load(f)
+
+        preview = Preview(
+            unsuppressed=pd.read_parquet(path / "unsuppressed.parquet"),
+            suppressed=pd.read_parquet(path / "suppressed.parquet"),
+            **details,
+        )
+
+        with self._lock:
+            self._previews[key] = preview
+
+        return preview
+
+    def put(self, key: str, preview: Preview):
+        with self._lock:
+            self._previews[key] = preview
+
+        path = self.directory / key
+        path.mkdir(parents=True, exist_ok=True)
+        preview.unsuppressed.to_parquet(path / "unsuppressed.parquet")
+        preview.suppressed.to_parquet(path / "suppressed.parquet")
+
+        # Written last, so a half written entry is never read back
+        with open(path / "preview.json", "w") as f:
+            json.dump(
+                {
+                    "table_name": preview.table_name,
+                    "edition": preview.edition,
+                    "sample_geoids": preview.sample_geoids,
+                    "seconds": preview.seconds,
+                },
+                f,
+            )
+
+
+def run_preview(
+    recipe: TableRecipe,
+    edition: EditionRecipe,
+    engine: Engine,
+    geoids: list[str],
+    cache: Optional[PreviewCache] = None,
+    statement_timeout_seconds: float = 30,
+) -> Preview:
+    """
+    Aggregate the recipe for the sample geoids and apply its suppression.
+    The query is cancelled by the server if it runs past the timeout.
+    """
+    from .suppression import apply_suppression
+
+    raw_table = (edition.raw_table_schema, edition.raw_table_name)
+    marker = change_markers(engine, [raw_table])[raw_table]
+    key = recipe_hash(recipe, edition, geoids, marker)
+
+    if cache is not None and (preview := cache.get(key)) is not None:
+        preview.cached = True
+        return preview
+
+    import pandas as pd
+
+    variables = list(recipe.variables)
+    query = build_query(
+        build_outer_select(variables),
+        build_inner_select(variables),
+        f"{edition.raw_table_schema}.{edition.raw_table_name}",
+        sample_geoids=geoids,
+    )
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        # set_config(..., true) is SET LOCAL, so the timeout ends with the transaction
+        connection.execute(
+            text("SELECT set_config('statement_timeout', :timeout, true)"),
+            {"timeout": str(int(statement_timeout_seconds * 1000))},
+        )
+        unsuppressed = pd.read_sql(query, connection)
+
+    if recipe.suppression_threshold:
+        suppressed = apply_suppression(
+            unsuppressed,
+            read_table_variables_to_dataframe(variables),
+            threshold=recipe.suppression_threshold,
+        )
+    else:
+        suppressed = unsuppressed
+
+    preview = Preview(
+        table_name=recipe.table_name,
+        edition=edition.edition,
+        sample_geoids=list(geoids),
+        unsuppressed=unsuppressed,
+        suppressed=suppressed,
+        seconds=time.perf_counter() - start,
+    )
+
+    if cache is not None:
+        cache.put(key, preview)
+
+    return preview
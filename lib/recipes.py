@@ -0,0 +1,195 @@
+"""
+Plain, immutable copies of the table build 'recipes' stored in the
+workspace database.
+
+Loading a recipe pulls the table metadata along with its editions,
+variables and variable groups in a fixed handful of queries (rather than
+one per lazy relationship), then copies everything out of the session so
+the result can be passed around freely once the session is closed.
+"""
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+from .connection import sqlalch_obj_to_dict
+from .d3models import (
+    D3TableMetadata,
+    D3VariableGroup,
+    InvalidEditionError,
+    InvalidTableError,
+)
+from .dtypes import CensusTableName, CensusVariableName, Indentation
+
+
+@dataclass(frozen=True)
+class VariableRecipe:
+    id: Optional[int]
+    variable_name: CensusVariableName
+    table_name: CensusTableName
+    indentation: Optional[Indentation] = None
+    description: Optional[str] = None
+    parent_column: Optional[CensusVariableName] = None
+    sql_aggregation_phrase: Optional[str] = None
+    documentation: Optional[str] = None
+
+    def __str__(self):
+        return f"{self.variable_name}: {self.description}"
+
+
+@dataclass(frozen=True)
+class EditionRecipe:
+    id: Optional[int]
+    table_name: CensusTableName
+    edition: str
+    documentation: Optional[str] = None
+    raw_table_db: Optional[str] = None
+    raw_table_schema: Optional[str] = None
+    raw_table_name: Optional[str] = None
+    time_frame: Optional[str] = None
+
+    def __str__(self):
+        return f"{self.table_name} for {self.edition}"
+
+
+@dataclass(frozen=True)
+class VariableGroupRecipe:
+    id: Optional[int]
+    table_name: CensusTableName
+    description: str
+    documentation: Optional[str] = None
+    parent_variable_name: Optional[CensusVariableName] = None
+    variables: tuple[CensusVariableName, ...] = ()
+
+
+@dataclass(frozen=True)
+class TableRecipe:
+    id: Optional[int]
+    table_name: CensusTableName
+    category: Optional[str] = None
+    description: Optional[str] = None
+    description_simple: Optional[str] = None
+    table_topics: Optional[str] = None
+    universe: Optional[str] = None
+    subject_area: Optional[str] = None
+    source: Optional[str] = None
+    suppression_threshold: Optional[int] = None
+    tool: Optional[str] = None
+    documentation: Optional[str] = None
+
+    variables: tuple[VariableRecipe, ...] = field(default=(), repr=False)
+    editions: tuple[EditionRecipe, ...] = field(default=(), repr=False)
+    variable_groups: tuple[VariableGroupRecipe, ...] = field(default=(), repr=False)
+
+    def __str__(self):
+        return f"{self.table_name}: {self.description_simple}"
+
+    def edition(self, edition: str) -> EditionRecipe:
+        for candidate in self.editions:
+            if candidate.edition == edition:
+                return candidate
+
+        raise InvalidEditionError(
+            f"'{edition}' is not a valid edition for table {self.table_name} -- update d3_edition_metadata to fix."
+        )
+
+    def latest_edition(self) -> EditionRecipe:
+        if not self.editions:
+            raise InvalidTableError(
+                f"'{self.table_name}' has no editions available -- update d3_edition_metadata to fix."
+            )
+
+        return max(self.editions, key=lambda edition: edition.edition)
+
+    def select_timeframe(self, timeframe: str) -> Optional[EditionRecipe]:
+        for edition in self.editions:
+            if edition.time_frame == timeframe:
+                return edition
+
+        return None
+
+    def past(self) -> Optional[EditionRecipe]:
+        return self.select_timeframe("PAST")
+
+    def present(self) -> Optional[EditionRecipe]:
+        return self.select_timeframe("PRESENT")
+
+
+def placeholder_edition(table_name: CensusTableName) -> EditionRecipe:
+    """
+    Hollow tables don't read from a raw table, so they get an edition
+    without any source information.
+    """
+    return EditionRecipe(id=None, table_name=table_name, edition="PLACEHOLDER")
+
+
+def _to_recipe(table: D3TableMetadata) -> TableRecipe:
+    variables = sorted(table.variables, key=lambda variable: variable.variable_name)
+    editions = sorted(table.all_editions, key=lambda edition: edition.edition)
+
+    return TableRecipe(
+        **sqlalch_obj_to_dict(table),
+        variables=tuple(
+            VariableRecipe(**sqlalch_obj_to_dict(variable)) for variable in variables
+        ),
+        editions=tuple(
+            EditionRecipe(**sqlalch_obj_to_dict(edition)) for edition in editions
+        ),
+        variable_groups=tuple(
+            VariableGroupRecipe(
+                **sqlalch_obj_to_dict(group),
+                variables=tuple(
+                    sorted(variable.variable_name for variable in group.variables)
+                ),
+            )
+            for group in sorted(table.variable_groups, key=lambda group: group.id)
+        ),
+    )
+
+
+def load_recipes(
+    db: Session, table_names: Iterable[CensusTableName]
+) -> dict[CensusTableName, TableRecipe]:
+    """
+    Load the recipes for many tables at once. The number of queries doesn't
+    depend on how many tables are requested: one for the tables and their
+    editions, one for the variables and one each for the groups and their
+    memberships.
+
+    Tables that aren't in d3_table_metadata are left out of the result.
+    """
+    table_names = list(dict.fromkeys(table_names))
+
+    if not table_names:
+        return {}
+
+    stmt = (
+        select(D3TableMetadata)
+        .where(D3TableMetadata.table_name.in_(table_names))
+        .options(
+            joinedload(D3TableMetadata.all_editions),
+            selectinload(D3TableMetadata.variables),
+            selectinload(D3TableMetadata.variable_groups).selectinload(
+                D3VariableGroup.variables
+            ),
+        )
+    )
+
+    tables = db.scalars(stmt).unique().all()
+
+    return {table.table_name: _to_recipe(table) for table in tables}
+
+
+def load_recipe(db: Session, table_name: CensusTableName) -> TableRecipe:
+    """
+    Load the full recipe for a single table.
+    """
+    recipes = load_recipes(db, [table_name])
+
+    if table_name not in recipes:
+        raise InvalidTableError(
+            f"'{table_name}' is not in d3_table_metadata -- add it in the admin before building."
+        )
+
+    return recipes[table_name]
@@ -0,0 +1,156 @@
+"""
+A local SQLite copy of the recipe tables in the workspace database.
+
+The recipes change rarely, so most builds can read them from disk instead
+of opening a tunnel to the workspace box. The snapshot uses the same
+table definitions as lib.d3models, so the usual loaders (lib.recipes) run
+against it unchanged.
+
+A snapshot younger than max_age_minutes is used as is. Once it's older,
+one query fetches a row count and checksum for every recipe table and only
+the tables whose checksum moved are copied again.
+"""
+import time
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    delete,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.orm import Session, sessionmaker
+
+from .d3models import Base
+
+
+DEFAULT_SNAPSHOT_PATH = ".pipeline_cache/metadata.sqlite"
+
+_state_metadata = MetaData()
+
+snapshot_state = Table(
+    "snapshot_state",
+    _state_metadata,
+    Column("table_name", String(64), primary_key=True),
+    Column("row_count", Integer()),
+    Column("fingerprint", String(32)),
+    Column("refreshed_at", Float()),
+)
+
+
+def _fingerprint_query() -> text:
+    """
+    One round trip that summarizes every recipe table. The md5 over the
+    ordered rows catches edits as well as inserts and deletes.
+    """
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        order_by = ", ".join(f"x.{column.name}" for column in table.primary_key)
+        parts.append(
+            f"SELECT '{table.name}' AS table_name, count(*) AS row_count, "
+            f"md5(coalesce(string_agg(x::text, ',' ORDER BY {order_by}), '')) AS fingerprint "
+            f"FROM {table.name} x"
+        )
+
+    return text("\nUNION ALL\n".join(parts))
+
+
+class MetadataSnapshot:
+    def __init__(self, path: str | Path, max_age_minutes: float = 60):
+        self.path = Path(path)
+        self.max_age_minutes = max_age_minutes
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.engine = create_engine(f"sqlite:///{self.path}")
+
+        Base.metadata.create_all(self.engine)
+        _state_metadata.create_all(self.engine)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["MetadataSnapshot"]:
+        settings = config.get("metadata_snapshot", {})
+
+        # Off unless asked for, edits made in the admin can take up to
+        # max_age_minutes to reach builds that read from the snapshot
+        if not settings.get("enabled", False):
+            return None
+
+        return cls(
+            settings.get("path", DEFAULT_SNAPSHOT_PATH),
+            max_age_minutes=settings.get("max_age_minutes", 60),
+        )
+
+    def session(self) -> sessionmaker:
+        return sessionmaker(self.engine)
+
+    def _state(self) -> dict[str, dict]:
+        with self.engine.connect() as connection:
+            return {
+                row.table_name: row._asdict()
+                for row in connection.execute(select(snapshot_state))
+            }
+
+    def is_expired(self) -> bool:
+        state = self._state()
+
+        if any(table.name not in state for table in Base.metadata.sorted_tables):
+            return True
+
+        oldest = min(row["refreshed_at"] for row in state.values())
+
+        return (time.time() - oldest) > (self.max_age_minutes * 60)
+
+    def refresh(self, workspace_db: Session, force: bool = False) -> list[str]:
+        """
+        Copy every recipe table whose checksum differs from the snapshot
+        (or all of them if force is set). Returns the names of the tables
+        that were copied.
+        """
+        state = self._state()
+        fingerprints = {
+            row.table_name: row for row in workspace_db.execute(_fingerprint_query())
+        }
+
+        stale = [
+            table
+            for table in Base.metadata.sorted_tables
+            if force
+            or (table.name not in state)
+            or (state[table.name]["fingerprint"] != fingerprints[table.name].fingerprint)
+        ]
+
+        now = time.time()
+        with self.engine.begin() as connection:
+            for table in reversed(stale):
+                connection.execute(delete(table))
+
+            for table in stale:
+                rows = [
+                    dict(row) for row in workspace_db.execute(select(table)).mappings()
+                ]
+                if rows:
+                    connection.execute(insert(table), rows)
+
+            connection.execute(delete(snapshot_state))
+            connection.execute(
+                insert(snapshot_state),
+                [
+                    {
+                        "table_name": name,
+                        "row_count": row.row_count,
+                        "fingerprint": row.fingerprint,
+                        "refreshed_at": now,
+                    }
+                    for name, row in fingerprints.items()
+                ],
+            )
+
+        return [table.name for table in stale]
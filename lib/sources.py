@@ -0,0 +1,62 @@
+"""
+Helpers for the raw source tables that the recipes aggregate from.
+"""
+from typing import Iterable, Optional
+
+from sqlalchemy import Engine, text
+
+from .recipes import EditionRecipe
+
+
+FILE_SOURCE = "file"
+"""
+raw_table_db for editions read from a GeoParquet or GeoPackage export
+(named in raw_table_name) instead of a source database. These need the
+strtree aggregation backend.
+"""
+
+
+RawTable = tuple[str, str, str]
+"""
+A raw table as (database, schema, table name), which is how
+d3_edition_metadata points at it.
+"""
+
+
+def raw_table_key(edition: EditionRecipe) -> Optional[RawTable]:
+    if (edition.raw_table_db is None) or (edition.raw_table_schema is None):
+        return None
+
+    return (edition.raw_table_db, edition.raw_table_schema, edition.raw_table_name)
+
+
+def change_markers(
+    engine: Engine, tables: Iterable[tuple[str, str]]
+) -> dict[tuple[str, str], Optional[int]]:
+    """
+    A cheap counter per (schema, table) that moves whenever rows are
+    inserted, updated or deleted, read from the statistics collector.
+
+    The counters reset when the server's statistics are reset, which only
+    ever shows up as a (harmless) extra change.
+    """
+    tables = list(tables)
+
+    if not tables:
+        return {}
+
+    stmt = text("""
+        SELECT schemaname, relname, n_tup_ins + n_tup_upd + n_tup_del AS marker
+        FROM pg_stat_all_tables
+        WHERE schemaname || '.' || relname = ANY(:names)
+    """)
+
+    with engine.connect() as connection:
+        found = {
+            (row.schemaname, row.relname): row.marker
+            for row in connection.execute(
+                stmt, {"names": [f"{schema}.{name}" for schema, name in tables]}
+            )
+        }
+
+    return {table: found.get(table) for table in tables}
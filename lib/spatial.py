@@ -0,0 +1,266 @@
+"""
+An in-process replacement for the PostGIS aggregation query.
+
+The block geometries and their block -> geoids crosswalk are loaded once
+into a shapely STRtree. Source features are read in batches, matched to
+the blocks they intersect, expanded to every geoid of each block (the
+unnest(geoids) in the SQL) and the recipe's phrases, translated by
+lib.phrases, are accumulated per geoid. Every geoid in the crosswalk is
+returned, zero filled, matching the RIGHT JOIN in build_query.
+
+Sources can be a table on the source database or a GeoParquet or
+GeoPackage export. Geometries are compared as they are, so the source and
+the blocks have to share a coordinate system.
+"""
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from sqlalchemy import Engine, text
+
+from .instrumentation import observe, stage
+from .phrases import CompiledPhrase, compile_phrases
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+
+BLOCK_TABLE = "shp.blockgeom2geoids20"
+DEFAULT_BATCH_SIZE = 50_000
+FILE_SUFFIXES = (".parquet", ".geoparquet", ".gpkg")
+
+_GEOMETRY = "__geometry"
+
+
+class BlockIndex:
+    """
+    Block geometries in an STRtree, with each block's geoids stored as
+    integer codes into `geoids` (a CSR layout: block i owns
+    codes[offsets[i]:offsets[i + 1]]).
+    """
+
+    def __init__(self, geometries: "np.ndarray", block_geoids: list[list[str]]):
+        import numpy as np
+        from shapely import STRtree
+
+        self.tree = STRtree(geometries)
+
+        self.geoids = np.array(sorted({geoid for geoids in block_geoids for geoid in geoids or ()}))
+        positions = {geoid: code for code, geoid in enumerate(self.geoids)}
+
+        lengths = np.array([len(geoids or ()) for geoids in block_geoids])
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.codes = np.array(
+            [positions[geoid] for geoids in block_geoids for geoid in geoids or ()], dtype="int64"
+        )
+
+    @classmethod
+    def from_engine(cls, engine: Engine, table: str = BLOCK_TABLE) -> "BlockIndex":
+        import shapely
+
+        stmt = text(f"SELECT geoids, ST_AsBinary(geom) AS wkb FROM {table}")
+        with engine.connect() as connection:
+            rows = connection.execute(stmt).all()
+
+        return cls(
+            shapely.from_wkb([bytes(row.wkb) if row.wkb is not None else None for row in rows]),
+            [
+                # A JSON array on the local backend
+                json.loads(row.geoids) if isinstance(row.geoids, str) else list(row.geoids or ())
+                for row in rows
+            ],
+        )
+
+    @classmethod
+    def from_file(cls, path: str | Path) -> "BlockIndex":
+        """
+        A GeoParquet or GeoPackage export of the block table, with its
+        geoids column as a list (or a JSON array in a GeoPackage).
+        """
+        geoids, geometries = [], []
+        for frame, batch_geometries in read_features(path, ["geoids"]):
+            geoids += [
+                json.loads(value) if isinstance(value, str) else list(value)
+                for value in frame["geoids"]
+            ]
+            geometries.append(batch_geometries)
+
+        import numpy as np
+
+        return cls(np.concatenate(geometries), geoids)
+
+    def assign(self, geometries: "np.ndarray") -> tuple["np.ndarray", "np.ndarray"]:
+        """
+        One (feature, geoid code) pair for every geoid of every block each
+        feature intersects.
+        """
+        import numpy as np
+
+        features, blocks = self.tree.query(geometries, predicate="intersects")
+
+        starts = self.offsets[blocks]
+        counts = self.offsets[blocks + 1] - starts
+        total = int(counts.sum())
+
+        # Position of each pair's geoids in self.codes, without a Python loop
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        codes = self.codes[np.repeat(starts, counts) + within]
+
+        return np.repeat(features, counts), codes
+
+
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def load_blocks(source: Engine | str | Path) -> BlockIndex:
+    """
+    The block index for an engine or an exported file, built once per
+    process.
+    """
+    key = str(source.url) if isinstance(source, Engine) else str(Path(source).resolve())
+
+    with _blocks_lock:
+        if key not in _blocks:
+            if isinstance(source, Engine):
+                _blocks[key] = BlockIndex.from_engine(source)
+            else:
+                _blocks[key] = BlockIndex.from_file(source)
+
+        return _blocks[key]
+
+
+def is_file_source(source: str) -> bool:
+    return str(source).lower().endswith(FILE_SUFFIXES)
+
+
+def read_features(
+    source: str | Path,
+    columns: list[str],
+    engine: Optional[Engine] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[tuple["pd.DataFrame", "np.ndarray"]]:
+    """
+    Yield (attributes, geometries) in batches from a table on `engine` or a
+    GeoParquet or GeoPackage file.
+    """
+    if not is_file_source(source):
+        yield from _read_table(source, columns, engine, batch_size)
+    elif str(source).lower().endswith(".gpkg"):
+        yield from _read_geopackage(Path(source), columns, batch_size)
+    else:
+        yield from _read_geoparquet(Path(source), columns, batch_size)
+
+
+def _read_table(source_table_name, columns, engine, batch_size):
+    import pandas as pd
+    import shapely
+
+    selected = ", ".join([f'"{column}"' for column in columns] + [f"ST_AsBinary(geom) AS {_GEOMETRY}"])
+    stmt = text(f"SELECT {selected} FROM {source_table_name}")
+
+    with engine.connect().execution_options(stream_results=True) as connection:
+        for frame in pd.read_sql(stmt, connection, chunksize=batch_size):
+            wkb = [bytes(value) if value is not None else None for value in frame.pop(_GEOMETRY)]
+            yield frame, shapely.from_wkb(wkb)
+
+
+def _read_geoparquet(path, columns, batch_size):
+    import pyarrow.parquet as pq
+    import shapely
+
+    parquet = pq.ParquetFile(path)
+
+    geo = json.loads((parquet.schema_arrow.metadata or {}).get(b"geo", b"{}"))
+    geometry_column = geo.get("primary_column", "geometry")
+    if geometry_column not in parquet.schema_arrow.names:
+        geometry_column = "geom"
+
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns + [geometry_column]):
+        frame = batch.to_pandas()
+        yield frame[columns], shapely.from_wkb(frame[geometry_column].to_numpy())
+
+
+def _gpkg_to_wkb(blob: Optional[bytes]) -> Optional[bytes]:
+    """
+    Strip the GeoPackage header (magic, version, flags, srs id and an
+    optional envelope) from a geometry blob, leaving standard WKB.
+    """
+    if blob is None:
+        return None
+
+    flags = blob[3]
+    envelope_size = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}[(flags >> 1) & 0b111]
+
+    return bytes(blob[8 + envelope_size:])
+
+
+def _read_geopackage(path, columns, batch_size):
+    import pandas as pd
+    import shapely
+
+    connection = sqlite3.connect(path)
+    try:
+        table_name, geometry_column = connection.execute(
+            """
+            SELECT c.table_name, g.column_name
+            FROM gpkg_contents c JOIN gpkg_geometry_columns g USING (table_name)
+            WHERE c.data_type = 'features'
+            """
+        ).fetchone()
+
+        selected = ", ".join(f'"{column}"' for column in columns + [geometry_column])
+        cursor = connection.execute(f'SELECT {selected} FROM "{table_name}"')
+
+        while rows := cursor.fetchmany(batch_size):
+            frame = pd.DataFrame.from_records(rows, columns=columns + [_GEOMETRY])
+            wkb = [_gpkg_to_wkb(blob) for blob in frame.pop(_GEOMETRY)]
+            yield frame, shapely.from_wkb(wkb)
+    finally:
+        connection.close()
+
+
+def run_spatial_aggregation(
+    source: str,
+    variables: list,
+    blocks: BlockIndex,
+    engine: Optional[Engine] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> "pd.DataFrame":
+    """
+    Same output as lib.aggregation.run_aggregation: a geoid column, then
+    one column per variable, with a row for every geoid in the crosswalk.
+    """
+    import numpy as np
+    import pandas as pd
+
+    phrases: list[CompiledPhrase] = compile_phrases(variables)
+    columns = sorted(set().union(*[phrase.columns for phrase in phrases]))
+
+    totals = [np.zeros(len(blocks.geoids)) for _ in phrases]
+    integer = [True for _ in phrases]
+
+    with stage("query"):
+        for frame, geometries in read_features(source, columns, engine, batch_size):
+            features, codes = blocks.assign(geometries)
+            pairs = frame.iloc[features].reset_index(drop=True)
+
+            for position, phrase in enumerate(phrases):
+                totals[position] += phrase.accumulate(pairs, codes, len(blocks.geoids))
+                integer[position] &= phrase.is_integer(pairs)
+
+        aggregated = pd.DataFrame(
+            {
+                "geoid": blocks.geoids,
+                **{
+                    phrase.variable_name: total.astype("int64") if is_integer else total
+                    for phrase, total, is_integer in zip(phrases, totals, integer)
+                },
+            }
+        )
+        observe(aggregated)
+
+    return aggregated
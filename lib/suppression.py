@@ -1,7 +1,13 @@
+from dataclasses import dataclass
 from textwrap import dedent
+from typing import Optional
+
+import numpy as np
 import pandas as pd
 
+from .columnar import mask_column
 from .dtypes import Indentation, CensusVariableName
+from .instrumentation import observe
 
 
 class Pivot:
@@ -114,10 +120,11 @@ def mute_small_values(
     return safe
 
 
-def apply_suppression(
-    df: pd.DataFrame, column_metadata: pd.DataFrame, threshold: int = 6
-) -> pd.DataFrame:
+def _value_columns(df: pd.DataFrame) -> list[str]:
+    return [label for label in df.columns if label not in ("geoid", "index")]
+
 
+def _check_indentation(column_metadata: pd.DataFrame):
     if column_metadata["indentation"].isna().any():
         raise ValueError(
             dedent("""
@@ -126,6 +133,168 @@ def apply_suppression(
             """)
         )   
 
+
+def _mute_from_pivots(
+    df: pd.DataFrame,
+    column_metadata: pd.DataFrame,
+    value_columns: list[str],
+    pivots: np.ndarray,
+    below_count: np.ndarray,
+) -> np.ndarray:
+    """
+    The mute mask over df.columns given each row's pivot (a position in
+    value_columns) and how many of its values are below the threshold.
+    """
+    all_below = below_count == len(value_columns)
+    right_on = (below_count > 0) & ~all_below
+
+    indentation = dict(zip(column_metadata["variable_name"], column_metadata["indentation"]))
+    lowered = dict(zip(column_metadata["variable_name"].str.lower(), column_metadata["indentation"]))
+
+    pivot_indent = np.full(len(df), np.inf)
+    for position in np.unique(pivots[right_on]):
+        pivot_column = value_columns[position]
+        if pivot_column not in indentation:
+            raise IndexError(f"{pivot_column} not found in column_metadata")
+        pivot_indent[right_on & (pivots == position)] = indentation[pivot_column]
+
+    column_indent = np.array([lowered.get(column, -np.inf) for column in df.columns], dtype=float)
+
+    mute = column_indent[np.newaxis, :] >= pivot_indent[:, np.newaxis]
+    mute[all_below] = np.asarray(df.columns != "geoid")
+
+    return mute
+
+
+def suppression_mask(
+    df: pd.DataFrame, column_metadata: pd.DataFrame, threshold: int = 6
+) -> tuple[list[str], np.ndarray]:
+    """
+    mute_small_values for every row at once: a boolean (rows, columns)
+    array over df.columns that is True where a value is suppressed, along
+    with the columns the pivot was looked for in.
+    """
+    value_columns = _value_columns(df)
+    values = df[value_columns].astype("int64").to_numpy()
+
+    below = values < threshold
+
+    # First highest value below the threshold, as idxmax picks it
+    pivots = np.where(below, values, np.iinfo("int64").min).argmax(axis=1)
+
+    return value_columns, _mute_from_pivots(df, column_metadata, value_columns, pivots, below.sum(axis=1))
+
+
+@dataclass
+class SuppressionSweep:
+    """
+    What suppression would remove at each of several thresholds.
+
+    `counts` has a row per threshold, summary level and variable with the
+    number of suppressed cells, out of `cells` geographies. `masks` maps
+    each threshold to its mute mask over `columns` when they were kept.
+    """
+
+    thresholds: list[int]
+    columns: list[str]
+    counts: pd.DataFrame
+    masks: Optional[dict[int, np.ndarray]] = None
+
+    def by_threshold(self) -> pd.DataFrame:
+        totals = self.counts.groupby("threshold")[["suppressed", "cells"]].sum()
+        totals["share"] = totals["suppressed"] / totals["cells"]
+        return totals
+
+    def by_summary_level(self) -> pd.DataFrame:
+        totals = self.counts.groupby(["threshold", "summary_level"])[["suppressed", "cells"]].sum()
+        totals["share"] = totals["suppressed"] / totals["cells"]
+        return totals
+
+
+def suppression_sweep(
+    df: pd.DataFrame,
+    column_metadata: pd.DataFrame,
+    thresholds: list[int],
+    keep_masks: bool = False,
+) -> SuppressionSweep:
+    """
+    apply_suppression's mute mask for every threshold from one pass over
+    the table. Each row is sorted once; a higher threshold only moves the
+    pivot further up the same sorted row, so every threshold is a cut of
+    it rather than a new search.
+    """
+    from .geography import summary_levels
+
+    _check_indentation(column_metadata)
+
+    thresholds = sorted(set(thresholds))
+    value_columns = _value_columns(df)
+    values = df[value_columns].astype("int64").to_numpy()
+    width = len(value_columns)
+
+    # Sorting the reversed row stably leaves the first of equal values
+    # last, so the top value below a threshold is the one idxmax picks
+    order = width - 1 - np.argsort(values[:, ::-1], axis=1, kind="stable")
+    ordered = np.take_along_axis(values, order, axis=1)
+
+    # Rows grouped by summary level once, so each threshold's counts are
+    # one reduceat over the grouped mask
+    levels, level_codes = np.unique(summary_levels(df["geoid"]).to_numpy(), return_inverse=True)
+    grouped = np.argsort(level_codes, kind="stable")
+    starts = np.searchsorted(level_codes[grouped], np.arange(len(levels)))
+    cells = np.bincount(level_codes, minlength=len(levels))
+    counted = [position for position, column in enumerate(df.columns) if column in value_columns]
+
+    counts, masks = [], {}
+    rows = np.arange(len(df))
+    for threshold in thresholds:
+        below_count = (ordered < threshold).sum(axis=1)
+        pivots = order[rows, np.maximum(below_count - 1, 0)] if width else np.zeros(len(df), dtype=int)
+
+        mute = _mute_from_pivots(df, column_metadata, value_columns, pivots, below_count)
+        if keep_masks:
+            masks[threshold] = mute
+
+        if len(df):
+            suppressed = np.add.reduceat(mute[grouped][:, counted].astype("int64"), starts, axis=0)
+        else:
+            suppressed = np.zeros((0, width), dtype="int64")
+        counts.append(
+            pd.DataFrame(
+                {
+                    "threshold": threshold,
+                    "summary_level": np.repeat(levels, width),
+                    "variable_name": np.tile(value_columns, len(levels)),
+                    "suppressed": suppressed.ravel(),
+                    "cells": np.repeat(cells, width),
+                }
+            )
+        )
+
+    observe(df)
+
+    return SuppressionSweep(
+        thresholds=thresholds,
+        columns=list(df.columns),
+        counts=pd.concat(counts, ignore_index=True),
+        masks=masks if keep_masks else None,
+    )
+
+
+def apply_suppression(
+    df: pd.DataFrame, column_metadata: pd.DataFrame, threshold: int = 6
+) -> pd.DataFrame:
+
+    _check_indentation(column_metadata)
+    observe(df)
+
+    _, mute = suppression_mask(df, column_metadata, threshold)
+
+    # Every column keeps its data buffer, only the validity bitmap changes
     return pd.DataFrame(
-        [mute_small_values(row, column_metadata, threshold) for _, row in df.iterrows()]
+        {
+            column: df[column] if column == "geoid" else mask_column(df[column], mute[:, position])
+            for position, column in enumerate(df.columns)
+        },
+        copy=False,
     )
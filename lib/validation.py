@@ -0,0 +1,156 @@
+"""
+Checks that an aggregated table is consistent with its variable hierarchy
+before it's suppressed: a parent's children should add up to it ("equal")
+or at least not exceed it ("not_exceed").
+
+The hierarchy comes from each variable's parent_column, or, where that's
+missing, from its indentation (the closest earlier variable indented one
+level less). It's compiled once per table into a sparse (variables,
+parents) matrix, so the children totals of every parent for every geoid
+are a single matrix multiply.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+
+from .instrumentation import observe
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from scipy.sparse import csc_matrix
+
+
+MODES = ("equal", "not_exceed", "off")
+
+# Absolute slack for float aggregates
+TOLERANCE = 1e-6
+
+
+@dataclass(frozen=True)
+class Hierarchy:
+    """
+    `children` has a 1 at (child, parent) for every parent in `parents`,
+    with rows and columns in the order of `variable_names` and `parents`.
+    """
+    variable_names: tuple[str, ...]
+    parents: tuple[str, ...]
+    children: "csc_matrix"
+
+
+def parent_columns(variables) -> dict[str, Optional[str]]:
+    """
+    Each variable's parent, falling back on indentation for the ones
+    without a parent_column.
+    """
+    parents = {}
+    latest_at_indent = {}
+
+    for variable in variables:
+        parent = variable.parent_column
+        if parent is None and variable.indentation:
+            parent = latest_at_indent.get(variable.indentation - 1)
+
+        parents[variable.variable_name] = parent
+        if variable.indentation is not None:
+            latest_at_indent[variable.indentation] = variable.variable_name
+
+    return parents
+
+
+@lru_cache(maxsize=256)
+def _hierarchy(structure: tuple[tuple[str, Optional[str]], ...]) -> Hierarchy:
+    import numpy as np
+    from scipy.sparse import csc_matrix
+
+    variable_names = tuple(name for name, _ in structure)
+    positions = {name: position for position, name in enumerate(variable_names)}
+
+    edges = [(positions[child], parent) for child, parent in structure if parent in positions]
+    parents = tuple(sorted({parent for _, parent in edges}, key=positions.get))
+    parent_positions = {parent: position for position, parent in enumerate(parents)}
+
+    children = csc_matrix(
+        (
+            np.ones(len(edges)),
+            ([child for child, _ in edges], [parent_positions[parent] for _, parent in edges]),
+        ),
+        shape=(len(variable_names), len(parents)),
+    )
+
+    return Hierarchy(variable_names, parents, children)
+
+
+def compile_hierarchy(variables) -> Hierarchy:
+    """
+    The parent-child matrix for a table's variables, cached by the shape
+    of the hierarchy so rebuilding a table doesn't recompile it.
+    """
+    return _hierarchy(tuple(parent_columns(variables).items()))
+
+
+def validate_hierarchy(
+    df: "pd.DataFrame", variables, mode: str = "not_exceed"
+) -> "pd.DataFrame":
+    """
+    The (geoid, parent) pairs whose children break the rule, with the
+    parent's value and its children's total. Variables missing from `df`
+    count as 0.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if mode not in MODES:
+        raise ValueError(f"Unknown validation mode '{mode}', expected one of {', '.join(MODES)}.")
+
+    columns = ["geoid", "parent_column", "parent_value", "children_total"]
+    hierarchy = compile_hierarchy(variables)
+    if mode == "off" or not hierarchy.parents or df.empty:
+        return pd.DataFrame(columns=columns)
+
+    present = [position for position, name in enumerate(hierarchy.variable_names) if name in df.columns]
+    values = np.zeros((len(df), len(hierarchy.variable_names)))
+    values[:, present] = df[[hierarchy.variable_names[position] for position in present]].to_numpy(
+        dtype="float64", na_value=0
+    )
+
+    # (geoids, variables) @ (variables, parents): every parent's children total at once
+    totals = np.asarray(values @ hierarchy.children)
+    parent_values = values[:, [hierarchy.variable_names.index(parent) for parent in hierarchy.parents]]
+
+    if mode == "equal":
+        broken = ~np.isclose(totals, parent_values, rtol=0, atol=TOLERANCE)
+    else:
+        broken = totals > parent_values + TOLERANCE
+
+    rows, parents = np.nonzero(broken)
+    violations = pd.DataFrame(
+        {
+            "geoid": df["geoid"].to_numpy()[rows],
+            "parent_column": np.array(hierarchy.parents, dtype=object)[parents],
+            "parent_value": parent_values[rows, parents],
+            "children_total": totals[rows, parents],
+        },
+        columns=columns,
+    )
+    observe(violations)
+
+    return violations
+
+
+def table_mode(settings: dict, table_name: str) -> str:
+    """
+    The mode for a table from the [validation] config: its entry under
+    [validation.tables], or else the default mode ("off" if unset).
+    """
+    return settings.get("tables", {}).get(table_name, settings.get("mode", "off"))
+
+
+def report_violations(table_name: str, mode: str, violations: "pd.DataFrame", limit: int = 10) -> str:
+    summary = violations.groupby("parent_column").size().sort_values(ascending=False)
+    lines = [
+        f"{table_name} fails the '{mode}' hierarchy check for {len(violations)} geoid/variable pairs:",
+        *[f"  {parent}: {count} geoids" for parent, count in summary.items()],
+        "",
+        violations.head(limit).to_string(index=False),
+    ]
+    return "\n".join(lines)
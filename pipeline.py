@@ -4,34 +4,11 @@ from pathlib import Path
 import argparse
 from argparse import RawTextHelpFormatter
 
-from sqlalchemy.orm import sessionmaker
 import tomli
 
-from lib.connection import (
-    build_workspace_engine,
-    build_source_engine,
-    build_destination_engine,
-    open_workspace_tunnel,
-    open_destination_tunnel,
-)
-from lib.d3models import (
-    get_table_metadata,
-    get_edition_metadata,
-    get_latest_edition_metadata,
-    get_variable_metadata,
-    read_table_variables_to_dataframe,
-    InvalidEditionError,
-    D3EditionMetadata,
-)
-from lib.aggregation import run_aggregation
-from lib.suppression import apply_suppression
-from lib.empty import build_empty_table
-from lib.delivery import (
-    push_base_table,
-    add_moe_columns,
-    push_moe_table,
-)
-from lib.metadata import update_metadata
+# The lib modules pull in pandas, SQLAlchemy and sshtunnel, so they're only
+# imported once a build actually starts. That keeps --help, --version and
+# argument errors quick. benchmarks/importtime.py guards this.
 
 
 __version__ = "0.0.3"
@@ -76,7 +53,7 @@ parser.add_argument(
     version=f"D3 HIP / SDC aggregator & DUA suppressor {__version__}",
 )
 parser.add_argument(
-    "table_name", help="The name of the table that you're building."
+    "table_name", nargs="?", help="The name of the table that you're building."
 )
 parser.add_argument(
     "-e",
@@ -100,6 +77,145 @@ parser.add_argument(
     action="store_true",
     help="Simply reads the table metadata from the workspace database--useful if you only want to rebuild metadata.",
 )
+parser.add_argument(
+    "-rm",
+    "--refresh-metadata",
+    action="store_true",
+    help="Recopy the recipes from the workspace database into the local metadata snapshot.",
+)
+parser.add_argument(
+    "-b",
+    "--batch",
+    metavar="MANIFEST",
+    help="Build every table listed in a toml manifest instead of a single table.",
+)
+parser.add_argument(
+    "-ap",
+    "--all_present",
+    action="store_true",
+    help="Build every table with a PRESENT edition in d3_edition_metadata.",
+)
+parser.add_argument(
+    "--backfill",
+    metavar="TABLE",
+    nargs="+",
+    help=dedent("""\
+        Build every edition of these tables into d3_<edition>, then refresh d3_present
+        and d3_past from the PRESENT and PAST editions."""),
+)
+parser.add_argument(
+    "--years",
+    metavar=("FIRST", "LAST"),
+    type=int,
+    nargs=2,
+    help="Only backfill the editions from FIRST to LAST (inclusive).",
+)
+parser.add_argument(
+    "--refresh_block_cache",
+    metavar="DB",
+    nargs="+",
+    help=dedent("""\
+        Rebuild the subdivided block geometries ([block_subdivision]) and the block
+        assignments ([block_assignment]) on these source databases if they're stale."""),
+)
+parser.add_argument(
+    "--watch",
+    action="store_true",
+    help=dedent("""\
+        Keep running and rebuild tables whenever their recipe or raw table changes.
+        Watches every PRESENT edition, or just the tables in --batch."""),
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    help="How many tables to build at once in batch mode (default from the [batch] config).",
+)
+parser.add_argument(
+    "--resume",
+    metavar="RUN_ID",
+    help="Restart a failed build from the first stage that didn't finish.",
+)
+parser.add_argument(
+    "--report",
+    metavar="PATH",
+    help="Write per-stage timings, memory and throughput for the run to a JSON file.",
+)
+parser.add_argument(
+    "--prometheus",
+    metavar="PATH",
+    help="Also write the run report as a Prometheus textfile.",
+)
+parser.add_argument(
+    "--trace_memory",
+    action="store_true",
+    help=dedent("""\
+        Record per-stage peak Python allocations with tracemalloc (slows the build down).
+        Stages that overlap another build (batches with --workers > 1) aren't measured."""),
+)
+parser.add_argument(
+    "--aggregation_backend",
+    choices=("sql", "strtree", "geoid"),
+    help=dedent("""\
+        'sql' aggregates on the source database, 'strtree' does the spatial join in
+        this process and 'geoid' is for sources already keyed by geoid, returning only
+        the geoids present in the source (default from the [aggregation] config)."""),
+)
+parser.add_argument(
+    "--strict_validation",
+    action="store_true",
+    help="Fail the build when the aggregates break the variable hierarchy checks in [validation].",
+)
+parser.add_argument(
+    "--compile_phrases",
+    action="store_true",
+    help=dedent("""\
+        Aggregate with the compiled query: CASE aggregates as FILTERs, duplicate phrases
+        and shared conditions computed once (default from the [aggregation] config)."""),
+)
+parser.add_argument(
+    "--assign_blocks",
+    action="store_true",
+    help=dedent("""\
+        Join the source to the blocks through its cached block assignment instead of
+        st_intersects, refreshing it first if needed (default from the
+        [block_assignment] config)."""),
+)
+parser.add_argument(
+    "--partitioned",
+    action="store_true",
+    help=dedent("""\
+        Deliver tables partitioned by summary level, one partition per geoid prefix
+        (default from the [delivery] config)."""),
+)
+parser.add_argument(
+    "--blobs",
+    action="store_true",
+    help=dedent("""\
+        Also deliver a JSON document per geoid and table to geography_blobs for the
+        API (default from the [blobs] config)."""),
+)
+parser.add_argument(
+    "--suppression_sweep",
+    metavar="THRESHOLD",
+    type=int,
+    nargs="+",
+    help=dedent("""\
+        Instead of building the table, report how many cells suppression would remove
+        at each of these thresholds, per summary level and variable."""),
+)
+parser.add_argument(
+    "--sweep_output",
+    metavar="DIRECTORY",
+    help=dedent("""\
+        Write the sweep's counts to counts.csv here, and with --sweep_masks each
+        threshold's mask to mask_<threshold>.parquet."""),
+)
+parser.add_argument(
+    "--sweep_masks",
+    action="store_true",
+    help="Keep the suppression mask for every threshold of the sweep (needs --sweep_output).",
+)
 parser.add_argument(
     "--config",
     default="pipeline_config.toml",
@@ -133,144 +249,307 @@ def get_destination_schema(namespace):
     return namespace.destination_schema
 
 
-def load_metadata(db, namespace):
+def metadata_session(config, connections, namespace):
     """
-    Load the metadata for the destination table. This contains the 'recipe' for the
-    sql query that generates the final aggregation.
+    Returns the sessionmaker to read recipes from. That's the local snapshot
+    if it's enabled in the config, so the workspace tunnel is only opened
+    when the snapshot is missing, expired or a refresh is requested.
     """
+    from lib.snapshot import MetadataSnapshot
+
+    snapshot = MetadataSnapshot.from_config(config)
+
+    # A local workspace is already a SQLite file, there's nothing to snapshot
+    if snapshot is None or config.get("backend", {}).get("kind") == "local":
+        return connections.workspace_session()
+
+    if namespace.refresh_metadata or snapshot.is_expired():
+        WorkspaceSession = connections.workspace_session()
+        with WorkspaceSession() as db:
+            refreshed = snapshot.refresh(db, force=namespace.refresh_metadata)
+
+        if refreshed:
+            print(f"Metadata snapshot refreshed: {', '.join(refreshed)}.")
 
-    if namespace.hollow:
-        edition_metadata = D3EditionMetadata(
-            table_name=namespace.table_name, edition="PLACEHOLDER"
+    return snapshot.session()
+
+
+def write_report(namespace, report):
+    if namespace.report:
+        report.write_json(namespace.report)
+    if namespace.prometheus:
+        report.write_prometheus(namespace.prometheus)
+
+
+def main_batch(namespace, config, connections, WorkspaceSession, report):
+    from lib.batch import read_manifest, present_jobs, run_batch, print_summary
+    from lib.checkpoint import checkpoint_directory
+    from lib.recipes import load_recipes
+
+    settings = config.get("batch", {})
+
+    with WorkspaceSession() as db:
+        if namespace.all_present:
+            jobs = present_jobs(db)
+        else:
+            jobs = read_manifest(namespace.batch)
+
+        recipes = load_recipes(db, [job.table_name for job in jobs])
+
+    print(f"Building {len(jobs)} tables.")
+    results = run_batch(
+        jobs,
+        recipes,
+        connections,
+        workers=namespace.workers or settings.get("workers", 4),
+        source_concurrency=settings.get("source_concurrency", 2),
+        destination_concurrency=settings.get("destination_concurrency", 2),
+        checkpoints=checkpoint_directory(config),
+        report=report,
+    )
+    print_summary(results)
+    write_report(namespace, report)
+
+    connections.close()
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+def main_sweep(namespace, job, recipe, connections, checkpoint, report):
+    from lib.build import sweep_table
+
+    with report.build(job.table_name, job.destination_schema):
+        sweep = sweep_table(
+            job, recipe, connections, namespace.suppression_sweep, keep_masks=namespace.sweep_masks
         )
-    elif not namespace.edition:
-        edition_metadata = get_latest_edition_metadata(db, namespace.table_name)
 
-    else:
+    print(f"Suppressed cells in {job.table_name}:\n")
+    print(sweep.by_summary_level().to_string())
+    print()
+    print(sweep.by_threshold().to_string())
+
+    if namespace.sweep_output:
+        import pandas as pd
+
+        directory = Path(namespace.sweep_output)
+        directory.mkdir(parents=True, exist_ok=True)
+        sweep.counts.to_csv(directory / "counts.csv", index=False)
+
+        for threshold, mask in (sweep.masks or {}).items():
+            pd.DataFrame(mask, columns=sweep.columns).to_parquet(directory / f"mask_{threshold}.parquet")
+
+        print(f"\nSweep written to {directory}.")
+
+    # A sweep never delivers, so there is nothing to resume
+    checkpoint.cleanup()
+    connections.close()
+
+
+def main_backfill(namespace, config, connections, WorkspaceSession, report):
+    from lib.batch import backfill_jobs, promote_time_frames, run_batch, print_summary
+    from lib.checkpoint import checkpoint_directory
+    from lib.recipes import load_recipes
+
+    settings = config.get("batch", {})
+
+    # Every edition shares its table's recipe, so each is loaded just once
+    with WorkspaceSession() as db:
+        recipes = load_recipes(db, namespace.backfill)
+
+    missing = [table_name for table_name in namespace.backfill if table_name not in recipes]
+    if missing:
+        print(f"Not in d3_table_metadata: {', '.join(missing)}.")
+
+    jobs = backfill_jobs(recipes.values(), namespace.years)
+
+    print(f"Backfilling {len(jobs)} editions of {len(recipes)} tables.")
+    results = run_batch(
+        jobs,
+        recipes,
+        connections,
+        workers=namespace.workers or settings.get("workers", 4),
+        source_concurrency=settings.get("source_concurrency", 2),
+        destination_concurrency=settings.get("destination_concurrency", 2),
+        checkpoints=checkpoint_directory(config),
+        report=report,
+    )
+    results += promote_time_frames(results, recipes, connections)
+
+    print_summary(results)
+    write_report(namespace, report)
+
+    connections.close()
+
+    if missing or not all(result.ok for result in results):
+        sys.exit(1)
+
+
+def main_watch(namespace, config, connections):
+    import signal
+
+    from lib.batch import read_manifest
+    from lib.checkpoint import checkpoint_directory
+    from lib.daemon import Watcher
+
+    watcher = Watcher(
+        config,
+        connections,
+        jobs=read_manifest(namespace.batch) if namespace.batch else None,
+        checkpoints=checkpoint_directory(config),
+    )
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("Stopping, waiting for running builds to finish.")
+        watcher.stop()
+
+    connections.close()
+
+
+def main_refresh_block_cache(namespace, connections):
+    from lib.blockcache import refresh_block_cache
+
+    for db_name in namespace.refresh_block_cache:
+        print(f"Refreshing the block cache on {db_name}.")
+        refresh_block_cache(connections.source_engine(db_name), connections.config)
+
+    connections.close()
+
+
+def read_job(namespace, config):
+    """
+    The job to build, either from the command line or from the checkpoint
+    of the run being resumed.
+    """
+    from lib.build import BuildJob
+    from lib.checkpoint import (
+        Checkpoint,
+        CheckpointError,
+        DEFAULT_CHECKPOINT_DIRECTORY,
+        checkpoint_directory,
+        start_checkpoint,
+    )
+
+    if namespace.resume:
+        directory = checkpoint_directory(config) or DEFAULT_CHECKPOINT_DIRECTORY
         try:
-            edition_metadata = get_edition_metadata(
-                db, namespace.table_name, namespace.edition
-            )
-        except InvalidEditionError as e:
+            checkpoint = Checkpoint.resume(directory, namespace.resume)
+        except CheckpointError as e:
             print(e)
             sys.exit()
 
-    table_metadata = get_table_metadata(db, namespace.table_name)
-    variable_metadata = get_variable_metadata(db, namespace.table_name)
+        return BuildJob(**checkpoint.job_options), checkpoint
 
-    if (
-        (edition_metadata.raw_table_db is None)
-        | (edition_metadata.raw_table_schema is None)
-    ) & (not namespace.hollow):
-        print(
-            "No database or schema provided in the editions metadata table. Add this argument before attempting again."
-        )
-        sys.exit()
-
-    print(f"Metadata loaded for {table_metadata.table_name}: {table_metadata.description}, beginning aggregation.")
+    job = BuildJob(
+        table_name=namespace.table_name,
+        edition=namespace.edition,
+        # This has some validation side effects, so run it here before any querying happens
+        destination_schema=get_destination_schema(namespace),
+        hollow=namespace.hollow,
+        no_update=namespace.no_update,
+    )
 
-    return edition_metadata, variable_metadata, table_metadata
+    return job, start_checkpoint(config, job)
 
 
 def main():
     namespace = parser.parse_args()
 
+    modes = [
+        namespace.table_name is not None,
+        bool(namespace.batch or namespace.all_present) and not namespace.watch,
+        namespace.resume is not None,
+        namespace.watch,
+        namespace.backfill is not None,
+        namespace.refresh_block_cache is not None,
+    ]
+    if sum(modes) != 1:
+        parser.error(
+            "Provide one of a table_name, --batch / --all_present, --resume, --watch, --backfill "
+            "or --refresh_block_cache."
+        )
+    if namespace.years and not namespace.backfill:
+        parser.error("--years only applies to --backfill.")
+    if namespace.suppression_sweep and not modes[0]:
+        parser.error("--suppression_sweep works on a single table_name.")
+    if namespace.sweep_masks and not namespace.sweep_output:
+        parser.error("--sweep_masks needs a --sweep_output directory.")
+
     with open(namespace.config, "rb") as f:
         config = tomli.load(f)
 
-    # This has some validation side effects, so run it here before any querying happens
-    destination_schema = get_destination_schema(namespace)
+    if namespace.aggregation_backend:
+        config.setdefault("aggregation", {})["backend"] = namespace.aggregation_backend
+    if namespace.strict_validation:
+        config.setdefault("validation", {})["strict"] = True
+    if namespace.compile_phrases:
+        config.setdefault("aggregation", {})["compile_phrases"] = True
+    if namespace.assign_blocks:
+        config.setdefault("block_assignment", {})["enabled"] = True
+    if namespace.partitioned:
+        config.setdefault("delivery", {})["partition_by_summary_level"] = True
+    if namespace.blobs:
+        config.setdefault("blobs", {})["enabled"] = True
+
+    from lib.connection import get_backend
+    from lib.instrumentation import RunReport
+    from lib.build import BuildError, build_table
+    from lib.d3models import InvalidEditionError, InvalidTableError
+    from lib.recipes import load_recipe
+
+    if modes[0] or modes[2]:
+        job, checkpoint = read_job(namespace, config)
+
+    # Tunnels and engines are opened lazily and reused for the whole process
+    connections = get_backend(config)
+
+    if namespace.watch:
+        return main_watch(namespace, config, connections)
+    if modes[5]:
+        return main_refresh_block_cache(namespace, connections)
 
     # 1. Load metadata
-    # because the workspace database is on a box accessible through ssh, open a tunnel
-    with open_workspace_tunnel(config) as tunnel:
-        workspace_engine = build_workspace_engine(config, tunnel.local_bind_port) # type: ignore
-        WorkspaceSession = sessionmaker(workspace_engine)
+    WorkspaceSession = metadata_session(config, connections, namespace)
 
-        with WorkspaceSession() as db:
-            # Load metadata from the workspace database
-            edition_metadata, variable_metadata, table_metadata = load_metadata(
-                db, namespace
-            )
-            variable_metadata_df = read_table_variables_to_dataframe(
-                variable_metadata
-            )
-
-    # 2. Run aggregation
-    if namespace.hollow or namespace.no_update:
-        # If the hollow flag is set, build an empty dataframe with the correct shape.
-        unsuppressed = build_empty_table(variable_metadata)
-
-    else:
-        # otherwise run the aggregation to obtain the dataframe
-        source_engine = build_source_engine(
-            config,
-            edition_metadata.raw_table_db,
-        )
-        unsuppressed = run_aggregation(
-            # Have to do it this way because the postgis stuff isn't available in the lower namespaces.
-            # Maybe there is a way to handle this by adding to the schema instead of replacing the schema name.
-            f"{edition_metadata.raw_table_schema}.{edition_metadata.raw_table_name}",
-            variable_metadata,
-            source_engine,
-        )
+    report = RunReport(trace_memory=namespace.trace_memory)
 
-    # 3. Apply suppression if necessary
-    if not table_metadata.suppression_threshold:
-        print("Aggregation complete.")
-        final = unsuppressed
-    elif namespace.hollow:
-        print("Hollow table ready.")
-        final = unsuppressed
-    elif namespace.no_update:
-        final = unsuppressed
-    else:
-        print("Aggregation complete, beginning suppression.")
-        final = apply_suppression(
-            unsuppressed,
-            variable_metadata_df,
-            threshold=table_metadata.suppression_threshold, 
-        )
+    if modes[1]:
+        return main_batch(namespace, config, connections, WorkspaceSession, report)
+    if modes[4]:
+        return main_backfill(namespace, config, connections, WorkspaceSession, report)
 
-    # 4. Deliver tables
-    # Need an ssh tunnel like the workspace connection above
-    with open_destination_tunnel(config) as tunnel:
-        destination_engine = build_destination_engine(
-            config, str(tunnel.local_bind_port), destination_schema # type: ignore
-        )
-        DestinationSession = sessionmaker(destination_engine)
-        if not namespace.no_update:
-            print(f"Pushing {namespace.table_name} to schema {destination_schema} on destination database.")
-
-            push_base_table(
-                final,
-                namespace.table_name,
-                destination_engine,
-                schema=destination_schema,
-            )
-
-            final_moe = add_moe_columns(final)
-            push_moe_table(
-                final_moe,
-                namespace.table_name,
-                destination_engine,
-                schema=destination_schema,
-            )
+    try:
+        with WorkspaceSession() as db:
+            try:
+                recipe = load_recipe(db, job.table_name)
+            except (InvalidEditionError, InvalidTableError) as e:
+                raise BuildError(str(e)) from e
+
+        if namespace.suppression_sweep:
+            return main_sweep(namespace, job, recipe, connections, checkpoint, report)
+
+        with report.build(job.table_name, job.destination_schema):
+            build_table(job, recipe, connections, checkpoint=checkpoint)
+    except BuildError as e:
+        print(e)
+        if checkpoint.started:
+            print(f"Restart it with --resume {checkpoint.run_id}")
         else:
-            print("No-update flag was selected so no data is moving.")
-
+            checkpoint.cleanup()
+        sys.exit()
+    except Exception:
+        if checkpoint.started:
+            print(f"Build failed, restart it with --resume {checkpoint.run_id}")
+        else:
+            checkpoint.cleanup()
+        raise
+    finally:
+        write_report(namespace, report)
 
-        # Update the metadata tables if necessary
-        print("Updating metadata on destination database.")
-        try:
-            with DestinationSession() as db:
-                update_metadata(
-                    db,
-                    table_metadata,
-                    variable_metadata,
-                )
-        except (TypeError, AttributeError) as e:
-            print(f"ERROR: Unable to update metadata--{e}")
+    connections.close()
 
     print("Complete!")
 
@@ -0,0 +1,123 @@
+"""
+lib.compiler's query against the verbatim phrases, on SQLite, and with
+the shared LATERAL on Postgres. The Postgres test runs against
+PIPELINE_TEST_POSTGRES_URL and is skipped without it.
+"""
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+
+from lib.aggregation import run_aggregation
+from lib.compiler import compile_aggregation
+
+
+def variable(name, phrase):
+    return SimpleNamespace(variable_name=name, sql_aggregation_phrase=phrase)
+
+
+GUARDED_DIVISION = "sum(CASE WHEN aa.units > 0 AND aa.kind = '{}' THEN aa.value / aa.units ELSE 0 END)"
+
+VARIABLES = [
+    variable("b99999001", "count(*)"),
+    variable("b99999002", "sum(aa.units)"),
+    variable("b99999003", "sum(CASE WHEN aa.kind = 'x' THEN aa.units ELSE 0 END)"),
+    variable("b99999004", "count(CASE WHEN aa.kind = 'x' THEN 1 END)"),
+    variable("b99999005", "sum(CASE WHEN aa.kind = 'y' AND aa.units > 0 THEN aa.units END)"),
+    variable("b99999006", GUARDED_DIVISION.format("x")),
+    variable("b99999007", GUARDED_DIVISION.format("y")),
+    variable("b99999008", "sum(aa.units) FILTER (WHERE aa.kind = 'x')"),
+]
+
+# Overflows an integer on the units = 2000000 row, if it's computed outside the guard
+GUARDED_OVERFLOW = "sum(CASE WHEN aa.units < 10 AND aa.kind = '{}' THEN aa.units * 1000000000 ELSE 0 END)"
+
+
+def create_source(connection, table):
+    connection.exec_driver_sql(f"CREATE TABLE {table} (geoid text, kind text, units integer, value real)")
+    connection.exec_driver_sql(
+        f"""
+        INSERT INTO {table} VALUES
+            ('14000US1', 'x', 2, 10.0),
+            ('14000US1', 'x', 0, 5.0),
+            ('14000US1', 'y', 4, 2.0),
+            ('14000US2', 'y', 0, 1.0),
+            ('14000US2', 'y', NULL, 3.0),
+            ('14000US2', 'z', 2000000, 1.0),
+            ('14000US3', NULL, 1, NULL)
+        """
+    )
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        create_source(connection, "src")
+    return engine
+
+
+def test_compiled_matches_verbatim(engine):
+    verbatim = run_aggregation("src", VARIABLES, engine, backend="geoid")
+    # verify runs the verbatim query too and raises AggregationMismatchError on any difference
+    compiled = run_aggregation("src", VARIABLES, engine, backend="geoid", compile=True, verify=True)
+
+    assert list(compiled.columns) == list(verbatim.columns)
+    assert compiled["b99999006"].tolist() == pytest.approx([5.0, 0.0, 0.0])
+    assert compiled["b99999007"].tolist() == pytest.approx([0.5, 0.0, 0.0])
+
+
+def test_guarded_division_stays_guarded():
+    compiled = compile_aggregation(VARIABLES, lateral=True)
+
+    # Shared per row, outside the CASE guard, so only expressions that can't raise
+    assert "aa.units > 0" in compiled.lateral
+    assert "/" not in compiled.lateral
+    assert "(aa.value / aa.units)" in compiled.aggregates["b99999006"]
+
+
+def test_casts_are_not_shared():
+    variables = [
+        variable(f"b9999900{k}", f"sum(CASE WHEN aa.code::int > 5 AND aa.kind = '{k}' THEN 1 ELSE 0 END)")
+        for k in (1, 2)
+    ]
+
+    assert compile_aggregation(variables, lateral=True).lateral == ""
+
+
+def test_arithmetic_on_columns_is_not_shared():
+    variables = [variable(f"b9999900{k}", GUARDED_OVERFLOW.format(k)) for k in ("x", "y")]
+    compiled = compile_aggregation(variables, lateral=True)
+
+    assert "aa.units < 10" in compiled.lateral
+    assert "*" not in compiled.lateral
+
+
+@pytest.mark.skipif(
+    not os.environ.get("PIPELINE_TEST_POSTGRES_URL"), reason="PIPELINE_TEST_POSTGRES_URL isn't set"
+)
+def test_lateral_matches_verbatim_on_postgres():
+    engine = create_engine(os.environ["PIPELINE_TEST_POSTGRES_URL"])
+    schema = "pipeline_test_compiler"
+    variables = VARIABLES + [
+        variable("b99999009", GUARDED_OVERFLOW.format("x")),
+        variable("b99999010", GUARDED_OVERFLOW.format("y")),
+    ]
+    assert compile_aggregation(variables, lateral=True).lateral
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        connection.exec_driver_sql(f'CREATE SCHEMA "{schema}"')
+        create_source(connection, f'"{schema}".src')
+    try:
+        source = f'"{schema}".src'
+        verbatim = run_aggregation(source, variables, engine, backend="geoid")
+        compiled = run_aggregation(source, variables, engine, backend="geoid", compile=True, verify=True)
+
+        assert list(compiled.columns) == list(verbatim.columns)
+        assert compiled["b99999006"].tolist() == pytest.approx([5.0, 0.0, 0.0])
+        assert compiled["b99999009"].tolist() == [2000000000, 0, 0]
+    finally:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP SCHEMA "{schema}" CASCADE')
@@ -0,0 +1,85 @@
+"""
+Partition pruning for tables delivered by summary level (lib.ddl).
+
+The Postgres test runs against PIPELINE_TEST_POSTGRES_URL and is skipped
+without it. The bounds tests need no database: they route geoids through
+the generated ranges in byte order, which is what the "C" collation on
+geoid gives Postgres.
+"""
+import os
+import re
+
+import pytest
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from lib.ddl import create_partitioned_table, partition_bounds, partition_name, partitioned_table
+from lib.delivery import partitions_scanned
+
+
+LEVELS = ["040", "050", "059", "060", "140", "150", "160", "860"]
+GEOIDS = {
+    "040": "04000US26",
+    "050": "05000US26163",
+    "059": "05900US2616322000",
+    "060": "06000US2616322000",
+    "140": "14000US26163520100",
+    "150": "15000US261635201001",
+    "160": "16000US2622000",
+    "860": "86000US48201",
+}
+
+_RANGE = re.compile(r"FOR VALUES FROM \('(.*)'\) TO \('(.*)'\)")
+
+
+def routed(geoid: str, levels: list[str]) -> list[str]:
+    """
+    The partitions whose bounds hold `geoid`, or the DEFAULT partition.
+    """
+    partitions = []
+    for level in levels:
+        lower, upper = _RANGE.match(partition_bounds(level)).groups()
+        if lower.encode() <= geoid.encode() < upper.encode():
+            partitions.append(partition_name("b01001", level))
+    return partitions or [partition_name("b01001", None)]
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_each_summary_level_routes_to_one_partition(level):
+    assert routed(GEOIDS[level], LEVELS) == [partition_name("b01001", level)]
+
+
+def test_unknown_summary_level_goes_to_default():
+    assert routed("97000US2600001", LEVELS) == [partition_name("b01001", None)]
+
+
+def test_bounds_do_not_overlap():
+    ranges = sorted(_RANGE.match(partition_bounds(level)).groups() for level in LEVELS)
+    for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+        assert upper <= lower
+
+
+def test_partitioned_table_ddl():
+    table = partitioned_table("b01001", ["geoid", "b01001001"], MetaData(schema="d3_present"))
+    ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+
+    assert "PARTITION BY RANGE (geoid)" in ddl
+    assert 'COLLATE "C"' in ddl
+
+
+@pytest.mark.skipif(
+    not os.environ.get("PIPELINE_TEST_POSTGRES_URL"), reason="PIPELINE_TEST_POSTGRES_URL isn't set"
+)
+def test_lookups_scan_one_partition():
+    engine = create_engine(os.environ["PIPELINE_TEST_POSTGRES_URL"])
+    schema = "pipeline_test_partitions"
+    table = partitioned_table("b01001", ["geoid", "b01001001"], MetaData(schema=schema))
+
+    partitions = create_partitioned_table(engine, schema, table, LEVELS)
+    try:
+        for level in LEVELS:
+            assert partitions_scanned(engine, schema, "b01001", GEOIDS[level]) == [partitions[level]]
+    finally:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP SCHEMA "{schema}" CASCADE')
@@ -0,0 +1,79 @@
+"""
+The strtree backend against what the SQL path returns for the same
+phrases. Postgres isn't needed, the expected values are its results.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import shapely
+
+from lib.phrases import DivisionByZeroError
+from lib.spatial import BlockIndex, run_spatial_aggregation
+
+
+def variable(name, phrase):
+    return SimpleNamespace(variable_name=name, sql_aggregation_phrase=phrase)
+
+
+@pytest.fixture
+def blocks():
+    return BlockIndex(
+        np.array([shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1)]),
+        [["14000US1", "04000US1"], ["14000US2", "04000US1"]],
+    )
+
+
+@pytest.fixture
+def source(tmp_path):
+    points = [shapely.Point(0.5, 0.5), shapely.Point(0.5, 0.5), shapely.Point(2.5, 0.5), shapely.Point(2.5, 0.5)]
+    path = tmp_path / "source.parquet"
+    pq.write_table(
+        pa.table(
+            {
+                "x": pa.array([2.6, 2.6, -2.5, None], pa.float64()),
+                "u": pa.array([2, 5, 0, 3], pa.int64()),
+                "kind": pa.array(["a", "b", "a", "b"]),
+                "geometry": pa.array(shapely.to_wkb(points).tolist(), pa.binary()),
+            }
+        ),
+        path,
+    )
+    return str(path)
+
+
+# geoids in order: 04000US1, 14000US1, 14000US2
+EXPECTED = {
+    "b99999001": ("count(*)", [4, 2, 2]),
+    # ::int rounds half away from zero, -2.5 is -3
+    "b99999002": ("sum(aa.x::int)", [3, 6, -3]),
+    # integer division truncates
+    "b99999003": ("sum(aa.u / 2)", [4, 3, 1]),
+    # the zero divisor is never evaluated
+    "b99999004": ("sum(CASE WHEN aa.u > 0 THEN 10 / aa.u ELSE 0 END)", [10, 7, 3]),
+    "b99999005": ("sum(CASE WHEN aa.kind = 'a' THEN 1 ELSE 0 END)", [2, 1, 1]),
+    # a sum of only NULLs is zero filled, as the SQL backends COALESCE it
+    "b99999006": ("sum(aa.x) FILTER (WHERE aa.u > 0)", [5.2, 5.2, 0.0]),
+}
+
+
+def test_matches_sql_results(source, blocks):
+    aggregated = run_spatial_aggregation(
+        source, [variable(name, phrase) for name, (phrase, _) in EXPECTED.items()], blocks
+    )
+
+    assert aggregated["geoid"].tolist() == ["04000US1", "14000US1", "14000US2"]
+    for name, (phrase, expected) in EXPECTED.items():
+        assert aggregated[name].tolist() == pytest.approx(expected), phrase
+    for name in ("b99999001", "b99999002", "b99999003", "b99999004", "b99999005"):
+        assert aggregated[name].dtype == "int64", EXPECTED[name][0]
+
+
+def test_division_by_zero_raises(source, blocks):
+    with pytest.raises(DivisionByZeroError):
+        run_spatial_aggregation(source, [variable("b99999001", "sum(10 / aa.u)")], blocks)
+
+    with pytest.raises(DivisionByZeroError):
+        run_spatial_aggregation(source, [variable("b99999001", "sum(aa.u / 0)")], blocks)
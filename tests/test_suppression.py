@@ -0,0 +1,64 @@
+"""
+The vectorized suppression against mute_small_values, the row by row
+reference it replaced, on the synthetic tables from the benchmarks.
+"""
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import SHAPES, make_table, make_variables
+from lib.d3models import read_table_variables_to_dataframe
+from lib.suppression import apply_suppression, mute_small_values, suppression_mask, suppression_sweep
+
+THRESHOLD = 6
+SWEEP_THRESHOLDS = [1, 6, 11, 20, 5000]
+
+
+def synthetic(shape, seed=0):
+    variables = make_variables(25, shape)
+    table = make_table(variables, 150, small_fraction=0.3, threshold=THRESHOLD, seed=seed)
+
+    # Ties: values right at the threshold, and several equal values just
+    # below it so the pivot has to be the first of them
+    rng = np.random.default_rng(seed)
+    values = table.columns[1:]
+    for row in range(0, len(table), 3):
+        columns = rng.choice(values, size=4, replace=False)
+        table.loc[row, columns[:2]] = THRESHOLD
+        table.loc[row, columns[2:]] = THRESHOLD - 1
+
+    return table, read_table_variables_to_dataframe(variables)
+
+
+def reference_mask(table, column_metadata, threshold):
+    muted = table.apply(mute_small_values, axis=1, column_metadata=column_metadata, threshold=threshold)
+    return muted[list(table.columns)].isna().to_numpy() & table.notna().to_numpy()
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_mask_matches_mute_small_values(shape):
+    table, column_metadata = synthetic(shape)
+
+    _, mute = suppression_mask(table, column_metadata, THRESHOLD)
+
+    assert mute.any() and not mute.all()
+    np.testing.assert_array_equal(mute, reference_mask(table, column_metadata, THRESHOLD))
+
+    suppressed = apply_suppression(table, column_metadata, THRESHOLD)
+    np.testing.assert_array_equal(suppressed.isna().to_numpy(), mute)
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_sweep_matches_apply_suppression(shape):
+    table, column_metadata = synthetic(shape, seed=1)
+
+    sweep = suppression_sweep(table, column_metadata, SWEEP_THRESHOLDS, keep_masks=True)
+
+    value_columns = [column for column in table.columns if column != "geoid"]
+    for threshold in SWEEP_THRESHOLDS:
+        suppressed = apply_suppression(table, column_metadata, threshold).isna().to_numpy()
+        np.testing.assert_array_equal(sweep.masks[threshold], suppressed, err_msg=f"threshold {threshold}")
+
+        counts = sweep.counts[sweep.counts["threshold"] == threshold].set_index("variable_name")["suppressed"]
+        assert counts[value_columns].tolist() == suppressed[:, 1:].sum(axis=0).tolist()
+
+    np.testing.assert_array_equal(sweep.masks[THRESHOLD], reference_mask(table, column_metadata, THRESHOLD))